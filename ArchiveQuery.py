@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+ArchiveQuery.py
+
+Extraction engine used by WQDataExtractor.py. Rather than reading a whole
+'alldata_<area>.csv' file into memory and then filtering it, the filters for
+sampling points, date range and (optionally) determinands are applied while
+the archive is being read:
+
+- Parquet archive (see ParquetArchive.py): the filters are passed to pyarrow,
+  which skips any partition or row group whose statistics show it cannot
+  contain matching rows, and never loads non-matching rows into pandas.
+- .csv archive: the file is read in fixed-size chunks and each chunk is
+  filtered as soon as it is read, so only the matching rows are kept. If the
+  file has a sampling point index (see SiteIndex.py), only the parts of the
+  file holding the selected sampling points are read, and only the years
+  (partitions) of the file overlapping the date range.
+
+Data for sampling points spread over more than one EA operational area can
+be extracted in one go with query_areas, which first works out which areas
+hold data for the sampling points (find_areas) and then queries the area
+files side by side in a pool of worker processes, so the extraction takes
+about as long as the largest area rather than the sum of all of them.
+
+Either way the filtered data is returned from one pass over the archive with
+memory use bounded by the chunk size plus the size of the result, and with
+the column types set out in WQSchema.py. Each result's qualifier is turned
+into a qualifier code in the same pass (see ResultQualifiers.py).
+"""
+
+# Import modules:
+import os
+import glob
+import datetime
+import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from ParquetArchive import is_parquet_archive, open_archive, archive_areas
+from SiteIndex import load_index, select_ranges, select_partitions, read_ranges
+from WQSchema import read_dtypes, apply_schema, concat_frames
+from ResultQualifiers import add_qualifier_codes
+from PipelineTrace import span, count
+
+# pyarrow is only needed for the Parquet archive:
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pa_ds
+except ImportError:
+    pa = None
+
+# Number of rows to read from .csv archive at a time:
+CHUNK_SIZE = 100000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to convert a date to a datetime:
+def to_datetime(date):
+    '''
+    Function to convert a date given as a datetime, a date, a 'dd/mm/yyyy'
+    string (as entered in the ArcGIS tools) or an ISO 'yyyy-mm-dd...' string
+    into a datetime.
+
+    PARAMETERS:
+    - date: date to convert (or None)
+
+    RETURNS: datetime.datetime (or None)
+    '''
+    if date is None or isinstance(date, datetime.datetime):
+        return date
+    if isinstance(date, datetime.date):
+        return datetime.datetime(date.year, date.month, date.day)
+    if "/" in date:
+        return datetime.datetime.strptime(date, '%d/%m/%Y')
+    return pd.Timestamp(date).to_pydatetime()
+
+# Define function to filter a chunk of data using the query filters:
+def filter_chunk(df, locs, start_date, end_date, determinands=None):
+    '''
+    Function to filter a dataframe (or chunk of one) to only keep rows for the
+    selected sampling points, within the date range and (optionally) for the
+    selected determinands.
+
+    PARAMETERS:
+    - df: dataframe containing water quality data
+    - locs: set of sampling point notations (None for all)
+    - start_date: datetime; only rows after this are kept (None for no limit)
+    - end_date: datetime; only rows before this are kept (None for no limit)
+    - determinands: set of determinand definitions or notations (None for all)
+
+    RETURNS: filtered dataframe
+    '''
+    # Filter on the cheap text columns first so that dates only need parsing
+    # for rows which might be kept:
+    if locs is not None:
+        df = df[df['sample.samplingPoint.notation'].isin(locs)]
+    if determinands is not None:
+        df = df[df['determinand.definition'].isin(determinands) |
+                df['determinand.notation'].isin(determinands)]
+    if start_date is not None or end_date is not None:
+        dates = pd.to_datetime(df['sample.sampleDateTime'])
+        keep = pd.Series(True, index=df.index)
+        if start_date is not None:
+            keep &= dates > start_date
+        if end_date is not None:
+            keep &= dates < end_date
+        df = df[keep]
+    return df
+
+# Define function to query a .csv archive file:
+def query_csv(datafile, locs, start_date=None, end_date=None,
+              determinands=None, chunksize=CHUNK_SIZE):
+    '''
+    Function to extract the rows matching the query filters from an
+    'alldata_<area>.csv' file, reading and filtering it one chunk at a time.
+    If the file has a sampling point index, only the indexed parts of the file
+    for the selected sampling points and date range are read (or, if no
+    sampling points are selected, the years overlapping the date range).
+
+    PARAMETERS:
+    - datafile: path of .csv file
+    - locs: list of sampling point notations (None for all)
+    - start_date: start of date range (None for no limit)
+    - end_date: end of date range (None for no limit)
+    - determinands: list of determinand definitions or notations (None for all)
+    - chunksize: number of rows to read at a time
+
+    RETURNS: pandas dataframe of matching rows
+    '''
+    locs = None if locs is None else set(locs)
+    determinands = None if determinands is None else set(determinands)
+    start_date, end_date = to_datetime(start_date), to_datetime(end_date)
+
+    # If the file has an up-to-date sampling point index (see SiteIndex.py),
+    # only read the parts of the file holding the selected sampling points in
+    # the date range, or the year partitions overlapping the date range:
+    ranges = None
+    if locs is not None or start_date is not None or end_date is not None:
+        index = load_index(datafile)
+        if index is not None and locs is not None:
+            ranges = select_ranges(index, locs, start_date, end_date)
+        elif index is not None:
+            ranges = select_partitions(index, start_date, end_date)
+    if ranges is not None:
+        chunks = (pd.read_csv(piece, dtype=read_dtypes())
+                  for piece in read_ranges(datafile, index, ranges))
+    else:
+        chunks = pd.read_csv(datafile, chunksize=chunksize, dtype=read_dtypes())
+
+    # Time reading and filtering separately (if tracing, see PipelineTrace.py):
+    matches = []
+    chunks = iter(chunks)
+    while True:
+        with span("query.parse", file=os.path.basename(datafile)):
+            chunk = next(chunks, None)
+            if chunk is not None:
+                count("rows", len(chunk))
+        if chunk is None:
+            break
+        with span("query.filter"):
+            chunk = add_qualifier_codes(filter_chunk(chunk, locs, start_date, end_date, determinands))
+            count("rows_kept", len(chunk))
+        if len(chunk):
+            matches.append(chunk)
+    if not matches:
+        # Keep the columns of the archive even if nothing matched:
+        return add_qualifier_codes(apply_schema(pd.read_csv(datafile, nrows=0, dtype=read_dtypes())))
+    with span("query.merge"):
+        return apply_schema(concat_frames(matches))
+
+# Define function to build the pyarrow filter for a Parquet query:
+def parquet_filter(area_notation, locs, start_date, end_date, determinands=None):
+    '''
+    Function to build the pyarrow filter expression for a query, so that the
+    filters are applied while the Parquet archive is scanned.
+
+    PARAMETERS:
+    - area_notation: notation of EA operational area, or list of notations
+      (None for all areas)
+    - locs: list of sampling point notations (None for all)
+    - start_date: start of date range (None for no limit)
+    - end_date: end of date range (None for no limit)
+    - determinands: list of determinand definitions or notations (None for all)
+
+    RETURNS: pyarrow.dataset.Expression (or None if no filters)
+    '''
+    start_date, end_date = to_datetime(start_date), to_datetime(end_date)
+    filters = []
+    if isinstance(area_notation, (list, tuple, set)):
+        filters.append(pa_ds.field("area").isin(list(area_notation)))
+    elif area_notation is not None:
+        filters.append(pa_ds.field("area") == area_notation)
+    # Only year partitions overlapping the date range need to be opened:
+    if start_date is not None:
+        filters.append(pa_ds.field("year") >= start_date.year)
+        filters.append(pa_ds.field("sample.sampleDateTime") > pa.scalar(start_date, pa.timestamp("s")))
+    if end_date is not None:
+        filters.append(pa_ds.field("year") <= end_date.year)
+        filters.append(pa_ds.field("sample.sampleDateTime") < pa.scalar(end_date, pa.timestamp("s")))
+    if locs is not None:
+        filters.append(pa_ds.field("sample.samplingPoint.notation").isin(list(locs)))
+    if determinands is not None:
+        determinands = list(determinands)
+        filters.append(pa_ds.field("determinand.definition").isin(determinands) |
+                       pa_ds.field("determinand.notation").isin(determinands))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return expression
+
+# Define function to query a Parquet archive:
+def query_parquet(archive_dir, area_notation, locs, start_date=None,
+                  end_date=None, determinands=None, columns=None):
+    '''
+    Function to extract the rows matching the query filters from a Parquet
+    archive, pushing the filters down into the scan.
+
+    PARAMETERS:
+    - archive_dir: Parquet archive directory
+    - area_notation: notation of EA operational area, or list of notations
+      (None for all areas)
+    - locs: list of sampling point notations (None for all)
+    - start_date: start of date range (None for no limit)
+    - end_date: end of date range (None for no limit)
+    - determinands: list of determinand definitions or notations (None for all)
+    - columns: list of columns to return (None for all archive columns)
+
+    RETURNS: pandas dataframe of matching rows
+    '''
+    dataset = open_archive(archive_dir)
+    if columns is None:
+        columns = [n for n in dataset.schema.names if n not in ("area", "year")]
+    expression = parquet_filter(area_notation, locs, start_date, end_date, determinands)
+    with span("query.scan", archive=os.path.basename(archive_dir)):
+        df = add_qualifier_codes(apply_schema(dataset.to_table(columns=columns, filter=expression).to_pandas()))
+        count("rows_kept", len(df))
+    return df
+
+# Define function to query either kind of archive:
+def query_archive(wqArchive, area_notation, locs, start_date=None,
+                  end_date=None, determinands=None):
+    '''
+    Function to extract the rows matching the query filters for an EA
+    operational area from either a .csv archive directory (containing
+    'alldata_<area>.csv' files) or a Parquet archive directory.
+
+    PARAMETERS:
+    - wqArchive: archive directory
+    - area_notation: notation of EA operational area
+    - locs: list of sampling point notations (None for all)
+    - start_date: start of date range (None for no limit)
+    - end_date: end of date range (None for no limit)
+    - determinands: list of determinand definitions or notations (None for all)
+
+    RETURNS: pandas dataframe of matching rows
+    '''
+    if is_parquet_archive(wqArchive):
+        return query_parquet(wqArchive, area_notation, locs, start_date, end_date, determinands)
+    return query_csv(area_file(wqArchive, area_notation), locs, start_date, end_date, determinands)
+
+# Define function to get the .csv archive file for an area:
+def area_file(wqArchive, area_notation):
+    '''
+    Function to get the path of the 'alldata_<area>.csv' file for an EA
+    operational area in a .csv archive directory.
+
+    PARAMETERS:
+    - wqArchive: archive directory
+    - area_notation: notation of EA operational area
+
+    RETURNS: path of .csv file
+    '''
+    return os.path.join(wqArchive, "alldata_" + area_notation + ".csv")
+
+# Define function to list the areas held in either kind of archive:
+def list_areas(wqArchive):
+    '''
+    Function to list the EA operational areas held in an archive directory.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+
+    RETURNS: sorted list of area notations
+    '''
+    if is_parquet_archive(wqArchive):
+        return archive_areas(wqArchive)
+    files = glob.glob(area_file(wqArchive, "*"))
+    return sorted(os.path.basename(f)[len("alldata_"):-len(".csv")] for f in files)
+
+# Define function to work out which areas hold data for the sampling points:
+def find_areas(wqArchive, locs, default_areas=None):
+    '''
+    Function to work out which EA operational areas in an archive hold data
+    for the selected sampling points. For a .csv archive this uses each
+    file's sampling point index (see SiteIndex.py). Files without an index
+    (e.g. in an archive downloaded before indexes were built) could hold any
+    sampling point, so they are only included if they are one of the default
+    areas (or, if no default areas are given, always). For a Parquet archive
+    only the sampling point column is scanned.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+    - locs: list of sampling point notations
+    - default_areas: EA area notations chosen by the user (None if none)
+
+    RETURNS: sorted list of area notations
+    '''
+    locs = set(locs)
+    if is_parquet_archive(wqArchive):
+        table = open_archive(wqArchive).to_table(
+                columns=["area"], filter=pa_ds.field("sample.samplingPoint.notation").isin(list(locs)))
+        return sorted(set(table.column("area").to_pylist()))
+    areas = []
+    for area_notation in list_areas(wqArchive):
+        index = load_index(area_file(wqArchive, area_notation))
+        if index is None:
+            if default_areas is None or area_notation in default_areas:
+                areas.append(area_notation)
+        elif not locs.isdisjoint(index["sites"]):
+            areas.append(area_notation)
+    return areas
+
+# Define function to query several areas at once:
+def query_areas(wqArchive, areas, locs, start_date=None, end_date=None,
+                determinands=None, max_workers=None):
+    '''
+    Function to extract the rows matching the query filters from several EA
+    operational areas and merge them into one dataframe. The 'alldata_<area>'
+    .csv files are queried side by side in a pool of worker processes. A
+    Parquet archive is queried in one scan, as pyarrow already reads the
+    partitions using all processors.
+
+    PARAMETERS:
+    - wqArchive: archive directory
+    - areas: list of EA operational area notations (e.g. from find_areas)
+    - locs: list of sampling point notations (None for all)
+    - start_date: start of date range (None for no limit)
+    - end_date: end of date range (None for no limit)
+    - determinands: list of determinand definitions or notations (None for all)
+    - max_workers: number of worker processes (None for one per processor)
+
+    RETURNS: pandas dataframe of matching rows
+    '''
+    if not areas:
+        raise ValueError("No EA operational areas to query.")
+    if is_parquet_archive(wqArchive):
+        return query_parquet(wqArchive, list(areas), locs, start_date, end_date, determinands)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(areas))
+    if max_workers == 1:
+        results = [query_archive(wqArchive, area_notation, locs, start_date, end_date, determinands)
+                   for area_notation in areas]
+    else:
+        # Start workers afresh rather than forking (the default on Linux), so
+        # they do not inherit this process's trace or its locks (as on
+        # Windows):
+        with ProcessPoolExecutor(max_workers=max_workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(query_archive, wqArchive, area_notation, locs,
+                                   start_date, end_date, determinands)
+                       for area_notation in areas]
+            results = [future.result() for future in futures]
+    # Keep the columns of the archive even if nothing matched:
+    matches = [df for df in results if len(df)] or results[:1]
+    with span("query.merge", areas=len(areas)):
+        return apply_schema(concat_frames(matches))
@@ -0,0 +1,856 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+BatchDownloader.py
+
+Download engine used by CSVDownloader.py to fetch the pre-defined year/area
+batch datasets from the EA WIMS archive. Rather than requesting each dataset
+one after another, the year x area grid is split into download tasks which are
+run on a pool of worker threads sharing one pooled (keep-alive) HTTP session.
+The number of simultaneous requests sent to any one host is capped so that the
+archive server is not overloaded.
+
+Each response body is streamed straight to its yearly file in chunks (gzip
+compressed on the fly if requested) so that memory use stays flat however big
+the dataset is. The header line is checked as it arrives, so a response which
+is not a batch measurement dataset is rejected rather than saved.
+
+If a DownloadManifest is passed in, conditional requests are sent for datasets
+which have been downloaded before, and unchanged datasets are hard-linked from
+the previous download rather than fetched again.
+
+Downloads which fail for a reason that may pass (the connection dropping, a
+timeout, a body cut short, or a 429/5xx response) are tried again a set
+number of times, waiting longer after each attempt (exponential backoff with
+some randomness, so the workers do not all retry at once). If the server
+asks the tool to slow down (429, or a Retry-After header) every worker holds
+off sending requests to that host for the time asked. A dataset which still
+fails is reported at the end rather than stopping the other downloads.
+
+Each file is written under a temporary name and only renamed to its yearly
+filename once it is complete, so a stopped run never leaves a half-written
+file which looks like a finished download. If a DownloadJournal is passed in,
+the state of every dataset is checkpointed to it as the run goes, so a
+stopped run carries on where it left off when run again.
+
+The root URL is a parameter so that the engine can be pointed at a local
+stand-in server (see LocalWQAServer.py) instead of the live archive.
+"""
+
+# Import modules:
+import os
+import io
+import csv
+import gzip
+import hashlib
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import pandas as pd
+from DownloadManifest import link_or_copy
+from PipelineTrace import span, count, current_span
+
+# URL for EA WIMS API:
+ROOT_URL = "http://environment.data.gov.uk/water-quality"
+
+# Size of chunks (in bytes) to stream response bodies to disk in:
+CHUNK_SIZE = 1024 * 1024
+
+# Columns which must be present in the header of every batch dataset (these are
+# the columns used by the later stages of the tool):
+REQUIRED_COLUMNS = ["sample.samplingPoint.notation",
+                    "sample.samplingPoint.label",
+                    "sample.sampleDateTime",
+                    "determinand.definition",
+                    "determinand.unit.label",
+                    "resultQualifier.notation",
+                    "result",
+                    "sample.samplingPoint.easting",
+                    "sample.samplingPoint.northing"]
+
+# Number of rows to read at a time when adding a dataset to the registry and
+# statistics cube:
+SUMMARY_CHUNK_SIZE = 500000
+
+# Response codes which mean a request may succeed if tried again later:
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Time (in seconds) to wait for the server to accept a connection, and for
+# each part of the response to arrive:
+TIMEOUT = (10, 120)
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define error for unsuccessful HTTP status response codes:
+class StatusError(requests.ConnectionError):
+    '''
+    Error raised when a request does not return status code 200, holding the
+    status code and the number of seconds the server asked the tool to wait
+    before trying again (Retry-After header, or None).
+    '''
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+# Define function to check HTTP status response code following request:
+def http_status_checker(status, retry_after=None):
+    '''
+    Function to check if a webpage request was successful (code 200).
+
+    PARAMETERS:
+    - status: HTTP response status code
+    - retry_after: Retry-After header of response (or None)
+
+    RETURNS: None
+    '''
+    # HTTP status response code 200 OK status code indicates that the request has
+    # succeeded (https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/200).
+    # See https://httpstatuses.com/ for more details on status response codes.
+
+    # If status response code of request is not equal to 200:
+    if status != 200:
+        # Raise ConnectionError and print status code for user:
+        raise StatusError(
+                "Status code {} returned. Status code 200 expected."
+                .format(status), status, retry_after_seconds(retry_after))
+
+# Define function to read the Retry-After header of a response:
+def retry_after_seconds(value):
+    '''
+    Function to get the number of seconds to wait from a Retry-After header,
+    which may be a number of seconds or a date.
+
+    PARAMETERS:
+    - value: Retry-After header (or None)
+
+    RETURNS: number of seconds (None if no header or it cannot be read)
+    '''
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if when is None:
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+# Define class to hold the settings for retrying failed downloads:
+class RetryPolicy:
+    '''
+    Class holding how many times, and after how long, a failed download is
+    tried again.
+
+    PARAMETERS:
+    - attempts: maximum number of attempts for each dataset (1 to not retry)
+    - base_delay: wait (in seconds) before the first retry, doubled after
+      each further attempt
+    - max_delay: longest wait between attempts (unless asked by the server)
+    - max_retry_after: longest wait asked by the server (Retry-After) which
+      is kept to
+    - timeout: (connect, read) timeouts for each request, in seconds
+    - statuses: response codes which are worth trying again
+    '''
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=60.0,
+                 max_retry_after=300.0, timeout=TIMEOUT, statuses=RETRY_STATUSES):
+        self.attempts = max(int(attempts), 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.timeout = timeout
+        self.statuses = statuses
+
+    def is_transient(self, error):
+        '''
+        Function to check if a download error may pass if tried again (a
+        dropped connection, timeout, cut-short body or retryable status code).
+        Errors such as 404 or an unexpected header are not retried.
+
+        PARAMETERS:
+        - error: exception raised by download
+
+        RETURNS: True if download should be tried again
+        '''
+        if isinstance(error, StatusError):
+            return error.status in self.statuses
+        return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  requests.exceptions.ChunkedEncodingError))
+
+    def delay(self, attempt, error=None):
+        '''
+        Function to work out how long to wait before trying again: the
+        backoff for the attempt (between half and all of base_delay doubled
+        for each attempt so far, up to max_delay), or the wait asked for by
+        the server if that is longer.
+
+        PARAMETERS:
+        - attempt: number of attempts made so far (from 1)
+        - error: exception raised by download (or None)
+
+        RETURNS: number of seconds to wait
+        '''
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        wait = backoff / 2 + random.uniform(0, backoff / 2)
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            wait = max(wait, min(retry_after, self.max_retry_after))
+        return wait
+
+    def is_rate_limit(self, error):
+        '''
+        Function to check if an error means the server wants fewer requests
+        (429, or any response with a Retry-After header).
+
+        PARAMETERS:
+        - error: exception raised by download
+
+        RETURNS: True if the whole host should be held off
+        '''
+        return isinstance(error, StatusError) and (error.status == 429 or
+                                                   error.retry_after is not None)
+
+# Define function to build the batch download URL for a year and area:
+def batch_url(root, area_notation, year):
+    '''
+    Function to build the URL of the pre-defined batch dataset for one EA
+    operational area and one year.
+
+    PARAMETERS:
+    - root: root URL of the water quality archive API
+    - area_notation: notation of EA operational area (e.g. '3-35')
+    - year: year of data to download
+
+    RETURNS: URL as string
+    '''
+    return root + "/batch/measurement?area=" + str(area_notation) + "&year=" + str(year)
+
+# Define function to build the filename of a yearly dataset:
+def batch_filename(year, area_notation, compress=False):
+    '''
+    Function to build the filename used to save the batch dataset for one EA
+    operational area and one year (e.g. '2019_3-35.csv', or
+    '2019_3-35.csv.gz' if compressed).
+
+    PARAMETERS:
+    - year: year of data
+    - area_notation: notation of EA operational area
+    - compress: True if the file is gzip compressed
+
+    RETURNS: filename as string
+    '''
+    filename = str(year) + "_" + str(area_notation) + ".csv"
+    if compress:
+        filename += ".gz"
+    return filename
+
+# Define function to create a pooled HTTP session:
+def create_session(pool_size):
+    '''
+    Function to create a requests Session which keeps connections alive and
+    re-uses them between requests, with enough pooled connections per host for
+    each of the worker threads.
+
+    PARAMETERS:
+    - pool_size: maximum number of pooled connections per host
+
+    RETURNS: requests.Session
+    '''
+    session = requests.Session()
+    # Mount adapter with connection pool sized to number of workers:
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Define class to cap the number of simultaneous requests to each host:
+class HostLimiter:
+    '''
+    Class holding one semaphore per host so that no more than max_per_host
+    requests are sent to the same host at the same time, however many worker
+    threads are running. A host can also be paused (e.g. when it answers 429
+    Too Many Requests) so that no worker sends it requests for a while.
+
+    PARAMETERS:
+    - max_per_host: maximum number of concurrent requests to any one host
+    '''
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._resume = {}
+        self._lock = threading.Lock()
+
+    def pause(self, url, seconds):
+        '''
+        Function to stop requests to the host of a URL for a number of
+        seconds (or longer, if it is already paused for longer).
+
+        PARAMETERS:
+        - url: URL whose host is to be paused
+        - seconds: time to pause for
+
+        RETURNS: None
+        '''
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._resume[host] = max(self._resume.get(host, 0), time.time() + seconds)
+
+    def wait(self, url, stop=None):
+        '''
+        Function to wait until the host of a URL is no longer paused.
+
+        PARAMETERS:
+        - url: URL about to be requested
+        - stop: threading.Event which ends the wait early if set (or None)
+
+        RETURNS: None
+        '''
+        host = urlsplit(url).netloc
+        while True:
+            with self._lock:
+                remaining = self._resume.get(host, 0) - time.time()
+            if remaining <= 0 or (stop is not None and stop.is_set()):
+                return
+            if stop is not None:
+                stop.wait(remaining)
+            else:
+                time.sleep(remaining)
+
+    def semaphore(self, url):
+        '''
+        Function to get (or create) the semaphore for the host of a URL.
+
+        PARAMETERS:
+        - url: URL about to be requested
+
+        RETURNS: threading.BoundedSemaphore for that host
+        '''
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+# Define function to print progress through the download grid:
+def print_progress(done, total, task, info, seconds):
+    '''
+    Default progress callback for download_grid. Prints one line per
+    completed download.
+
+    PARAMETERS:
+    - done: number of downloads completed so far
+    - total: total number of downloads to do
+    - task: (year, area_notation, url, file) tuple for completed download
+    - info: dictionary of details for download (see download_task)
+    - seconds: time from the download being submitted to the pool until
+      it finished (including time waiting for a free worker)
+
+    RETURNS: None
+    '''
+    year, area_notation = task[0], task[1]
+    if info["status"] == "failed":
+        print(" [{0}/{1}] {2} {3} - failed after {4} attempt(s): {5}".format(
+                done, total, year, area_notation, info["attempts"], info["error"]))
+        return
+    print(" [{0}/{1}] {2} {3} - {4}, {5:.1f} MB in {6:.1f} s".format(
+            done, total, year, area_notation, info["status"],
+            info["bytes"] / 1e6, seconds))
+
+# Define function to get the temporary name a file is written under:
+def temp_filename(file):
+    '''
+    Function to get the temporary filename a yearly file is written to
+    before it is renamed into place (hidden, so it is not picked up by the
+    combine or Parquet stages, e.g. '.2019_3-35.csv.part').
+
+    PARAMETERS:
+    - file: path of yearly file
+
+    RETURNS: path of temporary file
+    '''
+    directory, name = os.path.split(file)
+    return os.path.join(directory, "." + name + ".part")
+
+# Define function to check the header line of a batch dataset:
+def check_header(line, required_columns=REQUIRED_COLUMNS):
+    '''
+    Function to check that the header line of a batch dataset contains all of
+    the columns needed by the later stages of the tool.
+
+    PARAMETERS:
+    - line: header line as bytes
+    - required_columns: list of column names which must be present
+
+    RETURNS: list of column names in header
+    '''
+    columns = next(csv.reader([line.decode("utf-8-sig").rstrip("\r\n")]), [])
+    missing = [c for c in required_columns if c not in columns]
+    if missing:
+        raise ValueError("Unexpected header in batch dataset, missing columns: {0}"
+                         .format(", ".join(missing)))
+    return columns
+
+# Define function to stream a response body to file:
+def stream_to_file(response, file, compress=False, chunk_size=CHUNK_SIZE,
+                   required_columns=REQUIRED_COLUMNS):
+    '''
+    Function to write the body of a streamed response to file chunk by chunk,
+    checking the header line as soon as it has arrived. The size, number of
+    data rows and SHA-256 hash of the body are worked out as it is written.
+    The body is written to a temporary file which is only renamed to file once
+    it is complete; if anything goes wrong the partly-written file is deleted.
+
+    PARAMETERS:
+    - response: requests.Response opened with stream=True
+    - file: path of file to write
+    - compress: True to gzip the file as it is written
+    - chunk_size: size of chunks to read from the response
+    - required_columns: columns which must be in the header (None to skip check)
+
+    RETURNS: dictionary with 'bytes' (uncompressed), 'rows' and 'sha256'
+    '''
+    opener = gzip.open if compress else open
+    sha256 = hashlib.sha256()
+    nbytes = 0
+    newlines = 0
+    last = b""
+    # Hold back the start of the body until the whole header line is in:
+    pending = b""
+    checked = required_columns is None
+    tmp = temp_filename(file)
+    try:
+        with opener(tmp, "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if not checked:
+                    pending += chunk
+                    if b"\n" not in pending:
+                        continue
+                    check_header(pending.split(b"\n", 1)[0], required_columns)
+                    checked = True
+                    chunk, pending = pending, b""
+                f.write(chunk)
+                sha256.update(chunk)
+                nbytes += len(chunk)
+                newlines += chunk.count(b"\n")
+                last = chunk[-1:] or last
+            # Body shorter than one line (e.g. empty dataset with no newline):
+            if not checked:
+                check_header(pending, required_columns)
+                f.write(pending)
+                sha256.update(pending)
+                nbytes += len(pending)
+                newlines += pending.count(b"\n")
+                last = pending[-1:] or last
+        # Only put file in place once it has all been written:
+        os.replace(tmp, file)
+    except BaseException:
+        # Remove partly-written file so it is not mistaken for a download:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    # Count lines (allowing for no newline at end of file), less header line:
+    lines = newlines + (1 if last not in (b"", b"\n") else 0)
+    return {"bytes": nbytes, "rows": max(lines - 1, 0), "sha256": sha256.hexdigest()}
+
+# Define function to download a single batch dataset to file:
+def download_batch(session, limiter, url, file, stream=True, compress=False,
+                   headers=None, timeout=None):
+    '''
+    Function to download one batch dataset and write it to a .csv file.
+
+    PARAMETERS:
+    - session: pooled requests.Session
+    - limiter: HostLimiter used to cap concurrent requests per host
+    - url: URL of batch dataset
+    - file: path of .csv file to write
+    - stream: True to stream the response body straight to file; False to read
+      it into a pandas dataframe first (original method, holds the whole
+      dataset in memory and adds an index column)
+    - compress: True to gzip the file as it is written (streaming only)
+    - headers: extra request headers (e.g. for a conditional request)
+    - timeout: (connect, read) timeouts in seconds (None to wait forever)
+
+    RETURNS: dictionary with 'status' ('downloaded', or 'not-modified' if the
+    server answered a conditional request with 304, in which case no file is
+    written), 'bytes', 'rows', 'sha256', 'etag' and 'last_modified'
+    '''
+    # Only send request once a slot is free for this host (the connection is
+    # in use until the whole body has been read):
+    with limiter.semaphore(url):
+        # Request data download from URL (timed until the headers arrive, see
+        # PipelineTrace.py):
+        with span("download.request", url=url):
+            response = session.get(url, stream=stream, headers=headers, timeout=timeout)
+        try:
+            # Dataset has not changed since previous download:
+            if response.status_code == 304:
+                return {"status": "not-modified", "bytes": 0}
+            # Call http_status_checker function to confirm successful request:
+            http_status_checker(response.status_code, response.headers.get("Retry-After"))
+            info = {"status": "downloaded",
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")}
+            if stream:
+                with span("download.write"):
+                    info.update(stream_to_file(response, file, compress=compress))
+                    count("bytes", info["bytes"])
+                    count("rows", info["rows"])
+                return info
+            # Return content of request:
+            content = response.text
+            info["bytes"] = len(response.content)
+            info["sha256"] = hashlib.sha256(response.content).hexdigest()
+        finally:
+            response.close()
+
+    # Read content of request into pandas dataframe using io:
+    with span("download.parse"):
+        df = pd.read_csv(io.StringIO(content))
+    # Write pandas dataframe to .csv file (via a temporary file, so the file
+    # is only there once complete):
+    with span("download.write"):
+        tmp = temp_filename(file)
+        try:
+            df.to_csv(tmp)
+            os.replace(tmp, file)
+        except BaseException:
+            # Remove partly-written file:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        count("bytes", info["bytes"])
+        count("rows", len(df))
+
+    info["rows"] = len(df)
+    return info
+
+# Define function to build the list of download tasks:
+def build_tasks(years, areas_list, output_dir, root=ROOT_URL, compress=False,
+                journal=None):
+    '''
+    Function to build the year x area grid of download tasks, skipping any
+    datasets which have already been downloaded to output_dir. If a journal
+    is given only the datasets it has marked as done are skipped (any other
+    file in output_dir is downloaded again).
+
+    PARAMETERS:
+    - years: iterable of years to download
+    - areas_list: list of EA operational area notations
+    - output_dir: directory to save yearly .csv files to
+    - root: root URL of the water quality archive API
+    - compress: True if yearly files are saved gzip compressed
+    - journal: DownloadJournal of this download directory (or None)
+
+    RETURNS: list of (year, area_notation, url, file) tuples
+    '''
+    tasks = []
+    for year in years:
+        for area_notation in areas_list:
+            file = os.path.join(output_dir, batch_filename(year, area_notation, compress))
+            # Check if file already exists to avoid repeatedly downloading
+            # the same data:
+            if os.path.isfile(file) and (journal is None or journal.is_done(area_notation, year)):
+                continue
+            tasks.append((year, area_notation, batch_url(root, area_notation, year), file))
+    return tasks
+
+# Define function to download one task, using the manifest if there is one:
+def download_task(session, limiter, task, stream=True, compress=False,
+                  manifest=None, timeout=None):
+    '''
+    Function to download the dataset for one task. If a manifest is given, a
+    conditional request is sent for datasets already held, and datasets which
+    have not changed are hard-linked from the previous download instead.
+
+    PARAMETERS:
+    - session: pooled requests.Session
+    - limiter: HostLimiter used to cap concurrent requests per host
+    - task: (year, area_notation, url, file) tuple
+    - stream: True to stream response bodies straight to file
+    - compress: True to save yearly files gzip compressed
+    - manifest: DownloadManifest (or None to always download)
+    - timeout: (connect, read) timeouts in seconds (None to wait forever)
+
+    RETURNS: dictionary of details for dataset (see download_batch), with
+    'status' of 'downloaded', 'unchanged' (downloaded, but same data as
+    before) or 'linked' (not modified, previous copy linked)
+    '''
+    year, area_notation, url, file = task
+    if manifest is None:
+        return download_batch(session, limiter, url, file, stream, compress, timeout=timeout)
+
+    previous = manifest.get(area_notation, year)
+    headers = manifest.conditional_headers(area_notation, year)
+    # Previous copy can only be re-used if it was saved in the same format:
+    if previous is not None and previous.get("file", "").endswith(".gz") != file.endswith(".gz"):
+        headers = {}
+    info = download_batch(session, limiter, url, file, stream, compress, headers, timeout)
+
+    if info["status"] == "not-modified":
+        # Link previous copy of dataset into this download directory:
+        link_or_copy(previous["file"], file)
+        entry = dict(previous)
+        info = dict(previous, status="linked", bytes=0)
+    else:
+        entry = {k: info.get(k) for k in ("etag", "last_modified", "bytes", "rows", "sha256")}
+        if previous is not None and previous.get("sha256") == info.get("sha256"):
+            info["status"] = "unchanged"
+
+    # Record latest copy of dataset in manifest:
+    entry["file"] = os.path.abspath(file)
+    entry["checked"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    manifest.update(area_notation, year, entry)
+    return info
+
+# Define function to download one task, trying again if it fails:
+def download_with_retry(session, limiter, task, stream=True, compress=False,
+                        manifest=None, retry=None, journal=None, stop=None):
+    '''
+    Function to download the dataset for one task (see download_task), trying
+    again after a wait if the download fails for a reason which may pass.
+    Each attempt and failure is recorded in the journal, if there is one.
+
+    PARAMETERS:
+    - session: pooled requests.Session
+    - limiter: HostLimiter used to cap (and pause) requests to each host
+    - task: (year, area_notation, url, file) tuple
+    - stream: True to stream response bodies straight to file
+    - compress: True to save yearly files gzip compressed
+    - manifest: DownloadManifest (or None to always download)
+    - retry: RetryPolicy (None for the default settings)
+    - journal: DownloadJournal to checkpoint the task's state to (or None)
+    - stop: threading.Event which stops any further attempts if set (or None)
+
+    RETURNS: dictionary of details for dataset (see download_task), with the
+    number of 'attempts' made
+    '''
+    retry = retry or RetryPolicy()
+    year, area_notation, url, file = task
+    attempt = 0
+    while True:
+        attempt += 1
+        # Hold off if the server has asked for fewer requests:
+        limiter.wait(url, stop)
+        if journal is not None:
+            journal.record(area_notation, year, "started", attempt=attempt)
+        try:
+            info = download_task(session, limiter, task, stream, compress, manifest,
+                                 retry.timeout)
+        except Exception as error:
+            if (attempt >= retry.attempts or not retry.is_transient(error) or
+                    (stop is not None and stop.is_set())):
+                # Note number of attempts made for the failure report:
+                error.attempts = attempt
+                raise
+            delay = retry.delay(attempt, error)
+            # Hold off every worker sending requests to this host:
+            if retry.is_rate_limit(error):
+                limiter.pause(url, delay)
+                count("rate_limited")
+            count("retries")
+            if journal is not None:
+                journal.record(area_notation, year, "retry", attempt=attempt,
+                               error=str(error), delay=round(delay, 2))
+            # Wait before trying again (stopped early if the run is stopped):
+            with span("download.backoff", attempt=attempt):
+                if stop is not None:
+                    stop.wait(delay)
+                else:
+                    time.sleep(delay)
+            continue
+        info["attempts"] = attempt
+        return info
+
+# Define function to add a downloaded dataset to the registry and cube:
+def summarise_dataset(file, area_notation, year, summaries, chunksize=SUMMARY_CHUNK_SIZE):
+    '''
+    Function to add a downloaded dataset to a sampling point registry and/or
+    statistics cube, reading the file once in chunks and passing each chunk
+    to all of them.
+
+    PARAMETERS:
+    - file: path of yearly .csv (or .csv.gz) file
+    - area_notation: notation of EA operational area
+    - year: year of data
+    - summaries: list of (name, SiteRegistry or StatsCube) tuples
+    - chunksize: number of rows to read at a time
+
+    RETURNS: None
+    '''
+    if not summaries:
+        return
+    columns = []
+    text = set()
+    for name, summary in summaries:
+        columns += [c for c in summary.source_columns if c not in columns]
+        text.update(summary.text_columns)
+    parts = {name: [] for name, summary in summaries}
+    with span("summaries.read", area=area_notation, year=year):
+        for chunk in pd.read_csv(file, usecols=columns, chunksize=chunksize,
+                                 dtype={c: str for c in text}):
+            for name, summary in summaries:
+                with span(name + ".add"):
+                    parts[name].append(summary.summarise_chunk(chunk, area_notation))
+    for name, summary in summaries:
+        with span(name + ".add"):
+            summary.add_chunks(parts[name], area_notation, year)
+
+# Define function to check the results of download_grid for failures:
+def check_failures(results):
+    '''
+    Function to check that every dataset in a download run was downloaded.
+
+    PARAMETERS:
+    - results: list of (task, info) tuples returned by download_grid
+
+    RETURNS: None
+    '''
+    failed = [task for task, info in results if info["status"] == "failed"]
+    # If any datasets failed, raise ConnectionError listing them for user:
+    if failed:
+        raise requests.ConnectionError(
+                "{0} datasets could not be downloaded ({1}). Run again to download "
+                "them (finished datasets are not downloaded again)."
+                .format(len(failed), ", ".join("{0} {1}".format(year, area_notation)
+                                               for year, area_notation, url, file in failed)))
+
+# Define function to download the whole year x area grid concurrently:
+def download_grid(years, areas_list, output_dir, root=ROOT_URL,
+                  max_workers=8, max_per_host=4, progress=print_progress,
+                  stream=True, compress=False, manifest=None, registry=None, cube=None,
+                  retry=None, journal=None):
+    '''
+    Function to download the batch datasets for every year and EA operational
+    area using a pool of worker threads. If a sampling point registry and/or
+    statistics cube is given, each dataset is added to them by the worker
+    thread as soon as it arrives, reading the file once for both (see
+    summarise_dataset). Failed downloads are tried again (see
+    download_with_retry); datasets which still fail are returned with status
+    'failed' and do not stop the rest of the run (see check_failures).
+
+    If a journal is given, datasets it has marked as done are not downloaded
+    again, and those done since the registry and cube were last saved are
+    added to them again.
+
+    PARAMETERS:
+    - years: iterable of years to download
+    - areas_list: list of EA operational area notations
+    - output_dir: directory to save yearly .csv files to
+    - root: root URL of the water quality archive API
+    - max_workers: number of worker threads
+    - max_per_host: maximum number of concurrent requests to any one host
+    - progress: function called after each download completes (or None)
+    - stream: True to stream response bodies straight to file
+    - compress: True to save yearly files gzip compressed (streaming only)
+    - manifest: DownloadManifest to refresh incrementally against (or None)
+    - registry: SiteRegistry to add downloaded datasets to (or None)
+    - cube: StatsCube to add downloaded datasets to (or None)
+    - retry: RetryPolicy (None for the default settings)
+    - journal: DownloadJournal of output_dir to checkpoint to (or None)
+
+    RETURNS: list of (task, info) tuples for completed downloads, where info is
+    the dictionary returned by download_with_retry (or, for failed downloads,
+    'status' 'failed', 'error' and 'attempts')
+    '''
+    if compress and not stream:
+        raise ValueError("compress=True requires stream=True.")
+    retry = retry or RetryPolicy()
+    years = list(years)
+    tasks = build_tasks(years, areas_list, output_dir, root, compress, journal)
+    total = len(tasks)
+    print("{0} datasets to download ({1} workers, max {2} per host).".format(
+            total, max_workers, max_per_host))
+
+    # Registry and cube (if given) to add each dataset to:
+    summaries = [(name, summary) for name, summary in (("registry", registry), ("cube", cube))
+                 if summary is not None]
+
+    # Add datasets finished by a stopped run, but not saved in the registry
+    # and cube, to them again:
+    if journal is not None:
+        for year in years:
+            for area_notation in areas_list:
+                file = os.path.join(output_dir, batch_filename(year, area_notation, compress))
+                if journal.is_unsaved(area_notation, year) and os.path.isfile(file):
+                    summarise_dataset(file, area_notation, year, summaries)
+
+    session = create_session(max_workers)
+    limiter = HostLimiter(max_per_host)
+    # Set to stop workers waiting to retry if the run is stopped:
+    stop = threading.Event()
+    results = []
+    # Span (if tracing) which the worker threads' spans are part of:
+    parent = current_span()
+
+    # Time each download from when it is submitted to the pool (so time spent
+    # waiting for a free worker is included):
+    def run(task, start):
+        year, area_notation, url, file = task
+        with span("download.dataset", parent, area=area_notation, year=year):
+            try:
+                info = download_with_retry(session, limiter, task, stream, compress,
+                                           manifest, retry, journal, stop)
+            except Exception as error:
+                # Record failure and carry on with the other datasets:
+                info = {"status": "failed", "bytes": 0, "error": str(error),
+                        "attempts": getattr(error, "attempts", 1)}
+                count("failed")
+                if journal is not None:
+                    journal.record(area_notation, year, "failed", error=info["error"],
+                                   attempts=info["attempts"])
+                return info, time.time() - start
+            # Datasets with the same data as last time are already in the
+            # registry and cube; the others are read once for both:
+            summarise_dataset(file, area_notation, year,
+                              [(name, summary) for name, summary in summaries
+                               if info["status"] == "downloaded" or
+                               not summary.has_batch(area_notation, year)])
+            if journal is not None:
+                journal.record(area_notation, year, "done", status=info["status"],
+                               attempts=info["attempts"], bytes=info.get("bytes"),
+                               rows=info.get("rows"), sha256=info.get("sha256"))
+        return info, time.time() - start
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(run, task, time.time()): task for task in tasks}
+            try:
+                for future in as_completed(futures):
+                    task = futures[future]
+                    # Re-raise any other error in the main thread:
+                    info, seconds = future.result()
+                    results.append((task, info))
+                    if progress is not None:
+                        progress(len(results), total, task, info, seconds)
+            except BaseException:
+                # Run stopped (e.g. Ctrl+C): drop datasets not yet started and
+                # stop workers waiting to retry, so the pool closes quickly.
+                # Downloads already under way finish, and the journal shows
+                # where to carry on from:
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        session.close()
+
+    # Summarise how many datasets actually had to be downloaded:
+    statuses = [info["status"] for task, info in results]
+    print("{0} downloaded, {1} unchanged, {2} linked from previous download.".format(
+            statuses.count("downloaded"), statuses.count("unchanged"), statuses.count("linked")))
+    if "failed" in statuses:
+        print("{0} datasets failed (run again to download them).".format(statuses.count("failed")))
+
+    return results
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+CSVCombiner.py
+
+Combine stage used by CSVDownloader.py to join the yearly .csv files for each
+EA operational area into one 'alldata_<area>.csv' file. Instead of reading
+every year into one pandas dataframe, the yearly files are appended to the
+output one after another so that only a small buffer is held in memory,
+however large the area is.
+
+The columns of all input files are reconciled into one header first (columns
+missing from a file are left blank and the index column written by older
+versions of CSVDownloader.py is dropped). Files whose header already matches
+are copied byte-for-byte without parsing. Because memory use no longer grows
+with the amount of data, an all-England 'alldata.csv' can also be written by
+appending the area files.
+"""
+
+# Import modules:
+import os
+import io
+import csv
+import glob
+import gzip
+from PipelineTrace import span, count
+
+# Size of blocks (in bytes) to copy files in:
+BLOCK_SIZE = 1024 * 1024
+
+# Number of re-mapped rows to buffer before writing to the output file:
+ROWS_PER_WRITE = 10000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to open a (possibly gzipped) .csv file:
+def open_csv(file, mode="rt"):
+    '''
+    Function to open a .csv or .csv.gz file.
+
+    PARAMETERS:
+    - file: path of file
+    - mode: 'rt' for text (csv module) or 'rb' for bytes
+
+    RETURNS: open file object
+    '''
+    if file.endswith(".gz"):
+        if mode == "rt":
+            return gzip.open(file, mode, encoding="utf-8-sig", newline="")
+        return gzip.open(file, mode)
+    if mode == "rt":
+        return open(file, mode, encoding="utf-8-sig", newline="")
+    return open(file, mode)
+
+# Define function to check if a column is an index column from pandas:
+def is_index_column(column):
+    '''
+    Function to check if a column name is an unnamed index column written by
+    pandas (e.g. by df.to_csv(file) in older versions of CSVDownloader.py).
+
+    PARAMETERS:
+    - column: column name
+
+    RETURNS: True if column is an index column
+    '''
+    return column == "" or column.startswith("Unnamed: ")
+
+# Define function to read the header line of a .csv file:
+def read_header(file):
+    '''
+    Function to read the column names from the first line of a .csv file.
+
+    PARAMETERS:
+    - file: path of .csv (or .csv.gz) file
+
+    RETURNS: list of column names
+    '''
+    with open_csv(file) as f:
+        return next(csv.reader(f), [])
+
+# Define function to reconcile the headers of several .csv files:
+def reconcile_header(files):
+    '''
+    Function to build one header containing every column found in a list of
+    .csv files, without pandas index columns. Columns are kept in the order
+    of the first file, with any columns only found in later files added on
+    the end, so files with the usual archive header can be copied as they
+    are.
+
+    PARAMETERS:
+    - files: list of .csv file paths
+
+    RETURNS: list of column names
+    '''
+    columns = []
+    for file in files:
+        columns += [c for c in read_header(file) if not is_index_column(c) and c not in columns]
+    return columns
+
+# Define function to copy the body of a file with a matching header:
+def copy_body(file, out):
+    '''
+    Function to copy every line after the header of a .csv file to an open
+    output file without parsing it.
+
+    PARAMETERS:
+    - file: path of .csv file
+    - out: output file opened in binary mode
+
+    RETURNS: None
+    '''
+    with open_csv(file, "rb") as f:
+        # Skip header line:
+        f.readline()
+        last = b""
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            out.write(block)
+            last = block[-1:]
+        # Make sure the next file starts on a new line:
+        if last not in (b"", b"\n"):
+            out.write(b"\n")
+
+# Define function to copy the rows of a file with a different header:
+def remap_body(file, columns, out):
+    '''
+    Function to copy the rows of a .csv file to an open output file, putting
+    each value in the right output column and leaving blank any output column
+    not in the file.
+
+    PARAMETERS:
+    - file: path of .csv file
+    - columns: list of output column names
+    - out: output file opened in binary mode
+
+    RETURNS: None
+    '''
+    with open_csv(file) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        # Position of each output column in this file (None if missing):
+        positions = [header.index(c) if c in header else None for c in columns]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        rows_written = 0
+        for row in reader:
+            writer.writerow([row[p] if p is not None and p < len(row) else "" for p in positions])
+            rows_written += 1
+            # Write buffered rows out so that memory use stays small:
+            if rows_written % ROWS_PER_WRITE == 0:
+                out.write(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+        out.write(buffer.getvalue().encode("utf-8"))
+
+# Define function to combine a list of .csv files into one:
+def combine_files(files, output_filename, columns=None):
+    '''
+    Function to combine .csv files into one output .csv file, appending one
+    file at a time.
+
+    PARAMETERS:
+    - files: list of .csv file paths (combined in the order given)
+    - output_filename: path of output .csv file
+    - columns: list of output column names (if None, the reconciled header of
+      the input files is used)
+
+    RETURNS: list of output column names
+    '''
+    if columns is None:
+        columns = reconcile_header(files)
+    with open(output_filename, "wb") as out:
+        header = io.StringIO()
+        csv.writer(header, lineterminator="\n").writerow(columns)
+        out.write(header.getvalue().encode("utf-8"))
+        for file in files:
+            # Copy file without parsing if it has exactly the output columns:
+            if read_header(file) == columns:
+                copy_body(file, out)
+            else:
+                remap_body(file, columns, out)
+    return columns
+
+# Define function to find the yearly files for an EA operational area:
+def find_area_files(input_dir, area_notation):
+    '''
+    Function to find the yearly .csv (or .csv.gz) files downloaded for an EA
+    operational area, in year order.
+
+    PARAMETERS:
+    - input_dir: directory containing yearly files (e.g. '2019_3-35.csv')
+    - area_notation: notation of EA operational area
+
+    RETURNS: sorted list of file paths
+    '''
+    files = []
+    for extension in (".csv", ".csv.gz"):
+        files += glob.glob(os.path.join(input_dir, "*_" + area_notation + extension))
+    return sorted(files)
+
+# Define function to combine the yearly files for every area:
+def combine_areas(input_dir, areas_list, areas_dir, all_england=False):
+    '''
+    Function to write one 'alldata_<area>.csv' file per EA operational area in
+    areas_dir, and optionally one 'alldata.csv' file for all of England in
+    input_dir (kept out of areas_dir so it is not picked up as an area file).
+
+    PARAMETERS:
+    - input_dir: directory containing yearly files
+    - areas_list: list of EA operational area notations
+    - areas_dir: directory to write combined files to
+    - all_england: True to also write all-England 'alldata.csv' to input_dir
+
+    RETURNS: list of combined area file paths
+    '''
+    area_files = {a: find_area_files(input_dir, a) for a in areas_list}
+
+    # If writing an all-England file, give every area file the same header so
+    # that they can simply be appended to each other:
+    columns = None
+    if all_england:
+        columns = reconcile_header([f for a in areas_list for f in area_files[a]])
+
+    outputs = []
+    for area_notation in areas_list:
+        files = area_files[area_notation]
+        print("Combining {0} .csv files for {1}.".format(len(files), area_notation))
+        if not files:
+            continue
+        output_filename = os.path.join(areas_dir, "alldata_" + area_notation + ".csv")
+        with span("combine.area", area=area_notation, files=len(files)):
+            combine_files(files, output_filename, columns)
+            count("bytes", os.path.getsize(output_filename))
+        print("Written {0}.".format(output_filename))
+        outputs.append(output_filename)
+
+    if all_england and outputs:
+        output_filename = os.path.join(input_dir, "alldata.csv")
+        print("Combining area files into {0}.".format(output_filename))
+        with span("combine.england", files=len(outputs)):
+            combine_files(outputs, output_filename, columns)
+            count("bytes", os.path.getsize(output_filename))
+
+    return outputs
@@ -1,300 +1,306 @@
-# -*- coding: utf-8 -*-
-"""
-GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
-Independent Project - EA WIMS Water Quality Data Analyser/Viewer
-
-Anne Harding (200754573)
-26/04/2019
-
-CSVDownloader.py
-
-Standalone Python script to download water quality data from EA WIMS archive 
-for years 2000 to current year for all EA operational regions, and concatenate
-into 1 combined .csv file per EA operation region containing all years' data.
-"""
-
-# Note that there are multiple ways of downloading data from the archive.
-# I have experimented with the different methods and decided that downloading
-# the "pre-defined" datasets and keeping a master copy is the best way to 
-# proceed. These datasets are split by year and operational area.
-# The web archive is currently in "Beta" and says that the datasets are
-# updated every month. At the time of writing this script, the data had last
-# been updated on 20th March 2019.
-
-# Search "CHANGEME" for filepaths that will need altering if used on
-# different computer.
-
-# Import modules:
-import os
-import datetime
-import requests
-import pandas as pd
-import io
-import glob
-# import csv
-# from bs4 import BeautifulSoup
-
-# -----------------------------------------------------------------------------
-# FUNCTIONS:
-
-# Define function to check HTTP status response code following request:
-def http_status_checker(status):
-    '''
-    Function to check if a webpage request was successful (code 200).
-    
-    PARAMETERS:
-    - status: HTTP response status code
-    
-    RETURNS: None
-    '''
-    # HTTP status response code 200 OK status code indicates that the request has
-    # succeeded (https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/200).
-    # See https://httpstatuses.com/ for more details on status response codes.
-    
-    # If status response code of request is not equal to 200:
-    if status != 200:
-        # Raise ConnectionError and print status code for user:
-        raise requests.ConnectionError(
-                "Status code {} returned. Status code 200 expected."
-                .format(status))
-    # If status response code is equal to 200:
-    # else:
-        # Inform user that request was successful:
-        # print("Status code {} returned. Request successful.".format(status))
-        
-# Define function to create directory at user-specified location:
-def create_directory(dirPath):
-    '''
-    Function to create a directory at a user-specified location if that
-    directory does not already exist.
-    
-    PARAMETERS:
-    - dirPath: user-specified location for directory to be created
-    
-    RETURNS: None
-    '''
-    # Try to create output directory:
-    try:
-        os.mkdir(dirPath)
-        print("Directory {} created.".format(dirPath))
-    # If output directory already exists, raise FileExistsError:
-    except FileExistsError:
-        print("Directory {} already exists.".format(dirPath))
-        pass
-            
-    '''
-    # ALTERNATIVE CODE:
-    # If output directory does not already exist:
-    if not os.path.exists(dirPath):
-        # Create directory:
-        os.mkdir(dirPath)
-        # Inform user that directory has been created:
-        print("Directory {} created.".format(dirPath))
-    # If output directory already exists:
-    else:
-        # Inform user that directory already exists:
-        print("Directory {} already exists.".format(dirPath))
-    '''
-    
-# -----------------------------------------------------------------------------
-# GET NOTATION FOR ENVIRONMENT AGENCY OPERATIONAL AREAS:
-        
-# .csv file location containing EA operational areas details:
-ea_areas = 'Z:\GEOG5790\project\data\ea-area.csv' # CHANGEME
-
-# Read .csv file containing EA operational areas details into pandas dataframe:
-areas_df = pd.read_csv(ea_areas, header=0)
-# Only keep 'label' and 'notation' columns:
-areas_df = areas_df[['label', 'notation']]
-# Print statement to manually check dataframe:
-# print(areas_df)
-
-# Convert 'notation' column to list:
-areas_list = areas_df['notation'].tolist()
-# Remove "Regional" from list:
-areas_list.remove('R')
-# Print statement to manually check list:
-# print(areas_list)
-
-print(type(areas_list))
-
-# -----------------------------------------------------------------------------
-# DOWNLOAD DATA FROM EA WIMS ARCHIVE:
-
-# URL for EA WIMS API:
-root = "http://environment.data.gov.uk/water-quality"
-
-# Get current year:
-now = datetime.datetime.now()
-current_year = now.year
-
-# Define location of output directory to save data to using today's date:
-output_dir = "Z:\GEOG5790\project\data\csv_downloaded_" + str(datetime.date.today()) # CHANGEME
-# Print statement to manually check output directory:
-# print(output_dir)
-# Call create_directory function to create a directory at output_dir:
-create_directory(output_dir)
-
-# Loop through each year from 2000 to current year:
-for year in range(2000, current_year+1):
-    
-    # Inform user of progress through years loop:
-    print("Downloading data for year {}:".format(year))
-    
-    for area_notation in areas_list:
-        # Find area label from area notation using dataframe as a "look-up":
-        area_labels = areas_df['label'].where(
-                areas_df['notation'] == area_notation).tolist()
-        area_label = [x for x in area_labels if str(x) != 'nan'][0]
-        
-        # Inform user of progress through areas loop:
-        print(" - {} ({})".format(area_label, area_notation))
-    
-        # Define filename:
-        filename = str(year) + "_" + str(area_notation) + ".csv"
-        # Join output directory path to filename:
-        file = os.path.join(output_dir, filename)
-        # Print statement to manually check file:
-        # print(file)
-    
-        # Check if file already exists (i.e. data has already been
-        # downloaded today) to avoid repeatedly downloading the same data:
-        if os.path.isfile(file):
-            # Inform user:
-            print("Data already downloaded. Skipping this dataset.")
-        # If file does not already exist, continue download:
-        else:
-            # Define URL to download data from for this year and this area:
-            url = root + "/batch/measurement?area=" + str(area_notation) + "&year=" + str(year)
-            # Print statement to manually check url:
-            # print(url)
-            
-            # Request data download from URL:
-            response = requests.get(url)
-            
-            # Return status code of request:
-            status = response.status_code
-            # Call http_status_checker function to confirm successful request:
-            http_status_checker(status)
-        
-            # Return content of request:
-            content = response.text
-            # Print statement to manually check content of request from url:
-            # print(content)
-            
-            # Read content of rquest into pandas dataframe using io:
-            df = pd.read_csv(io.StringIO(content))
-            # Write pandas dataframe to .csv file:
-            df.to_csv(file)
-        
-            '''
-            # ALTERNATIVE METHOD OF WRITING REQUEST TO CSV:
-            
-            # This code left artefacts in the final .csv files which meant
-            # that some of the data did not line up in the relevant columns,
-            # making it very difficult to process in further stages.
-            
-            # Parse content of request using BeautifulSoup:
-            soup = BeautifulSoup(content, 'html.parser')
-            
-            # Create empty array to hold data:
-            data = []
-            # Loop through rows in parsed data:
-            for row in soup:
-                # Append each row to data array:
-                data.append([row])
-                # Print statement to manually check each row:
-                # print(row)
-            # Print statement to manually check data:
-            # print(data)
-            
-            # Write data to .csv file:
-            with open(file, 'w', newline='') as f:
-                writer = csv.writer(f, delimiter=',')
-                for row in data:
-                    writer.writerow(row)
-            '''
-            
-            # Repeat for next area in loop.
-            
-    # Repeat for next year in loop.
-    
-print("Data for years 2000 to {} downloaded for all EA areas.".format(current_year))
-
-# -----------------------------------------------------------------------------
-# COMBINE DOWNLOADED .CSV FILES:
-
-# Change directory to working directory:
-os.chdir(output_dir)
-# Define file extension to search for:
-extension = ".csv"
-
-# Define subfolder to save combined .csv files for each EA area:
-areas_dir = os.path.join(output_dir, "areas")
-# Call create_directory function to create a directory at areas_dir:
-create_directory(areas_dir)
-
-# loop through EA operational areas:
-for area_notation in areas_list:
-    # Find area label from area notation using dataframe as a "look-up":
-    area_labels = areas_df['label'].where(
-        areas_df['notation'] == area_notation).tolist()
-    area_label = [x for x in area_labels if str(x) != 'nan'][0]
-    
-    # Inform user of progress through areas loop:
-    print("Combining files for {} ({}).".format(area_label, area_notation))
-
-    # Use pattern-matching to identify .csv files for EA area:
-    print("Finding all .csv files to combine.")
-    all_filenames = [i for i in glob.glob('*{}'.format(area_notation + extension))]
-    # Print statement to manually check number of identified files:
-    print("{} .csv files found: ".format(str(len(all_filenames))))
-    # Print statement to manually check names of identified files:
-    for filename in all_filenames:
-        print(filename)
-
-    # Concatenate all identified files into pandas dataframe::
-    print("Concatenating .csv files for {} ({}).".format(area_label, area_notation))
-    combined_csv = pd.concat([pd.read_csv(f) for f in all_filenames], sort=True)
-    
-    # Define output filename for combined .csv file:
-    output_filename = areas_dir + "\alldata_" + area_notation + ".csv"
-
-    # Write pandas dataframe for area to output .csv file::
-    print("Writing output .csv file to {}.".format(output_filename))
-    combined_csv.to_csv(output_filename, index=False, encoding='utf-8')
-
-print("Data concatenation complete.")
-
-'''
-# CODE TO COMBINE ALL DATASETS INTO ONE .CSV FOR ALL REGIONS AND ALL YEARS:
-# This code was very slow to run due to the large quantity of files and the 
-# significant volume of data within each file. Therefore, I had to compromise
-# and create master datasets for each individual EA operational area (for all
-# years), rather than a complete dataset for all of England.
-
-# Change directory to working directory:
-os.chdir(output_dir)
-# Define file extension to search for:
-extension = ".csv"
-# Define filename to save combined output file to:
-output_filename = os.path.join(output_dir, "alldata.csv")
-
-# Use pattern-matching to identify all files with '.csv' extension in directory:
-print("Finding all .csv files to combine.")
-all_filenames = [i for i in glob.glob('*{}'.format(extension))]
-# Print statement to manually check number of identified files:
-print("{} .csv files found: ".format(str(len(all_filenames))))
-# Print statement to manually check names of identified files:
-for filename in all_filenames:
-    print(filename)
-
-# Concatenate all identified files:
-print("Concatenating .csv files.")
-combined_csv = pd.concat([pd.read_csv(f) for f in all_filenames], sort=True)
-
-# Write pandas dataframe to output .csv file::
-print("Writing output .csv file to {}.".format(filename))
-combined_csv.to_csv(output_filename, index=False, encoding='utf-8')
-'''
-# -----------------------------------------------------------------------------
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+Anne Harding (200754573)
+26/04/2019
+
+CSVDownloader.py
+
+Standalone Python script to download water quality data from EA WIMS archive 
+for years 2000 to current year for all EA operational regions, and concatenate
+into 1 combined .csv file per EA operation region containing all years' data.
+"""
+
+# Note that there are multiple ways of downloading data from the archive.
+# I have experimented with the different methods and decided that downloading
+# the "pre-defined" datasets and keeping a master copy is the best way to 
+# proceed. These datasets are split by year and operational area.
+# The web archive is currently in "Beta" and says that the datasets are
+# updated every month. At the time of writing this script, the data had last
+# been updated on 20th March 2019.
+
+# Search "CHANGEME" for filepaths that will need altering if used on
+# different computer.
+
+# Import modules:
+import os
+import sys
+import datetime
+import pandas as pd
+from BatchDownloader import ROOT_URL, RetryPolicy, download_grid, check_failures
+from DownloadManifest import DownloadManifest
+from DownloadJournal import DownloadJournal
+from CSVCombiner import combine_areas
+from ParquetArchive import build_archive, archive_areas
+from SiteIndex import build_index
+from SiteRegistry import SiteRegistry
+from StatsCube import StatsCube
+from DeterminandCatalogue import build_catalogue
+from PipelineTrace import start_trace, stop_trace, span, count, summary_lines
+# import csv
+# from bs4 import BeautifulSoup
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to create directory at user-specified location:
+def create_directory(dirPath):
+    '''
+    Function to create a directory at a user-specified location if that
+    directory does not already exist.
+    
+    PARAMETERS:
+    - dirPath: user-specified location for directory to be created
+    
+    RETURNS: None
+    '''
+    # Try to create output directory:
+    try:
+        os.mkdir(dirPath)
+        print("Directory {} created.".format(dirPath))
+    # If output directory already exists, raise FileExistsError:
+    except FileExistsError:
+        print("Directory {} already exists.".format(dirPath))
+        pass
+            
+    '''
+    # ALTERNATIVE CODE:
+    # If output directory does not already exist:
+    if not os.path.exists(dirPath):
+        # Create directory:
+        os.mkdir(dirPath)
+        # Inform user that directory has been created:
+        print("Directory {} created.".format(dirPath))
+    # If output directory already exists:
+    else:
+        # Inform user that directory already exists:
+        print("Directory {} already exists.".format(dirPath))
+    '''
+
+# Define function to get the notations of the EA operational areas:
+def read_areas(ea_areas):
+    '''
+    Function to read the notations of the EA operational areas from the .csv
+    file of EA operational area details (leaving out "Regional").
+
+    PARAMETERS:
+    - ea_areas: path of .csv file containing EA operational areas details
+
+    RETURNS: list of area notations
+    '''
+    # Read .csv file containing EA operational areas details into pandas dataframe:
+    areas_df = pd.read_csv(ea_areas, header=0)
+    # Only keep 'label' and 'notation' columns:
+    areas_df = areas_df[['label', 'notation']]
+    # Print statement to manually check dataframe:
+    # print(areas_df)
+
+    # Convert 'notation' column to list:
+    areas_list = areas_df['notation'].tolist()
+    # Remove "Regional" from list:
+    if 'R' in areas_list:
+        areas_list.remove('R')
+    # Print statement to manually check list:
+    # print(areas_list)
+    return areas_list
+
+# Define function to download and combine the archive:
+def refresh_archive(data_dir, areas_list, first_year=2000, root=ROOT_URL,
+                    max_workers=8, max_per_host=4, compress=False,
+                    all_england=False, write_parquet=False, attempts=5):
+    '''
+    Function to download the archive datasets for every year and EA area into
+    a new 'csv_downloaded_<date>' directory in data_dir, export the sampling
+    point layer and combine, index and catalogue one file per area. The
+    download manifest, sampling point registry and statistics cube are kept
+    in data_dir so that each refresh only downloads datasets which have
+    changed. If a refresh is stopped, or some datasets fail to download,
+    running it again the same day carries on from the checkpoint journal in
+    the download directory (see DownloadJournal.py).
+
+    PARAMETERS:
+    - data_dir: data directory (holding manifest, registry and cube)
+    - areas_list: list of EA operational area notations
+    - first_year: first year to download
+    - root: root URL of the water quality archive API
+    - max_workers: number of worker threads to download datasets with
+    - max_per_host: maximum number of simultaneous requests to the server
+    - compress: True to gzip the yearly files as they are downloaded (pandas
+      reads .csv.gz files directly, so the combine step works on either)
+    - all_england: True to also combine all areas into one 'alldata.csv'
+    - write_parquet: True to also build a Parquet archive (requires pyarrow)
+    - attempts: number of times to try each dataset before giving up
+
+    RETURNS: path of download directory
+    '''
+    # -------------------------------------------------------------------------
+    # DOWNLOAD DATA FROM EA WIMS ARCHIVE:
+
+    # Get current year:
+    now = datetime.datetime.now()
+    current_year = now.year
+
+    # Define location of output directory to save data to using today's date:
+    output_dir = os.path.join(data_dir, "csv_downloaded_" + str(datetime.date.today()))
+    # Print statement to manually check output directory:
+    # print(output_dir)
+    # Call create_directory function to create a directory at output_dir:
+    create_directory(output_dir)
+
+    # Record time, bytes, rows and memory use of each stage and of each
+    # dataset's request and write in 'refresh_trace.jsonl' (see
+    # PipelineTrace.py):
+    trace = start_trace(os.path.join(output_dir, "refresh_trace.jsonl"))
+
+    # Stop the trace however the refresh ends (so its memory sampler and file
+    # are not left running if a step fails):
+    try:
+        # Load manifest of datasets downloaded by previous runs. This is kept
+        # outside the dated download directories so that each refresh only
+        # downloads datasets which have changed since last time (unchanged
+        # datasets are hard-linked from the previous download directory):
+        manifest = DownloadManifest(os.path.join(data_dir, "download_manifest.json"))
+
+        # Load registry of sampling points, which is kept next to the manifest and
+        # updated as each dataset is downloaded (see SiteRegistry.py):
+        registry = SiteRegistry(os.path.join(data_dir, "site_registry.csv"))
+
+        # Load cube of summary statistics for each sampling point, determinand and
+        # year, which is also updated as each dataset is downloaded (see
+        # StatsCube.py):
+        cube = StatsCube(os.path.join(data_dir, "stats_cube.csv"))
+
+        # Load checkpoint journal of this download directory, which records each
+        # dataset as it is finished so that a stopped refresh carries on where it
+        # left off:
+        journal = DownloadJournal(os.path.join(output_dir, "download_journal.jsonl"))
+
+        # Download each year from first_year to current year for each area.
+        # Datasets are downloaded concurrently by BatchDownloader, skipping any
+        # which have already been downloaded today. Failed downloads are tried
+        # again (waiting longer each time) up to 'attempts' times:
+        with span("download", datasets=len(areas_list) * (current_year + 1 - first_year)):
+            results = download_grid(range(first_year, current_year+1), areas_list, output_dir,
+                                    root=root, max_workers=max_workers, max_per_host=max_per_host,
+                                    stream=True, compress=compress, manifest=manifest,
+                                    registry=registry, cube=cube,
+                                    retry=RetryPolicy(attempts=attempts), journal=journal)
+        with span("save"):
+            registry.save()
+            cube.save()
+            journal.mark_saved()
+
+        # Stop before combining if any datasets are missing (the datasets which
+        # were downloaded are kept, so running again only fetches the rest):
+        check_failures(results)
+
+        print("Data for years {0} to {1} downloaded for all EA areas.".format(
+                first_year, current_year))
+
+        # ----------------------------------------------------------------------
+        # EXPORT SAMPLING POINT LOCATIONS:
+
+        # Write 'england_wq_locs.shp' (and a .csv copy with first/last sample
+        # dates and row counts) straight from the registry, so CSVtoSHP.py does
+        # not need to re-read the archive:
+        shp_dir = os.path.join(output_dir, "shp")
+        create_directory(shp_dir)
+        with span("export"):
+            site_count = registry.export(os.path.join(shp_dir, "england_wq_locs.shp"),
+                                         os.path.join(shp_dir, "england_wq_locs.csv"))
+        print("{0} sampling points written to england_wq_locs.shp.".format(site_count))
+
+        # ----------------------------------------------------------------------
+        # COMBINE DOWNLOADED .CSV FILES:
+
+        # Define subfolder to save combined .csv files for each EA area:
+        areas_dir = os.path.join(output_dir, "areas")
+        # Call create_directory function to create a directory at areas_dir:
+        create_directory(areas_dir)
+
+        # Combine yearly files into one .csv file per EA area. The yearly files
+        # are appended to the output one at a time by CSVCombiner, so memory use
+        # stays small however many years of data there are:
+        with span("combine"):
+            area_files = combine_areas(output_dir, areas_list, areas_dir, all_england=all_england)
+
+        # Build sampling point index for each combined file so that
+        # WQDataExtractor can read just the parts of the file for the sampling
+        # points selected:
+        for area_file in area_files:
+            print("Indexing {0}.".format(area_file))
+            with span("index", file=os.path.basename(area_file)):
+                build_index(area_file)
+                count("bytes", os.path.getsize(area_file))
+
+        # Build catalogue of determinands for each EA area (code, definition,
+        # unit, row and sampling point counts), used by WQDataExtractor to check
+        # the determinands selected by the user:
+        for area_notation in areas_list:
+            if os.path.isfile(os.path.join(areas_dir, "alldata_" + area_notation + ".csv")):
+                with span("catalogue", area=area_notation):
+                    build_catalogue(areas_dir, area_notation)
+
+        print("Data concatenation complete.")
+
+        # ----------------------------------------------------------------------
+        # BUILD PARQUET ARCHIVE (OPTIONAL):
+
+        # Also convert the yearly files into a typed, compressed Parquet archive
+        # partitioned by area and year. Later stages can read just the columns
+        # they need from this archive:
+        if write_parquet:
+            archive_dir = os.path.join(output_dir, "archive")
+            with span("parquet"):
+                build_archive(output_dir, areas_list, archive_dir)
+            for area_notation in archive_areas(archive_dir):
+                with span("catalogue", area=area_notation):
+                    build_catalogue(archive_dir, area_notation)
+
+        # Note: combining all datasets into one .csv for all of England was
+        # originally abandoned because reading every file into one pandas
+        # dataframe was very slow and needed more memory than was available.
+        # CSVCombiner appends the files instead, so this is now an option
+        # (all_england above).
+    finally:
+        stop_trace()
+
+    # -------------------------------------------------------------------------
+    # TIMINGS:
+
+    # Show where the time went in this refresh:
+    print("Timings (also saved to {0}):".format(trace.path))
+    for line in summary_lines(trace.path):
+        print(line)
+
+    return output_dir
+
+# -----------------------------------------------------------------------------
+# RUN SCRIPT:
+
+# The refresh only runs when this script is run directly (it can also be run
+# from WQPipeline.py, or imported and refresh_archive called):
+if __name__ == "__main__":
+
+    # Data directory holding the download manifest, sampling point registry,
+    # statistics cube and dated download directories (can also be given as
+    # the first command line argument):
+    data_dir = "Z:\GEOG5790\project\data" # CHANGEME
+    if len(sys.argv) > 1:
+        data_dir = sys.argv[1]
+
+    # .csv file location containing EA operational areas details (can also be
+    # given as the second command line argument):
+    ea_areas = os.path.join(data_dir, "ea-area.csv")
+    if len(sys.argv) > 2:
+        ea_areas = sys.argv[2]
+
+    # Set all_england to True to also combine all areas into one
+    # 'alldata.csv' file for the whole of England (saved in the download
+    # directory). Set write_parquet to True to also build a Parquet archive
+    # (requires pyarrow). Set compress to True to gzip the yearly files:
+    refresh_archive(data_dir, read_areas(ea_areas), first_year=2000,
+                    max_workers=8, max_per_host=4, compress=False,
+                    all_england=False, write_parquet=False)
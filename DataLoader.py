@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+DataLoader.py
+
+Loader used by DataViewer.ipynb for the 'selected_data' file written by
+WQDataExtractor.py. Rather than reading the whole file into memory to fill the
+determinand dropdown and then filtering it again every time a determinand is
+chosen, the loader:
+
+- gets the list of determinands from the statistics cube saved with the data
+  (see StatsCube.py), from the series store (see SeriesStore.py) or, if there
+  is neither, by reading only the determinand column of the file;
+- reads the rows for a determinand only when it is first chosen (for a
+  .parquet file only those rows are read from disk);
+- keeps the determinands read most recently in a cache, up to a set amount of
+  memory, so switching back to a determinand does not read the file again.
+
+The plots in DataViewer.ipynb are drawn from a series store. If WQDataExtractor
+wrote one with the data file it is opened memory-mapped; if not, a store for
+just the chosen determinand is made in memory from the cached rows, so the
+whole file is never read at once.
+
+Example:
+    loader = DataLoader("selected_data.csv")
+    dets = loader.determinands()
+    df = loader.get(dets[0])
+    store = loader.series(dets[0])
+"""
+
+# Import modules:
+import os
+from collections import OrderedDict
+import pandas as pd
+from WQSchema import read_dtypes, apply_schema, concat_frames
+from SeriesStore import SeriesStore, store_is_current, store_dir_for
+
+# Maximum memory (in bytes) to use for cached determinand data:
+CACHE_BYTES = 512 * 1024 * 1024
+
+# Number of rows to read from a .csv file at a time:
+CHUNK_SIZE = 200000
+
+# Column holding the determinand names shown in the dropdown:
+DETERMINAND_COLUMN = "determinand.definition"
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to check if a .csv file was written with its index:
+def has_index_column(datafile):
+    '''
+    Function to check if the first column of a .csv file is an unnamed index
+    column (as written by pandas to_csv).
+
+    PARAMETERS:
+    - datafile: path of .csv file
+
+    RETURNS: True if first column is unnamed
+    '''
+    with open(datafile, "r", encoding="utf-8-sig") as f:
+        return f.readline().startswith(",")
+
+# Define class to load and cache data for each determinand:
+class DataLoader:
+    '''
+    Class to read the data for one determinand at a time from a .csv or
+    .parquet data file, keeping recently used determinands in memory.
+
+    PARAMETERS:
+    - datafile: path of .csv or .parquet data file
+    - max_bytes: maximum memory to use for cached data
+    '''
+    def __init__(self, datafile, max_bytes=CACHE_BYTES):
+        self.datafile = datafile
+        self.max_bytes = max_bytes
+        self.parquet = os.path.splitext(datafile)[1] == ".parquet"
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Series store written with the data file (None if there is none or
+        # it is out of date):
+        self.store = SeriesStore(store_dir_for(datafile)) if store_is_current(datafile) else None
+
+    def determinands(self):
+        '''
+        Function to list the determinands in the data file (most frequent
+        first), without reading the rest of the data.
+
+        RETURNS: list of determinand definitions
+        '''
+        stats_file = os.path.join(os.path.dirname(self.datafile), "selected_stats.csv")
+        if os.path.isfile(stats_file) and os.path.getmtime(stats_file) >= os.path.getmtime(self.datafile):
+            stats = pd.read_csv(stats_file, usecols=["definition", "count"], keep_default_na=False)
+            counts = stats.groupby("definition")["count"].sum()
+        elif self.store is not None:
+            return self.store.determinands()
+        else:
+            if self.parquet:
+                column = pd.read_parquet(self.datafile, columns=[DETERMINAND_COLUMN])
+            else:
+                column = pd.read_csv(self.datafile, usecols=[DETERMINAND_COLUMN],
+                                     dtype={DETERMINAND_COLUMN: "category"})
+            counts = column[DETERMINAND_COLUMN].value_counts()
+        return counts[counts > 0].sort_values(ascending=False, kind="stable").index.tolist()
+
+    def get(self, determinand):
+        '''
+        Function to get the data for one determinand, from the cache if it
+        has been read before.
+
+        PARAMETERS:
+        - determinand: determinand definition
+
+        RETURNS: pandas dataframe
+        '''
+        if determinand in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(determinand)
+            return self.cache[determinand]
+        self.misses += 1
+        df = self._read(determinand)
+        self.cache[determinand] = df
+        # Drop least recently used determinands until within memory limit
+        # (always keeping the one just read):
+        while len(self.cache) > 1 and self.cache_bytes() > self.max_bytes:
+            self.cache.popitem(last=False)
+        return df
+
+    def series(self, determinand):
+        '''
+        Function to get a series store holding the chosen determinand: the
+        store written with the data file if there is one, otherwise a store
+        held in memory made from the determinand's (cached) rows.
+
+        PARAMETERS:
+        - determinand: determinand definition
+
+        RETURNS: SeriesStore
+        '''
+        if self.store is not None:
+            return self.store
+        return SeriesStore.from_frame(self.get(determinand))
+
+    def cache_bytes(self):
+        '''
+        Function to get the memory used by the cached data.
+
+        RETURNS: number of bytes
+        '''
+        return sum(int(df.memory_usage(deep=True).sum()) for df in self.cache.values())
+
+    def _read(self, determinand):
+        '''
+        Function to read the rows for one determinand from the data file.
+
+        PARAMETERS:
+        - determinand: determinand definition
+
+        RETURNS: pandas dataframe
+        '''
+        if self.parquet:
+            df = pd.read_parquet(self.datafile, filters=[(DETERMINAND_COLUMN, "==", determinand)])
+            return apply_schema(df)
+        index_col = 0 if has_index_column(self.datafile) else None
+        matches = []
+        for chunk in pd.read_csv(self.datafile, chunksize=CHUNK_SIZE, index_col=index_col,
+                                 dtype=read_dtypes()):
+            chunk = chunk[chunk[DETERMINAND_COLUMN] == determinand]
+            if len(chunk):
+                matches.append(chunk)
+        if not matches:
+            return apply_schema(pd.read_csv(self.datafile, nrows=0, index_col=index_col,
+                                            dtype=read_dtypes()))
+        return apply_schema(concat_frames(matches))
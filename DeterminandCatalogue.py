@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+DeterminandCatalogue.py
+
+Catalogue of the determinands held in the Stage 1 archive for each EA
+operational area, built by CSVDownloader.py. For each determinand the
+catalogue records its code ('determinand.notation'), definition, unit, number
+of rows, number of sampling points and first/last sample dates. It is saved
+as a .csv table alongside the data:
+
+    alldata_3-35.csv        - archive file
+    alldata_3-35.csv.det    - determinand catalogue (.csv) for archive file
+    area=3-35/_determinands.csv - catalogue for an area of a Parquet archive
+
+WQDataExtractor.py uses the catalogue to check the determinands asked for by
+the user (by code or definition) before they are passed to the archive scan.
+"""
+
+# Import modules:
+import os
+import pandas as pd
+from ParquetArchive import is_parquet_archive, read_archive
+from ArchiveQuery import area_file
+from WQSchema import read_dtypes, DATE_FORMAT
+
+# Columns read from the archive to build the catalogue:
+SOURCE_COLUMNS = ["determinand.notation",
+                  "determinand.definition",
+                  "determinand.unit.label",
+                  "sample.samplingPoint.notation",
+                  "sample.sampleDateTime"]
+
+# Columns of the catalogue:
+CATALOGUE_COLUMNS = ["determinand.notation", "determinand.definition",
+                     "determinand.unit.label", "rows", "sites",
+                     "first_sample", "last_sample"]
+
+# Extension of catalogue files for .csv archive files:
+CATALOGUE_EXTENSION = ".det"
+
+# Number of rows to read from a .csv archive file at a time:
+CHUNK_SIZE = 500000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the catalogue filename for an area:
+def catalogue_filename(wqArchive, area_notation):
+    '''
+    Function to get the filename of the determinand catalogue for an EA
+    operational area of an archive.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+    - area_notation: notation of EA operational area
+
+    RETURNS: path of catalogue file
+    '''
+    if is_parquet_archive(wqArchive):
+        # Files starting with "_" are ignored when the dataset is opened:
+        return os.path.join(wqArchive, "area=" + area_notation, "_determinands.csv")
+    return area_file(wqArchive, area_notation) + CATALOGUE_EXTENSION
+
+# Define function to summarise the determinands in chunks of data:
+def summarise_determinands(chunks):
+    '''
+    Function to build a determinand catalogue from chunks of archive data.
+
+    PARAMETERS:
+    - chunks: iterable of dataframes with the SOURCE_COLUMNS
+
+    RETURNS: catalogue as pandas dataframe (one row per determinand code)
+    '''
+    summaries = []
+    pairs = []
+    for chunk in chunks:
+        summary = chunk.groupby("determinand.notation", observed=True).agg(
+                **{"determinand.definition": ("determinand.definition", "last"),
+                   "determinand.unit.label": ("determinand.unit.label", "last"),
+                   "rows": ("sample.sampleDateTime", "size"),
+                   "first_sample": ("sample.sampleDateTime", "min"),
+                   "last_sample": ("sample.sampleDateTime", "max")}).reset_index()
+        # Dates read from a Parquet archive are datetimes; put them in the
+        # same text format as the .csv files (which sorts in date order):
+        for col in ("first_sample", "last_sample"):
+            if pd.api.types.is_datetime64_any_dtype(summary[col]):
+                summary[col] = summary[col].dt.strftime(DATE_FORMAT)
+        summaries.append(summary)
+        # Distinct sampling points for each determinand:
+        pairs.append(chunk[["determinand.notation", "sample.samplingPoint.notation"]]
+                     .astype(str).drop_duplicates())
+    if not summaries:
+        return pd.DataFrame(columns=CATALOGUE_COLUMNS)
+    summary = pd.concat(summaries, ignore_index=True).astype({"determinand.notation": str})
+    catalogue = summary.groupby("determinand.notation").agg(
+            **{"determinand.definition": ("determinand.definition", "last"),
+               "determinand.unit.label": ("determinand.unit.label", "last"),
+               "rows": ("rows", "sum"),
+               "first_sample": ("first_sample", "min"),
+               "last_sample": ("last_sample", "max")})
+    sites = pd.concat(pairs).drop_duplicates().groupby("determinand.notation").size()
+    catalogue["sites"] = sites.reindex(catalogue.index).fillna(0).astype(int)
+    catalogue = catalogue.reset_index().sort_values("rows", ascending=False)
+    return catalogue[CATALOGUE_COLUMNS].reset_index(drop=True)
+
+# Define function to build the catalogue for an area:
+def build_catalogue(wqArchive, area_notation, chunksize=CHUNK_SIZE):
+    '''
+    Function to build the determinand catalogue for an EA operational area of
+    an archive (reading only the columns needed) and save it alongside the
+    data.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+    - area_notation: notation of EA operational area
+    - chunksize: number of rows to read from a .csv file at a time
+
+    RETURNS: catalogue as pandas dataframe
+    '''
+    if is_parquet_archive(wqArchive):
+        chunks = [read_archive(wqArchive, area_notation, SOURCE_COLUMNS)]
+    else:
+        chunks = pd.read_csv(area_file(wqArchive, area_notation), usecols=SOURCE_COLUMNS,
+                             dtype=read_dtypes(SOURCE_COLUMNS), chunksize=chunksize)
+    catalogue = summarise_determinands(chunks)
+    catalogue.to_csv(catalogue_filename(wqArchive, area_notation), index=False, encoding="utf-8")
+    return catalogue
+
+# Define function to load the catalogue for one or more areas:
+def load_catalogue(wqArchive, areas):
+    '''
+    Function to load the determinand catalogues for EA operational areas of
+    an archive and combine them. Areas without an up-to-date catalogue are
+    left out. When combining areas, row and sampling point counts are added
+    together.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+    - areas: list of EA operational area notations
+
+    RETURNS: catalogue as pandas dataframe (None if no catalogues found)
+    '''
+    parquet = is_parquet_archive(wqArchive)
+    catalogues = []
+    for area_notation in areas:
+        filename = catalogue_filename(wqArchive, area_notation)
+        if not os.path.isfile(filename):
+            continue
+        # Catalogue is out of date if the data has changed since:
+        if not parquet and os.path.getmtime(filename) < os.path.getmtime(area_file(wqArchive, area_notation)):
+            continue
+        catalogues.append(pd.read_csv(filename, dtype={"determinand.notation": str}))
+    if not catalogues:
+        return None
+    catalogue = pd.concat(catalogues, ignore_index=True).groupby("determinand.notation").agg(
+            {"determinand.definition": "last", "determinand.unit.label": "last",
+             "rows": "sum", "sites": "sum", "first_sample": "min", "last_sample": "max"})
+    catalogue = catalogue.reset_index().sort_values("rows", ascending=False)
+    return catalogue[CATALOGUE_COLUMNS].reset_index(drop=True)
+
+# Define function to match the determinands asked for to the catalogue:
+def match_determinands(catalogue, determinands):
+    '''
+    Function to look up determinands given by code (e.g. '0076') or
+    definition (e.g. 'Temperature of Water', in any case) in a catalogue.
+
+    PARAMETERS:
+    - catalogue: catalogue dataframe (from load_catalogue)
+    - determinands: list of determinand codes or definitions
+
+    RETURNS: (list of matching determinand codes, list of determinands not
+    found in catalogue)
+    '''
+    codes = catalogue["determinand.notation"].astype(str)
+    definitions = catalogue["determinand.definition"].astype(str).str.lower()
+    matched = []
+    missing = []
+    for determinand in determinands:
+        found = codes[(codes == determinand) | (definitions == determinand.lower())]
+        if len(found):
+            matched.extend(c for c in found if c not in matched)
+        else:
+            missing.append(determinand)
+    return matched, missing
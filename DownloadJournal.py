@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+DownloadJournal.py
+
+Checkpoint journal of a download run, kept in the dated download directory
+('download_journal.jsonl'). BatchDownloader.py adds one line to the journal
+each time the state of a year/area dataset changes:
+
+    started - request sent
+    retry   - request failed but will be tried again (with the error and the
+              time waited before the next attempt)
+    done    - dataset saved to the download directory
+    failed  - dataset could not be downloaded (after all of its attempts)
+
+and CSVDownloader.py adds a 'saved' line once the sampling point registry and
+statistics cube have been saved. Each line is written to disk straight away,
+so if a refresh is stopped part way through (or the computer is switched
+off) the journal still shows which datasets were finished. Running the
+refresh again the same day only downloads the datasets which are not 'done',
+and adds the datasets finished since the last 'saved' line to the registry
+and cube again (their summaries were lost with the stopped run).
+
+A yearly file is only ever put in place (renamed from a temporary file) once
+it has been completely written, so a dataset marked 'done' always has a
+complete file.
+"""
+
+# Import modules:
+import os
+import json
+import time
+import threading
+from DownloadManifest import manifest_key
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define class to hold the download journal:
+class DownloadJournal:
+    '''
+    Class to read and add to the checkpoint journal of a download run. Lines
+    are added under a lock, so the journal can be shared by the download
+    worker threads.
+
+    PARAMETERS:
+    - path: location of journal .jsonl file (created if it does not exist)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Latest line for each dataset, and datasets done since last 'saved':
+        self.tasks = {}
+        self.unsaved = set()
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut short if the run was stopped:
+                        continue
+                    self._apply(record)
+
+    def _apply(self, record):
+        # Keep track of the state of each dataset from a journal line:
+        if record.get("state") == "saved":
+            self.unsaved = set()
+            return
+        key = record.get("task")
+        self.tasks[key] = record
+        if record.get("state") == "done":
+            self.unsaved.add(key)
+
+    def record(self, area_notation, year, state, **details):
+        '''
+        Function to add a line for a dataset to the journal.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+        - state: 'started', 'retry', 'done' or 'failed'
+        - details: other details to record (e.g. attempt, error, status)
+
+        RETURNS: None
+        '''
+        record = dict(details, task=manifest_key(area_notation, year), state=state)
+        self._write(record)
+
+    def mark_saved(self):
+        '''
+        Function to record that every dataset done so far has been added to
+        the saved sampling point registry and statistics cube.
+
+        RETURNS: None
+        '''
+        self._write({"state": "saved"})
+
+    def state(self, area_notation, year):
+        '''
+        Function to get the latest state of a dataset.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: state as string, or None if dataset not in journal
+        '''
+        with self._lock:
+            record = self.tasks.get(manifest_key(area_notation, year))
+        return None if record is None else record.get("state")
+
+    def is_done(self, area_notation, year):
+        '''
+        Function to check if a dataset was finished by this or an earlier run.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: True if dataset is 'done'
+        '''
+        return self.state(area_notation, year) == "done"
+
+    def is_unsaved(self, area_notation, year):
+        '''
+        Function to check if a dataset was finished since the registry and
+        cube were last saved.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: True if dataset is 'done' but not yet saved
+        '''
+        with self._lock:
+            return manifest_key(area_notation, year) in self.unsaved
+
+    def _write(self, record):
+        # Append line and write it to disk before carrying on:
+        record["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._apply(record)
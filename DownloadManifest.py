@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+DownloadManifest.py
+
+Persistent record of every year/area dataset downloaded by CSVDownloader.py.
+For each (area, year) the manifest keeps the ETag and Last-Modified headers
+sent by the archive, the size, row count and SHA-256 hash of the data and the
+path of the most recent copy on disk.
+
+The manifest is kept outside the dated download directories so that the next
+refresh can send conditional requests for datasets it already holds. Datasets
+which the archive reports as unchanged (HTTP 304) are hard-linked into the new
+download directory instead of being downloaded again, so a monthly refresh
+only moves the data which has actually changed.
+"""
+
+# Import modules:
+import os
+import json
+import shutil
+import threading
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to build the manifest key for an area and year:
+def manifest_key(area_notation, year):
+    '''
+    Function to build the key used to store a dataset in the manifest.
+
+    PARAMETERS:
+    - area_notation: notation of EA operational area
+    - year: year of data
+
+    RETURNS: key as string (e.g. '3-35/2019')
+    '''
+    return str(area_notation) + "/" + str(year)
+
+# Define function to hard-link (or copy) an unchanged dataset:
+def link_or_copy(src, dst):
+    '''
+    Function to hard-link an existing file to a new location, falling back to
+    copying it if hard links are not possible (e.g. across drives). The link
+    or copy is made under a temporary name and then renamed, so dst is never
+    left half-copied (and any existing dst is replaced).
+
+    PARAMETERS:
+    - src: existing file
+    - dst: new location for file
+
+    RETURNS: None
+    '''
+    directory, name = os.path.split(dst)
+    tmp = os.path.join(directory, "." + name + ".part")
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    # Renaming does nothing if dst was already a link to src:
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+
+# Define class to hold the download manifest:
+class DownloadManifest:
+    '''
+    Class to load, query, update and save the download manifest. Updates are
+    thread-safe and the manifest is saved to disk after each one, so it is
+    always up to date even if a download run is stopped part way through.
+
+    PARAMETERS:
+    - path: location of manifest .json file (created if it does not exist)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Read existing manifest if there is one:
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def get(self, area_notation, year):
+        '''
+        Function to get the manifest entry for a dataset.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: dictionary for entry, or None if dataset not in manifest
+        '''
+        with self._lock:
+            return self.entries.get(manifest_key(area_notation, year))
+
+    def update(self, area_notation, year, entry):
+        '''
+        Function to record a dataset in the manifest and save the manifest.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+        - entry: dictionary of details for dataset
+
+        RETURNS: None
+        '''
+        with self._lock:
+            self.entries[manifest_key(area_notation, year)] = entry
+            self._save()
+
+    def conditional_headers(self, area_notation, year):
+        '''
+        Function to build the headers for a conditional request for a
+        dataset. Headers are only sent if the previous copy still exists on
+        disk to be linked to.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: dictionary of request headers (may be empty)
+        '''
+        entry = self.get(area_notation, year)
+        headers = {}
+        if entry is None or not os.path.isfile(entry.get("file", "")):
+            return headers
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def save(self):
+        '''
+        Function to save the manifest to disk.
+
+        RETURNS: None
+        '''
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        # Write to a temporary file then rename, so that the manifest is never
+        # left half-written:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+LocalWQAServer.py
+
+Local stand-in for the EA WIMS archive batch API. Serves small, made-up
+datasets at /batch/measurement?area=...&year=... with the same columns as the
+real archive so that BatchDownloader.py can be tried out (and timed) without
+touching the live server. The number of rows, sampling points and
+determinands in each dataset can be set, so that archives of any size can be
+made up for benchmarking (see WQBenchmark.py).
+
+The server can also be made unreliable, to try out the retries and
+checkpointing of BatchDownloader.py. A share of requests (or the first few
+requests for each dataset) then fail in one of these ways:
+
+    503      - 503 Service Unavailable
+    429      - 429 Too Many Requests, with a Retry-After header
+    truncate - the response is cut off part way through the body
+    drop     - the connection is closed without any response
+
+Example:
+    with LocalWQAServer() as server:
+        download_grid(range(2000, 2003), ['3-35'], out_dir, root=server.root)
+
+    with LocalWQAServer(flaky=0.3) as server:
+        download_grid(range(2000, 2003), ['3-35'], out_dir, root=server.root,
+                      retry=RetryPolicy(base_delay=0.1))
+"""
+
+# Import modules:
+import csv
+import hashlib
+import io
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+# Columns of the batch measurement datasets:
+COLUMNS = ["@id",
+           "sample.samplingPoint",
+           "sample.samplingPoint.notation",
+           "sample.samplingPoint.label",
+           "sample.sampleDateTime",
+           "determinand.label",
+           "determinand.definition",
+           "determinand.notation",
+           "resultQualifier.notation",
+           "result",
+           "codedResultInterpretation.interpretation",
+           "determinand.unit.label",
+           "sample.sampledMaterialType.label",
+           "sample.isComplianceSample",
+           "sample.purpose.label",
+           "sample.samplingPoint.easting",
+           "sample.samplingPoint.northing"]
+
+# Determinands used in the made-up datasets (label, definition, notation,
+# unit); further determinands are numbered on from these:
+DETERMINANDS = [("Temp Water", "Temperature of Water", "0076", "cel"),
+                ("pH", "pH", "0061", "phunits"),
+                ("BOD ATU", "BOD : 5 Day ATU", "0085", "mg/l"),
+                ("Ammonia(N)", "Ammoniacal Nitrogen as N", "0111", "mg/l"),
+                ("Orthophospht", "Orthophosphate, reactive as P", "0180", "mg/l"),
+                ("Oxygen, Dissolved, % Saturation", "Oxygen, Dissolved, % Saturation", "9901", "%"),
+                ("Nitrate-N", "Nitrate as N", "0117", "mg/l"),
+                ("Cond @ 25C", "Conductivity at 25 C", "0077", "us/cm")]
+
+# Ways in which requests fail when the server is flaky:
+FAILURES = ["503", "429", "truncate", "drop"]
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the details of a made-up determinand:
+def determinand(number):
+    '''
+    Function to get the label, definition, notation and unit of the nth
+    determinand used in the made-up datasets.
+
+    PARAMETERS:
+    - number: index of determinand (from 0)
+
+    RETURNS: (label, definition, notation, unit) tuple
+    '''
+    if number < len(DETERMINANDS):
+        return DETERMINANDS[number]
+    code = "{0:04d}".format(8000 + number)
+    return ("Det " + code, "Made-up determinand " + code, code, "mg/l")
+
+# Define function to get the coordinates of a made-up sampling point:
+def site_coordinates(number):
+    '''
+    Function to get the easting and northing of the nth made-up sampling point
+    of an area. Points are laid out in rows of 20 (100 m apart), 2 km apart.
+
+    PARAMETERS:
+    - number: index of sampling point (from 0)
+
+    RETURNS: (easting, northing) tuple
+    '''
+    return (400000 + (number % 20) * 100 + ((number // 20) % 100) * 2000,
+            500000 + (number % 20) * 100 + (number // 2000) * 2000)
+
+# Define function to make up a batch dataset for one area and year:
+def make_batch_csv(area_notation, year, rows=200, sites=20, determinands=1):
+    '''
+    Function to generate a repeatable, made-up batch dataset for one EA
+    operational area and one year.
+
+    PARAMETERS:
+    - area_notation: notation of EA operational area
+    - year: year of data
+    - rows: number of measurement rows to generate
+    - sites: number of sampling points to spread the rows over
+    - determinands: number of determinands to spread the rows over
+
+    RETURNS: .csv content as bytes
+    '''
+    # Seed on area and year so the same request always gets the same data:
+    rng = random.Random("{0}/{1}".format(area_notation, year))
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for i in range(rows):
+        site = "{0}-{1:04d}".format(area_notation.replace("-", ""), i % sites)
+        easting, northing = site_coordinates(i % sites)
+        # Each sampling point cycles through every determinand:
+        label, definition, notation, unit = determinand((i // sites) % determinands)
+        qualifier = "<" if rng.random() < 0.1 else ""
+        writer.writerow([
+                "http://environment.data.gov.uk/water-quality/data/measurement/{0}-{1}-{2}".format(area_notation, year, i),
+                "http://environment.data.gov.uk/water-quality/id/sampling-point/" + site,
+                site,
+                "SITE " + site,
+                "{0}-{1:02d}-{2:02d}T{3:02d}:00:00".format(year, rng.randint(1, 12), rng.randint(1, 28), rng.randint(8, 17)),
+                label,
+                definition,
+                notation,
+                qualifier,
+                round(rng.uniform(0, 20), 2),
+                "",
+                unit,
+                "RIVER / RUNNING SURFACE WATER",
+                "false",
+                "ENVIRONMENTAL MONITORING STATUTORY (EA)",
+                easting,
+                northing])
+    return out.getvalue().encode("utf-8")
+
+# Define request handler for the stand-in server:
+class BatchRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler answering GET .../batch/measurement?area=...&year=... with a
+    made-up batch dataset, or 304 if the If-None-Match header matches the
+    dataset's ETag. Any other path returns 404. If the server is flaky, some
+    requests fail instead (see LocalWQAServer.failure).
+    '''
+    # Keep connections alive between requests (as the real server does):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if not url.path.rstrip("/").endswith("/batch/measurement") or "area" not in query or "year" not in query:
+            self.send_error(404)
+            return
+        body = make_batch_csv(query["area"][0], query["year"][0], self.server.rows,
+                              self.server.sites, self.server.determinands)
+        failure = self.server.owner.failure(self.path)
+        if failure == "drop":
+            # Close connection without sending a response:
+            self.close_connection = True
+            return
+        if failure in ("503", "429"):
+            self.send_response(int(failure))
+            self.send_header("Retry-After", str(self.server.owner.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        # Tag each dataset with a hash of its content (as a real server would)
+        # so that conditional requests can be answered:
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if failure == "truncate":
+            # Send half the body then close connection:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console quiet:
+        pass
+
+# Define class to run the stand-in server in a background thread:
+class LocalWQAServer:
+    '''
+    Class to run the stand-in batch API on localhost in a background thread.
+    Use as a context manager; the root URL to pass to BatchDownloader is
+    available as the 'root' attribute.
+
+    PARAMETERS:
+    - rows: number of measurement rows in each made-up dataset
+    - port: port to listen on (0 picks a free port)
+    - sites: number of sampling points in each made-up dataset
+    - determinands: number of determinands in each made-up dataset
+    - flaky: share of requests (0 to 1) which fail
+    - fail_first: number of requests for each dataset which fail before it
+      is served
+    - failures: list of ways requests fail (see FAILURES)
+    - retry_after: seconds sent in the Retry-After header of 429/503
+      responses
+    - seed: seed for choosing which requests fail (so runs can be repeated)
+    '''
+    def __init__(self, rows=200, port=0, sites=20, determinands=1, flaky=0.0,
+                 fail_first=0, failures=FAILURES, retry_after=1, seed=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), BatchRequestHandler)
+        self.httpd.rows = rows
+        self.httpd.sites = sites
+        self.httpd.determinands = determinands
+        self.httpd.owner = self
+        self.httpd.daemon_threads = True
+        self.root = "http://127.0.0.1:{0}/water-quality".format(self.httpd.server_address[1])
+        self.flaky = flaky
+        self.fail_first = fail_first
+        self.failures = list(failures)
+        self.retry_after = retry_after
+        self.requests = {}
+        self.failed = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def failure(self, path):
+        '''
+        Function to decide if (and how) a request should fail, counting the
+        requests made for each path.
+
+        PARAMETERS:
+        - path: path of request
+
+        RETURNS: way to fail (see FAILURES), or None to answer as normal
+        '''
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            if self.requests[path] > self.fail_first and self._rng.random() >= self.flaky:
+                return None
+            self.failed += 1
+            return self._rng.choice(self.failures)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
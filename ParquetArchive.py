@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+ParquetArchive.py
+
+Optional columnar (Apache Parquet) version of the Stage 1 archive. The yearly
+.csv files downloaded by CSVDownloader.py are converted into a typed,
+compressed Parquet dataset partitioned by EA operational area and year:
+
+    <archive_dir>/area=3-35/year=2019/part-0.parquet
+
+Later stages can then read just the columns (and areas/years) they need, e.g.
+the four sampling point columns used by CSVtoSHP.py, instead of parsing the
+whole of a multi-GB 'alldata_<area>.csv' file.
+
+Requires the pyarrow module (pip install pyarrow). The rest of the tool works
+without it using the .csv archive.
+"""
+
+# Import modules:
+import os
+import glob
+import re
+from CSVCombiner import read_header, reconcile_header, is_index_column
+from WQSchema import apply_schema, read_wq_csv
+
+# pyarrow is only needed for the Parquet archive:
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as pa_ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Types to store columns as in the archive (any other column is stored as text):
+ARCHIVE_TYPES = {"sample.sampleDateTime": "timestamp[s]",
+                 "result": "float64",
+                 "sample.samplingPoint.easting": "int32",
+                 "sample.samplingPoint.northing": "int32",
+                 "sample.isComplianceSample": "bool"}
+
+# Compression codec for Parquet files:
+COMPRESSION = "zstd"
+
+# Size of blocks (in bytes) to read yearly .csv files in:
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Number of rows in each Parquet row group when rows are sorted by sampling
+# point (smaller row groups can be skipped more precisely by queries):
+ROW_GROUP_SIZE = 50000
+
+# Most data (in bytes, once read) to sort by sampling point at once. Yearly
+# datasets bigger than this are sorted in parts, so memory use stays bounded:
+SORT_BYTES = 256 * 1024 * 1024
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to check that pyarrow is available:
+def require_pyarrow():
+    '''
+    Function to raise an ImportError with a helpful message if pyarrow is not
+    installed.
+
+    RETURNS: None
+    '''
+    if pa is None:
+        raise ImportError("The Parquet archive requires the pyarrow module "
+                          "(pip install pyarrow).")
+
+# Define function to check if a directory holds a Parquet archive:
+def is_parquet_archive(path):
+    '''
+    Function to check if a directory contains a Parquet archive (i.e. has
+    'area=...' partition subdirectories).
+
+    PARAMETERS:
+    - path: directory to check
+
+    RETURNS: True if path is a Parquet archive
+    '''
+    return os.path.isdir(path) and len(glob.glob(os.path.join(path, "area=*"))) > 0
+
+# Define function to list the EA operational areas in a Parquet archive:
+def archive_areas(archive_dir):
+    '''
+    Function to list the EA operational areas held in a Parquet archive.
+
+    PARAMETERS:
+    - archive_dir: Parquet archive directory
+
+    RETURNS: sorted list of area notations
+    '''
+    dirs = glob.glob(os.path.join(archive_dir, "area=*"))
+    return sorted(os.path.basename(d)[len("area="):] for d in dirs)
+
+# Define function to build the Arrow schema for the archive:
+def archive_schema(columns):
+    '''
+    Function to build the Arrow schema used for every partition of the
+    archive, so that all partitions have the same columns and types.
+
+    PARAMETERS:
+    - columns: list of column names
+
+    RETURNS: pyarrow.Schema
+    '''
+    require_pyarrow()
+    fields = []
+    for column in columns:
+        type_name = ARCHIVE_TYPES.get(column, "string")
+        if type_name.startswith("timestamp"):
+            type_ = pa.timestamp("s")
+        else:
+            type_ = pa.type_for_alias(type_name)
+        fields.append(pa.field(column, type_))
+    return pa.schema(fields)
+
+# Define function to convert one yearly .csv file to a Parquet partition:
+def write_partition(csv_file, parquet_file, schema, sort_by_site=True,
+                    sort_bytes=SORT_BYTES):
+    '''
+    Function to convert one yearly .csv (or .csv.gz) file into a Parquet
+    file, reading it in blocks. If sort_by_site is True, rows are sorted by
+    sampling point and date so that each row group only covers a few sampling
+    points and can be skipped by queries for other sampling points. Blocks
+    are gathered and sorted up to sort_bytes at a time, so a yearly dataset
+    larger than that is written as several sorted runs rather than held in
+    memory whole.
+
+    PARAMETERS:
+    - csv_file: path of yearly .csv file
+    - parquet_file: path of Parquet file to write
+    - schema: pyarrow.Schema for archive (from archive_schema)
+    - sort_by_site: True to sort rows by sampling point and date
+    - sort_bytes: most data to sort at once
+
+    RETURNS: number of rows written
+    '''
+    require_pyarrow()
+    header = [c for c in read_header(csv_file) if not is_index_column(c)]
+    convert = pa_csv.ConvertOptions(
+            column_types={f.name: f.type for f in schema if f.name in header},
+            include_columns=header,
+            strings_can_be_null=True)
+    reader = pa_csv.open_csv(csv_file,
+                             read_options=pa_csv.ReadOptions(block_size=BLOCK_SIZE),
+                             convert_options=convert)
+
+    # Define function to put columns in archive order, filling any missing
+    # ones with nulls:
+    def conform(batch):
+        arrays = []
+        for field in schema:
+            if field.name in batch.schema.names:
+                arrays.append(batch.column(field.name).cast(field.type))
+            else:
+                arrays.append(pa.nulls(batch.num_rows, field.type))
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    # Define function to sort gathered blocks and write them:
+    def write_sorted(writer, tables):
+        table = pa.concat_tables(tables) if tables else schema.empty_table()
+        table = table.sort_by([("sample.samplingPoint.notation", "ascending"),
+                               ("sample.sampleDateTime", "ascending")])
+        writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        return table.num_rows
+
+    rows = 0
+    os.makedirs(os.path.dirname(parquet_file), exist_ok=True)
+    with pq.ParquetWriter(parquet_file, schema, compression=COMPRESSION) as writer:
+        if sort_by_site:
+            pending = []
+            pending_bytes = 0
+            for batch in (reader if header else []):
+                table = conform(batch)
+                pending.append(table)
+                pending_bytes += table.nbytes
+                if pending_bytes >= sort_bytes:
+                    rows += write_sorted(writer, pending)
+                    pending, pending_bytes = [], 0
+            if pending or rows == 0:
+                rows += write_sorted(writer, pending)
+        else:
+            for batch in reader:
+                writer.write_table(conform(batch))
+                rows += batch.num_rows
+    return rows
+
+# Define function to build the Parquet archive from the yearly .csv files:
+def build_archive(input_dir, areas_list, archive_dir, sort_by_site=True):
+    '''
+    Function to convert the yearly .csv files downloaded by CSVDownloader.py
+    into a Parquet archive partitioned by area and year.
+
+    PARAMETERS:
+    - input_dir: directory containing yearly files (e.g. '2019_3-35.csv')
+    - areas_list: list of EA operational area notations
+    - archive_dir: directory to write Parquet archive to
+    - sort_by_site: True to sort each partition by sampling point and date
+
+    RETURNS: number of rows written
+    '''
+    require_pyarrow()
+    pattern = re.compile(r"^(\d{4})_(.+)\.csv(\.gz)?$")
+    files = []
+    for path in sorted(glob.glob(os.path.join(input_dir, "*.csv*"))):
+        match = pattern.match(os.path.basename(path))
+        if match and match.group(2) in areas_list:
+            files.append((match.group(2), int(match.group(1)), path))
+
+    # Same columns for every partition:
+    schema = archive_schema(reconcile_header([f[2] for f in files]))
+
+    rows = 0
+    for area_notation, year, path in files:
+        parquet_file = os.path.join(archive_dir, "area=" + area_notation,
+                                    "year=" + str(year), "part-0.parquet")
+        print("Converting {0} to Parquet.".format(os.path.basename(path)))
+        rows += write_partition(path, parquet_file, schema, sort_by_site)
+    print("{0} rows written to Parquet archive {1}.".format(rows, archive_dir))
+    return rows
+
+# Define function to open the Parquet archive as a dataset:
+def open_archive(archive_dir):
+    '''
+    Function to open a Parquet archive as a pyarrow dataset with 'area' and
+    'year' partition columns.
+
+    PARAMETERS:
+    - archive_dir: Parquet archive directory
+
+    RETURNS: pyarrow.dataset.Dataset
+    '''
+    require_pyarrow()
+    partitioning = pa_ds.partitioning(
+            pa.schema([("area", pa.string()), ("year", pa.int32())]), flavor="hive")
+    return pa_ds.dataset(archive_dir, format="parquet", partitioning=partitioning)
+
+# Define function to read columns for an area from the Parquet archive:
+def read_archive(archive_dir, area_notation=None, columns=None, years=None):
+    '''
+    Function to read data from the Parquet archive into a pandas dataframe,
+    only reading the columns and partitions asked for.
+
+    PARAMETERS:
+    - archive_dir: Parquet archive directory
+    - area_notation: notation of EA operational area (None for all areas)
+    - columns: list of columns to read (None for all columns)
+    - years: list of years to read (None for all years)
+
+    RETURNS: pandas dataframe
+    '''
+    dataset = open_archive(archive_dir)
+    expression = None
+    if area_notation is not None:
+        expression = pa_ds.field("area") == area_notation
+    if years is not None:
+        year_filter = pa_ds.field("year").isin([int(y) for y in years])
+        expression = year_filter if expression is None else expression & year_filter
+    if columns is None:
+        # Leave out the partition columns, which are not in the .csv files:
+        columns = [n for n in dataset.schema.names if n not in ("area", "year")]
+    table = dataset.to_table(columns=columns, filter=expression)
+    return apply_schema(table.to_pandas())
+
+# Define function to read columns from either kind of archive:
+def read_columns(source, columns, area_notation=None):
+    '''
+    Function to read selected columns for an EA operational area from either
+    an 'alldata_<area>.csv' file or a Parquet archive directory.
+
+    PARAMETERS:
+    - source: path of .csv file, or Parquet archive directory
+    - columns: list of columns to read
+    - area_notation: notation of EA operational area (Parquet archive only)
+
+    RETURNS: pandas dataframe
+    '''
+    if is_parquet_archive(source):
+        return read_archive(source, area_notation, columns)
+    return read_wq_csv(source, usecols=columns)
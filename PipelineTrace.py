@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+PipelineTrace.py
+
+Timing and memory instrumentation shared by the scripts and supporting
+modules, so that when a refresh (CSVDownloader.py) or an extraction
+(WQDataExtractor.py) is slow it can be seen where the time went without
+running it under a profiler.
+
+Work is split into named 'spans' (e.g. 'download' for a whole stage, or
+'download.request' and 'download.write' for the steps of one dataset). For
+each span the trace records how long it took, counters added while it was
+open (e.g. rows and bytes, which are also added to the spans it is part of)
+and the peak memory (resident set size) of the process while it was open,
+sampled in the background. Each span is written as one line of JSON to the
+trace file as it ends, and summary_lines gives a table of time, rows, bytes
+and peak memory for each span name.
+
+Spans and counters do nothing unless a trace has been started, so modules
+can be instrumented without slowing down scripts which do not use a trace.
+Worker processes started while a trace is running add their spans to the
+same trace file, each with its own Trace (a process forked from a traced
+process does not carry on using its parent's, whose lock may have been held
+by the memory sampler at the time of the fork and which has no sampler).
+
+Example:
+    trace = start_trace("refresh_trace.jsonl")
+    with span("combine", area="3-35"):
+        ...
+        count("bytes", 1024)
+    stop_trace()
+    for line in summary_lines(trace.path):
+        print(line)
+"""
+
+# Import modules:
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import contextlib
+import pandas as pd
+
+# Environment variable holding the trace file, so worker processes can add
+# their spans to the same trace:
+TRACE_ENV = "WQ_TRACE_FILE"
+
+# Seconds between memory samples:
+SAMPLE_INTERVAL = 0.1
+
+# Trace started in this process (None if not tracing):
+_active = None
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the Windows memory counters of this process:
+def process_memory_counters():
+    '''
+    Function to get the memory counters of this process on Windows.
+
+    RETURNS: PROCESS_MEMORY_COUNTERS structure
+    '''
+    import ctypes
+    from ctypes import wintypes
+
+    # Define structure filled in by GetProcessMemoryInfo:
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    ctypes.windll.psapi.GetProcessMemoryInfo.argtypes = [
+            wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                             ctypes.byref(counters), counters.cb)
+    return counters
+
+# Define function to get the peak memory used by this process:
+def peak_rss_mb():
+    '''
+    Function to get the peak resident set size (memory) of this process.
+
+    RETURNS: peak resident set size in MB
+    '''
+    if sys.platform == "win32":
+        return process_memory_counters().PeakWorkingSetSize / 1024.0**2
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere:
+    return peak / 1024.0**2 if sys.platform == "darwin" else peak / 1024.0
+
+# Define function to get the memory currently used by this process:
+def current_rss_mb():
+    '''
+    Function to get the current resident set size (memory) of this process.
+    Where this cannot be read (e.g. macOS) the peak so far is used instead.
+
+    RETURNS: resident set size in MB
+    '''
+    if sys.platform == "win32":
+        return process_memory_counters().WorkingSetSize / 1024.0**2
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024.0**2
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+# Define class to record spans and counters:
+class Trace:
+    '''
+    Class to record timed spans, counters and memory use, writing each span to
+    a JSON-lines trace file (if given) as it ends. Spans can be opened from
+    any thread.
+
+    PARAMETERS:
+    - path: trace file to append spans to (None to keep them in memory only)
+    - sample_interval: seconds between memory samples (None for no sampling,
+      in which case memory is only read at the start and end of each span)
+    '''
+    def __init__(self, path=None, sample_interval=SAMPLE_INTERVAL):
+        self.path = path
+        self.records = []
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+        self._open = {}
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._stop = threading.Event()
+        self._sampler = None
+        if sample_interval:
+            self._sampler = threading.Thread(target=self._sample, args=(sample_interval,),
+                                             daemon=True)
+            self._sampler.start()
+
+    def _sample(self, interval):
+        # Record highest memory use seen while each span is open:
+        while not self._stop.wait(interval):
+            rss = current_rss_mb()
+            with self._lock:
+                for record in self._open.values():
+                    if rss > record["peak_rss_mb"]:
+                        record["peak_rss_mb"] = rss
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        '''
+        Function to get the id of the innermost span open in this thread, to
+        pass as the parent of spans opened in worker threads.
+
+        RETURNS: span id (None if no span is open)
+        '''
+        stack = self._stack()
+        return stack[-1]["id"] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attrs):
+        '''
+        Function to time a block of code as a span (use in a 'with'
+        statement).
+
+        PARAMETERS:
+        - name: name of span (e.g. 'download.request')
+        - parent: id of parent span (defaults to the innermost span open in
+          this thread)
+        - attrs: details of the span to record (e.g. area='3-35')
+
+        RETURNS: span record dictionary
+        '''
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1]["id"]
+        rss = current_rss_mb()
+        record = {"type": "span",
+                  "name": name,
+                  "id": "{0}-{1}".format(os.getpid(), next(self._ids)),
+                  "parent": parent,
+                  "pid": os.getpid(),
+                  "thread": threading.current_thread().name,
+                  "start": time.time(),
+                  "rss_start_mb": rss,
+                  "peak_rss_mb": rss,
+                  "counters": {},
+                  "attrs": attrs}
+        with self._lock:
+            self._open[record["id"]] = record
+        stack.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            stack.remove(record)
+            rss = current_rss_mb()
+            with self._lock:
+                del self._open[record["id"]]
+                record["rss_end_mb"] = rss
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+                self.records.append(record)
+                if self._file is not None:
+                    # One write per line, so processes sharing the file do
+                    # not split each other's lines:
+                    self._file.write(json.dumps(record, default=str) + "\n")
+                    self._file.flush()
+
+    def count(self, name, value=1):
+        '''
+        Function to add to a counter of the innermost span open in this
+        thread, the spans it is part of and the trace totals.
+
+        PARAMETERS:
+        - name: name of counter (e.g. 'rows' or 'bytes')
+        - value: amount to add
+
+        RETURNS: None
+        '''
+        stack = self._stack()
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+            record = stack[-1] if stack else None
+            while record is not None:
+                record["counters"][name] = record["counters"].get(name, 0) + value
+                record = self._open.get(record["parent"])
+
+    def close(self):
+        '''
+        Function to stop memory sampling and close the trace file.
+
+        RETURNS: None
+        '''
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# Define function to start tracing:
+def start_trace(path=None, sample_interval=SAMPLE_INTERVAL, overwrite=True):
+    '''
+    Function to start a trace for this process (and any worker processes it
+    starts), stopping any trace already running.
+
+    PARAMETERS:
+    - path: JSON-lines trace file (None to keep spans in memory only)
+    - sample_interval: seconds between memory samples
+    - overwrite: True to start a new trace file, False to append to it
+
+    RETURNS: Trace
+    '''
+    global _active
+    stop_trace()
+    if path is not None:
+        if overwrite and os.path.isfile(path):
+            os.remove(path)
+        os.environ[TRACE_ENV] = os.path.abspath(path)
+    _active = Trace(path, sample_interval)
+    return _active
+
+# Define function to stop tracing:
+def stop_trace():
+    '''
+    Function to stop the trace running in this process.
+
+    RETURNS: the Trace stopped (None if there was none)
+    '''
+    global _active
+    trace, _active = _active, None
+    os.environ.pop(TRACE_ENV, None)
+    if trace is not None:
+        trace.close()
+    return trace
+
+# Define function to get the running trace:
+def active_trace():
+    '''
+    Function to get the trace running in this process. A worker process
+    started by a traced process joins its parent's trace file.
+
+    RETURNS: Trace (None if not tracing)
+    '''
+    global _active
+    if _active is None and os.environ.get(TRACE_ENV):
+        _active = Trace(os.environ[TRACE_ENV])
+    return _active
+
+# Define function to drop the parent's trace in a forked process:
+def _after_fork():
+    # The child joins the trace file afresh (see active_trace):
+    global _active
+    _active = None
+
+# Forked processes (e.g. pool workers on Linux) start without a trace:
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+# Define function to time a block of code if tracing:
+def span(name, parent=None, **attrs):
+    '''
+    Function to time a block of code as a span of the running trace (use in
+    a 'with' statement). Does nothing if no trace is running.
+
+    PARAMETERS:
+    - name: name of span
+    - parent: id of parent span (from current_span) for spans opened in
+      worker threads
+    - attrs: details of the span to record
+
+    RETURNS: context manager
+    '''
+    trace = active_trace()
+    if trace is None:
+        return contextlib.nullcontext()
+    return trace.span(name, parent, **attrs)
+
+# Define function to add to a counter if tracing:
+def count(name, value=1):
+    '''
+    Function to add to a counter of the innermost open span of the running
+    trace. Does nothing if no trace is running.
+
+    PARAMETERS:
+    - name: name of counter
+    - value: amount to add
+
+    RETURNS: None
+    '''
+    trace = active_trace()
+    if trace is not None:
+        trace.count(name, value)
+
+# Define function to get the id of the innermost open span:
+def current_span():
+    '''
+    Function to get the id of the innermost span open in this thread, so
+    that spans opened by worker threads can be attached to it.
+
+    RETURNS: span id (None if not tracing or no span is open)
+    '''
+    trace = active_trace()
+    return None if trace is None else trace.current()
+
+# Define function to read a trace file:
+def read_trace(path):
+    '''
+    Function to read the spans from a JSON-lines trace file.
+
+    PARAMETERS:
+    - path: trace file
+
+    RETURNS: list of span record dictionaries
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Define function to summarise spans by name:
+def summarise(records):
+    '''
+    Function to summarise spans by name, in the order each name was first
+    started: number of calls, total, mean and longest time, counters (added
+    up) and peak memory.
+
+    PARAMETERS:
+    - records: list of span records (from Trace.records or read_trace), or
+      path of trace file
+
+    RETURNS: pandas dataframe indexed by span name
+    '''
+    if isinstance(records, str):
+        records = read_trace(records)
+    records = [r for r in records if r.get("type") == "span"]
+    if not records:
+        return pd.DataFrame(columns=["calls", "seconds", "mean", "max", "peak_rss_mb"])
+    df = pd.DataFrame({"name": [r["name"] for r in records],
+                       "start": [r["start"] for r in records],
+                       "seconds": [r["seconds"] for r in records],
+                       "peak_rss_mb": [r["peak_rss_mb"] for r in records]})
+    counters = pd.DataFrame([r["counters"] for r in records], index=df.index)
+    groups = df.groupby("name", sort=False)
+    summary = groups.agg(start=("start", "min"), calls=("seconds", "size"),
+                         seconds=("seconds", "sum"), mean=("seconds", "mean"),
+                         max=("seconds", "max"), peak_rss_mb=("peak_rss_mb", "max"))
+    if len(counters.columns):
+        summary = summary.join(counters.groupby(df["name"]).sum(min_count=1))
+    return summary.sort_values("start", kind="stable").drop(columns="start")
+
+# Define function to format the summary as a table:
+def summary_lines(records):
+    '''
+    Function to format the summary of a trace as lines of a text table, for
+    printing or arcpy.AddMessage. Spans which counted bytes also show their
+    throughput.
+
+    PARAMETERS:
+    - records: list of span records, or path of trace file
+
+    RETURNS: list of strings
+    '''
+    summary = summarise(records)
+    counters = [c for c in summary.columns
+                if c not in ("calls", "seconds", "mean", "max", "peak_rss_mb")]
+    header = "{0:<22} {1:>6} {2:>9} {3:>9} {4:>9}".format("span", "calls", "seconds", "mean", "max")
+    for c in counters:
+        header += " {0:>12}".format("MB" if c == "bytes" else c)
+    if "bytes" in counters:
+        header += " {0:>8}".format("MB/s")
+    header += " {0:>8}".format("peak MB")
+    lines = [header]
+    for name, row in summary.iterrows():
+        line = "{0:<22} {1:>6} {2:>9.2f} {3:>9.3f} {4:>9.3f}".format(
+                name, int(row["calls"]), row["seconds"], row["mean"], row["max"])
+        for c in counters:
+            value = row[c]
+            if pd.isna(value):
+                line += " {0:>12}".format("")
+            elif c == "bytes":
+                line += " {0:>12,.1f}".format(value / 1024.0**2)
+            else:
+                line += " {0:>12,.0f}".format(value)
+        if "bytes" in counters:
+            rate = "" if pd.isna(row["bytes"]) or not row["seconds"] else \
+                "{0:.1f}".format(row["bytes"] / 1024.0**2 / row["seconds"])
+            line += " {0:>8}".format(rate)
+        line += " {0:>8.0f}".format(row["peak_rss_mb"])
+        lines.append(line)
+    return lines
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+PlotDownsampler.py
+
+Downsampling of time series for the Plotly plots in DataViewer.ipynb, so that
+plots of many sampling points over many years stay quick to draw and the
+saved .html files stay small.
+
+The data is grouped by sampling point once. Each sampling point's series is
+then reduced to a fixed number of points with the Largest-Triangle-Three-
+Buckets (LTTB) algorithm, which keeps the peaks, troughs and overall shape of
+the series (a simpler min/max method is also available). Series with fewer
+points than this are plotted in full.
+
+In the notebook, TraceResampler.figure_widget gives an interactive plot which
+is re-drawn from the full data whenever the user zooms in, so the points in
+view are always shown at full resolution once few enough are in range.
+
+Reference: Steinarsson, S. (2013) Downsampling Time Series for Visual
+Representation. MSc thesis, University of Iceland.
+"""
+
+# Import modules:
+import numpy as np
+import pandas as pd
+
+# Default maximum number of points to plot for each trace:
+MAX_POINTS = 1000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to downsample a series with LTTB:
+def lttb_indices(x, y, n_out):
+    '''
+    Function to choose which points of a series to plot using the Largest-
+    Triangle-Three-Buckets algorithm. The first and last points are always
+    kept; the points in between are split into n_out - 2 buckets and from each
+    bucket the point forming the largest triangle with the point chosen from
+    the previous bucket and the average of the next bucket is kept.
+
+    PARAMETERS:
+    - x: numpy array of x values (numbers, sorted)
+    - y: numpy array of y values
+    - n_out: number of points to keep
+
+    RETURNS: numpy array of indices of points to keep
+    '''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # Bucket edges for the points between the first and last:
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.zeros(n_out, dtype=int)
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # Average of next bucket (or the last point for the final bucket):
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n - 1, n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Area (x2) of triangle formed with each point in this bucket:
+        area = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous]) -
+                      (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+# Define function to downsample a series keeping each bucket's min and max:
+def minmax_indices(x, y, n_out):
+    '''
+    Function to choose which points of a series to plot by splitting it into
+    n_out / 2 buckets and keeping the lowest and highest point of each.
+
+    PARAMETERS:
+    - x: numpy array of x values (sorted)
+    - y: numpy array of y values
+    - n_out: number of points to keep (about)
+
+    RETURNS: numpy array of indices of points to keep
+    '''
+    n = len(x)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    buckets = np.minimum(np.arange(n) * (n_out // 2) // n, n_out // 2 - 1)
+    order = pd.DataFrame({"bucket": buckets, "y": y}).groupby("bucket")["y"]
+    keep = np.concatenate([order.idxmin().values, order.idxmax().values, [0, n - 1]])
+    return np.unique(keep)
+
+# Define class to hold the series for each trace:
+class TraceResampler:
+    '''
+    Class to group plot data into one series per trace once, and produce
+    downsampled Plotly traces for the whole date range or a zoomed-in range.
+
+    PARAMETERS:
+    - df: pandas dataframe of data to plot
+    - group_col: column to make one trace per value of (e.g. sampling point)
+    - x_col: column of x values (e.g. sample date)
+    - y_col: column of y values (e.g. result)
+    - max_points: maximum number of points to plot for each trace
+    - method: 'lttb' or 'minmax'
+    '''
+    def __init__(self, df, group_col, x_col, y_col, max_points=MAX_POINTS, method="lttb"):
+        self.max_points = max_points
+        self.choose = lttb_indices if method == "lttb" else minmax_indices
+        self.series = []
+        df = df[[group_col, x_col, y_col]].dropna(subset=[x_col, y_col])
+        # Group once, rather than filtering the data for each trace:
+        for name, group in df.groupby(group_col, observed=True, sort=True):
+            group = group.sort_values(x_col, kind="stable")
+            x = group[x_col].values
+            self.series.append((str(name), x, group[y_col].values.astype(float)))
+
+    @classmethod
+    def from_series(cls, series, max_points=MAX_POINTS, method="lttb"):
+        '''
+        Function to make a TraceResampler from series which are already
+        grouped and sorted by date (e.g. from SeriesStore.traces), without
+        copying them (except to leave out missing values).
+
+        PARAMETERS:
+        - series: list of (name, x values, y values), x values sorted
+        - max_points: maximum number of points to plot for each trace
+        - method: 'lttb' or 'minmax'
+
+        RETURNS: TraceResampler
+        '''
+        resampler = cls(pd.DataFrame(columns=["name", "x", "y"]), "name", "x", "y",
+                        max_points, method)
+        resampler.series = []
+        for name, x, y in series:
+            # Leave out missing values (e.g. censored results), copying only
+            # the series which have any:
+            missing = np.isnan(y)
+            if missing.any():
+                x, y = x[~missing], y[~missing]
+            if len(x):
+                resampler.series.append((str(name), x, y))
+        return resampler
+
+    def traces(self, x_range=None):
+        '''
+        Function to get downsampled Plotly traces, for the whole series or only
+        the part within x_range.
+
+        PARAMETERS:
+        - x_range: (start, end) of x values to include (None for all)
+
+        RETURNS: list of trace dictionaries (name, x, y)
+        '''
+        traces = []
+        for name, x, y in self.series:
+            if x_range is not None:
+                start, end = np.searchsorted(x, np.array(x_range, dtype=x.dtype))
+                # Include a point either side so lines run to the plot edges:
+                start, end = max(start - 1, 0), min(end + 1, len(x))
+                x, y = x[start:end], y[start:end]
+            # Work on numbers, so dates are used as nanoseconds:
+            x_num = x.astype("datetime64[ns]").astype(np.int64) if np.issubdtype(x.dtype, np.datetime64) else x
+            keep = self.choose(x_num, y, self.max_points)
+            traces.append({"name": name, "x": x[keep], "y": y[keep]})
+        return traces
+
+    def figure_widget(self, layout, mode="markers+lines"):
+        '''
+        Function to make an interactive Plotly FigureWidget (for use in a
+        Jupyter notebook) which is re-drawn from the full data for the date
+        range in view whenever the user zooms or pans.
+
+        PARAMETERS:
+        - layout: Plotly layout dictionary
+        - mode: Plotly trace mode
+
+        RETURNS: plotly.graph_objs.FigureWidget
+        '''
+        import plotly.graph_objs as go
+        widget = go.FigureWidget(data=[dict(t, mode=mode) for t in self.traces()], layout=layout)
+
+        # Define function to re-draw traces when the x axis range changes:
+        def redraw(layout, x_range):
+            x_range = None if x_range is None else pd.to_datetime(list(x_range)).values
+            with widget.batch_update():
+                for trace, update in zip(widget.data, self.traces(x_range)):
+                    trace.x, trace.y = update["x"], update["y"]
+
+        widget.layout.on_change(redraw, "xaxis.range")
+        return widget
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+QueryCache.py
+
+Persistent cache of extraction results, used by WQDataExtractor.py so that
+repeat and overlapping queries (the same or neighbouring areas of interest,
+or a date range inside one already extracted) do not scan the archive again.
+
+Results are cached per sampling point: each entry holds the rows for one
+sampling point, determinand selection and date range, and is stored under a
+key made from the archive version, the sampling point and the determinands.
+The archive version is a fingerprint of the name, size and modification time
+of every data file in the archive, so entries for an archive which has since
+been refreshed or rebuilt are never used. A query is answered from the
+entries whose date range covers it, and only the sampling points without one
+are extracted from the archive. Where a sampling point has an entry which
+covers only part of the date range, just the periods before and after it are
+extracted and added to the entry.
+
+Each entry is a pickled dataframe in the cache directory, listed in
+'cache_index.json' with its size and the time it was last used. Once the
+cache is larger than its size limit the entries used least recently are
+deleted.
+"""
+
+# Import modules:
+import os
+import glob
+import json
+import time
+import hashlib
+import datetime
+import pandas as pd
+from ParquetArchive import is_parquet_archive
+from ArchiveQuery import to_datetime, query_areas
+from WQSchema import apply_schema, concat_frames
+from ResultQualifiers import add_qualifier_codes
+from PipelineTrace import span, count
+
+# Default size limit of cache (bytes):
+CACHE_SIZE = 1024 ** 3
+
+# Name of cache index file:
+INDEX_FILE = "cache_index.json"
+
+# Overlap added to the periods extracted to extend an entry, so the samples
+# taken at its first and last dates are included (sample times are given to
+# the second in the archive):
+DATE_STEP = datetime.timedelta(seconds=1)
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to choose the default cache location for an archive:
+def default_cache_dir(wqArchive):
+    '''
+    Function to get the default cache directory for an archive, which is kept
+    next to the archive directory (e.g. 'csv_downloaded_<date>/query_cache').
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+
+    RETURNS: path of cache directory
+    '''
+    return os.path.join(os.path.dirname(os.path.normpath(os.path.abspath(wqArchive))), "query_cache")
+
+# Define function to fingerprint the data files of an archive:
+def archive_version(wqArchive):
+    '''
+    Function to work out the version of an archive from the name, size and
+    modification time of its data files ('alldata_<area>.csv' files, or the
+    .parquet files of a Parquet archive).
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+
+    RETURNS: version as hexadecimal string
+    '''
+    if is_parquet_archive(wqArchive):
+        files = glob.glob(os.path.join(wqArchive, "area=*", "*", "*.parquet"))
+    else:
+        files = glob.glob(os.path.join(wqArchive, "alldata_*.csv"))
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        stat = os.stat(path)
+        digest.update("{0}|{1}|{2}\n".format(os.path.relpath(path, wqArchive), stat.st_size,
+                                             stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+# Define function to build the cache key for a sampling point:
+def entry_key(version, loc, determinands):
+    '''
+    Function to build the key used to store a sampling point's rows.
+
+    PARAMETERS:
+    - version: archive version (from archive_version)
+    - loc: sampling point notation
+    - determinands: sorted list of determinands (None for all)
+
+    RETURNS: key as hexadecimal string
+    '''
+    text = json.dumps([version, str(loc), determinands])
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+# Define function to check whether a cached date range covers a query:
+def covers(entry, start_date, end_date):
+    '''
+    Function to check whether the date range of a cache entry covers the date
+    range of a query (None meaning no limit).
+
+    PARAMETERS:
+    - entry: dictionary for cache entry
+    - start_date: start of query date range (datetime or None)
+    - end_date: end of query date range (datetime or None)
+
+    RETURNS: True or False
+    '''
+    start, end = to_datetime(entry["start"]), to_datetime(entry["end"])
+    if start is not None and (start_date is None or start_date < start):
+        return False
+    if end is not None and (end_date is None or end_date > end):
+        return False
+    return True
+
+# Define function to work out the periods missing from a cache entry:
+def missing_periods(entry, start_date, end_date):
+    '''
+    Function to work out which periods of a query's date range are outside
+    the date range of a cache entry (None meaning no limit).
+
+    PARAMETERS:
+    - entry: dictionary for cache entry
+    - start_date: start of query date range (datetime or None)
+    - end_date: end of query date range (datetime or None)
+
+    RETURNS: list of (start, end) periods to extract, or None if the date
+    ranges do not overlap (so the entry cannot be extended)
+    '''
+    start, end = to_datetime(entry["start"]), to_datetime(entry["end"])
+    if (end is not None and start_date is not None and start_date >= end) or \
+            (start is not None and end_date is not None and end_date <= start):
+        return None
+    periods = []
+    if start is not None and (start_date is None or start_date < start):
+        periods.append((start_date, start + DATE_STEP))
+    if end is not None and (end_date is None or end_date > end):
+        periods.append((end - DATE_STEP, end_date))
+    return periods
+
+# Define function to convert a date to text for the cache index:
+def date_text(date):
+    '''
+    Function to convert a date to ISO text for the cache index.
+
+    PARAMETERS:
+    - date: datetime (or None)
+
+    RETURNS: string (or None)
+    '''
+    return None if date is None else date.isoformat()
+
+# Define class to hold the query cache:
+class QueryCache:
+    '''
+    Class to answer archive queries from cached per-sampling point results,
+    extracting only the sampling points not already in the cache.
+
+    PARAMETERS:
+    - cache_dir: cache directory (created if it does not exist)
+    - max_bytes: size limit of cache in bytes
+    '''
+    def __init__(self, cache_dir, max_bytes=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, INDEX_FILE)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Read existing cache index if there is one:
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+        # Number of sampling points found in / missing from cache by last
+        # query, and of missing ones whose entry was extended:
+        self.hits = 0
+        self.misses = 0
+        self.extended = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def _save(self):
+        # Write to a temporary file first so the index is never left half written:
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_file, self.index_file)
+
+    def size(self):
+        '''
+        Function to get the total size of the cached results.
+
+        RETURNS: size in bytes
+        '''
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def get(self, key, start_date, end_date):
+        '''
+        Function to read a cached result if it covers the date range.
+
+        PARAMETERS:
+        - key: cache key (from entry_key)
+        - start_date: start of date range (datetime or None)
+        - end_date: end of date range (datetime or None)
+
+        RETURNS: pandas dataframe (None if not cached or not covered)
+        '''
+        entry = self.entries.get(key)
+        if entry is None or not covers(entry, start_date, end_date):
+            return None
+        return self.read(key)
+
+    def read(self, key):
+        '''
+        Function to read a cached result whatever its date range.
+
+        PARAMETERS:
+        - key: cache key (from entry_key)
+
+        RETURNS: pandas dataframe (None if not cached)
+        '''
+        if key not in self.entries:
+            return None
+        try:
+            df = pd.read_pickle(self._path(key))
+        except (OSError, EOFError, ValueError):
+            # Entry file missing or damaged, so extract again:
+            del self.entries[key]
+            return None
+        self.entries[key]["used"] = time.time()
+        return df
+
+    def put(self, key, loc, df, start_date, end_date):
+        '''
+        Function to store the rows for a sampling point in the cache.
+
+        PARAMETERS:
+        - key: cache key (from entry_key)
+        - loc: sampling point notation
+        - df: pandas dataframe of rows
+        - start_date: start of date range extracted (datetime or None)
+        - end_date: end of date range extracted (datetime or None)
+
+        RETURNS: None
+        '''
+        path = self._path(key)
+        df.to_pickle(path)
+        self.entries[key] = {"site": str(loc), "start": date_text(start_date),
+                             "end": date_text(end_date), "rows": len(df),
+                             "bytes": os.path.getsize(path), "used": time.time()}
+
+    def evict(self):
+        '''
+        Function to delete the entries used least recently until the cache is
+        within its size limit.
+
+        RETURNS: number of entries deleted
+        '''
+        total = self.size()
+        deleted = 0
+        for key in sorted(self.entries, key=lambda k: self.entries[k]["used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(key)["bytes"]
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            deleted += 1
+        return deleted
+
+    def query(self, wqArchive, areas, locs, start_date=None, end_date=None,
+              determinands=None, max_workers=None):
+        '''
+        Function to extract the rows matching the query filters (as
+        ArchiveQuery.query_areas), reading sampling points from the cache
+        where possible and extracting the rest from the archive.
+
+        PARAMETERS:
+        - wqArchive: archive directory
+        - areas: list of EA operational area notations (e.g. from find_areas)
+        - locs: list of sampling point notations
+        - start_date: start of date range (None for no limit)
+        - end_date: end of date range (None for no limit)
+        - determinands: list of determinand definitions or notations (None for all)
+        - max_workers: number of worker processes (None for one per processor)
+
+        RETURNS: pandas dataframe of matching rows
+        '''
+        start_date, end_date = to_datetime(start_date), to_datetime(end_date)
+        determinands = None if determinands is None else sorted(set(determinands))
+        locs = sorted(set(str(loc) for loc in locs))
+
+        # Look up each sampling point, using an entry for all determinands if
+        # there is no entry for the ones selected:
+        with span("cache.lookup", sites=len(locs)):
+            version = archive_version(wqArchive)
+            frames = {}
+            missing = []
+            for loc in locs:
+                key = entry_key(version, loc, determinands)
+                df = self.get(key, start_date, end_date)
+                if df is None and determinands is not None:
+                    df = self.get(entry_key(version, loc, None), start_date, end_date)
+                    if df is not None:
+                        df = df[df["determinand.definition"].isin(determinands) |
+                                df["determinand.notation"].isin(determinands)]
+                if df is None:
+                    missing.append(loc)
+                else:
+                    frames[loc] = df
+            self.hits, self.misses, self.extended = len(frames), len(missing), 0
+            count("sites_cached", self.hits)
+
+        # Extract the missing sampling points. Where a sampling point has an
+        # entry overlapping the date range, only the periods outside the entry
+        # are extracted and the entry is extended with them; otherwise the
+        # whole date range is extracted and replaces any entry. Sampling
+        # points needing the same period are extracted together:
+        if missing:
+            periods = {}
+            extending = {}
+            for loc in missing:
+                key = entry_key(version, loc, determinands)
+                entry = self.entries.get(key)
+                loc_periods = None
+                if entry is not None:
+                    loc_periods = missing_periods(entry, start_date, end_date)
+                    cached = None if loc_periods is None else self.read(key)
+                    if cached is None:
+                        loc_periods = None
+                    else:
+                        extending[loc] = cached, entry["start"], entry["end"]
+                for period in loc_periods or [(start_date, end_date)]:
+                    periods.setdefault(period, []).append(loc)
+            self.extended = len(extending)
+            count("sites_extended", self.extended)
+
+            extracted = {loc: [] for loc in missing}
+            empty = None
+            for (period_start, period_end), period_locs in periods.items():
+                df = query_areas(wqArchive, areas, period_locs, period_start, period_end,
+                                 determinands, max_workers)
+                empty = df.iloc[0:0]
+                for loc, site_df in df.groupby("sample.samplingPoint.notation", sort=False):
+                    extracted[loc].append(site_df)
+
+            with span("cache.store", sites=len(missing)):
+                for loc in missing:
+                    site_frames = extracted[loc]
+                    entry_start, entry_end = start_date, end_date
+                    if loc in extending:
+                        cached, cached_start, cached_end = extending[loc]
+                        site_frames = [add_qualifier_codes(cached)] + site_frames
+                        cached_start, cached_end = to_datetime(cached_start), to_datetime(cached_end)
+                        entry_start = None if entry_start is None or cached_start is None else min(entry_start, cached_start)
+                        entry_end = None if entry_end is None or cached_end is None else max(entry_end, cached_end)
+                    site_frames = [site_df for site_df in site_frames if len(site_df)]
+                    if not site_frames:
+                        site_df = empty
+                    elif len(site_frames) == 1:
+                        site_df = site_frames[0]
+                    else:
+                        site_df = concat_frames(site_frames).sort_values(
+                                "sample.sampleDateTime", kind="stable").reset_index(drop=True)
+                    self.put(entry_key(version, loc, determinands), loc, site_df,
+                             entry_start, entry_end)
+                    frames[loc] = site_df
+                self.evict()
+
+        self._save()
+
+        # Cut the cached results down to the date range of this query:
+        with span("cache.merge"):
+            # Keep the columns of the archive even if nothing matched (adding
+            # qualifier codes to any entries cached without them):
+            results = [add_qualifier_codes(frames[loc]) for loc in locs]
+            df = apply_schema(concat_frames([df for df in results if len(df)] or results[:1]))
+            dates = df["sample.sampleDateTime"]
+            keep = pd.Series(True, index=df.index)
+            if start_date is not None:
+                keep &= dates > start_date
+            if end_date is not None:
+                keep &= dates < end_date
+            return df[keep].reset_index(drop=True)
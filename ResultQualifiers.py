@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+ResultQualifiers.py
+
+Handling of result qualifiers ('resultQualifier.notation') and values below
+the Limit of Detection (LoD). Each result's qualifier is turned into a small
+code while the archive is being read (see ArchiveQuery.py):
+
+    0 - no qualifier
+    1 - '<' (below the Limit of Detection; the result is the LoD)
+    2 - '>' (above the upper limit of the method; the result is that limit)
+    3 - any other qualifier (result used as it is)
+
+and the results used for analysis ('resultQualified') are then worked out
+from the results and codes by one of these policies:
+
+    half     - results below the LoD are halved (the standard pre-processing,
+               and the default)
+    zero     - results below the LoD are set to zero
+    lod      - results below the LoD are used as the LoD
+    censored - results below the LoD or above the upper limit are left out
+               (set to NaN), with the codes showing which they were
+
+Every policy works on whole columns at once. Other policies can be added
+with register_policy. SeriesStore.py saves the results for every policy, so
+DataViewer.ipynb can switch between them without extracting the data again.
+"""
+
+# Import modules:
+import numpy as np
+import pandas as pd
+
+# Qualifier codes:
+NONE = 0
+BELOW = 1
+ABOVE = 2
+OTHER = 3
+QUALIFIER_CODES = {"": NONE, "<": BELOW, ">": ABOVE}
+
+# Column names of qualifier and codes:
+QUALIFIER_COLUMN = "resultQualifier.notation"
+CODE_COLUMN = "resultQualifier.code"
+
+# Policy used unless another is chosen (as in the original tool):
+DEFAULT_POLICY = "half"
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function for the 'half' policy:
+def half_lod(result, codes):
+    '''
+    Function to halve results below the Limit of Detection.
+
+    PARAMETERS:
+    - result: numpy array of results
+    - codes: numpy array of qualifier codes
+
+    RETURNS: numpy array of values
+    '''
+    return np.where(codes == BELOW, result / 2, result)
+
+# Define function for the 'zero' policy:
+def zero_lod(result, codes):
+    '''
+    Function to set results below the Limit of Detection to zero.
+
+    PARAMETERS:
+    - result: numpy array of results
+    - codes: numpy array of qualifier codes
+
+    RETURNS: numpy array of values
+    '''
+    return np.where(codes == BELOW, 0.0, result)
+
+# Define function for the 'lod' policy:
+def at_lod(result, codes):
+    '''
+    Function to use results below the Limit of Detection as the LoD (i.e.
+    as they are).
+
+    PARAMETERS:
+    - result: numpy array of results
+    - codes: numpy array of qualifier codes
+
+    RETURNS: numpy array of values
+    '''
+    return np.array(result, dtype=float)
+
+# Define function for the 'censored' policy:
+def censored(result, codes):
+    '''
+    Function to leave out (set to NaN) results below the Limit of Detection
+    or above the upper limit.
+
+    PARAMETERS:
+    - result: numpy array of results
+    - codes: numpy array of qualifier codes
+
+    RETURNS: numpy array of values
+    '''
+    return np.where((codes == BELOW) | (codes == ABOVE), np.nan, result)
+
+# Policies by name, and their descriptions (e.g. for the notebook dropdown):
+POLICIES = {"half": half_lod, "zero": zero_lod, "lod": at_lod, "censored": censored}
+POLICY_LABELS = {"half": "Half LoD",
+                 "zero": "Zero",
+                 "lod": "LoD",
+                 "censored": "Censored (left out)"}
+
+# Define function to add a policy:
+def register_policy(name, function, label=None):
+    '''
+    Function to add a policy for working out results from results and
+    qualifier codes.
+
+    PARAMETERS:
+    - name: name of policy
+    - function: function taking (results, codes) numpy arrays and returning
+      a numpy array of values
+    - label: description of policy (None to use name)
+
+    RETURNS: None
+    '''
+    POLICIES[name] = function
+    POLICY_LABELS[name] = label or name
+
+# Define function to turn qualifiers into codes:
+def qualifier_codes(qualifiers):
+    '''
+    Function to turn result qualifiers into qualifier codes. For a categorical
+    column only the categories are looked up.
+
+    PARAMETERS:
+    - qualifiers: pandas series (or array) of qualifiers
+
+    RETURNS: numpy array of codes (int8)
+    '''
+    if not isinstance(qualifiers, pd.Series):
+        qualifiers = pd.Series(qualifiers)
+    if isinstance(qualifiers.dtype, pd.CategoricalDtype):
+        # Last entry is for missing values (category code -1):
+        lookup = np.array([QUALIFIER_CODES.get(str(c).strip(), OTHER)
+                           for c in qualifiers.cat.categories] + [NONE], dtype=np.int8)
+        return lookup[qualifiers.cat.codes.values]
+    text = qualifiers.astype(object).fillna("").astype(str).str.strip().values
+    codes = np.full(len(text), OTHER, dtype=np.int8)
+    for qualifier, code in QUALIFIER_CODES.items():
+        codes[text == qualifier] = code
+    return codes
+
+# Define function to add qualifier codes to a dataframe:
+def add_qualifier_codes(df):
+    '''
+    Function to add the qualifier code column to a dataframe of water quality
+    data, if it does not already have one.
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data
+
+    RETURNS: dataframe with 'resultQualifier.code' column
+    '''
+    if CODE_COLUMN in df.columns:
+        return df
+    df = df.copy(deep=False)
+    if QUALIFIER_COLUMN in df.columns:
+        df[CODE_COLUMN] = qualifier_codes(df[QUALIFIER_COLUMN])
+    else:
+        df[CODE_COLUMN] = np.zeros(len(df), dtype=np.int8)
+    return df
+
+# Define function to work out results using a policy:
+def apply_policy(result, codes, policy=DEFAULT_POLICY):
+    '''
+    Function to work out the results used for analysis from the results and
+    qualifier codes.
+
+    PARAMETERS:
+    - result: array of results
+    - codes: array of qualifier codes (from qualifier_codes)
+    - policy: name of policy (see POLICIES)
+
+    RETURNS: numpy array of values (float64)
+    '''
+    if policy not in POLICIES:
+        raise ValueError("Unknown Limit of Detection policy: {0} (choose from {1}).".format(
+                policy, ", ".join(POLICIES)))
+    return np.asarray(POLICIES[policy](np.asarray(result, dtype=float), np.asarray(codes)),
+                      dtype=float)
+
+# Define function to add the results used for analysis to a dataframe:
+def qualify(df, policy=DEFAULT_POLICY):
+    '''
+    Function to set the 'resultQualified' column of a dataframe of water
+    quality data using a policy.
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data
+    - policy: name of policy (see POLICIES)
+
+    RETURNS: dataframe with 'resultQualifier.code' and 'resultQualified'
+    columns
+    '''
+    # Copy (not the data) so the caller's dataframe is not changed:
+    df = add_qualifier_codes(df).copy(deep=False)
+    df["resultQualified"] = apply_policy(df["result"].values, df[CODE_COLUMN].values, policy)
+    return df
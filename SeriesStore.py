@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+SeriesStore.py
+
+On-disk store of the time series in a 'selected_data' file, used by
+DataViewer.ipynb. The rows are sorted once by determinand, sampling point and
+date and saved as one array per column (NumPy .npy files), so each sampling
+point's series for a determinand is one contiguous slice of each array:
+
+    selected_data_series/time.npy       - sample dates (datetime64[s])
+    selected_data_series/result.npy     - results (float64)
+    selected_data_series/qualifier.npy  - result qualifier codes (int8, see
+                                          ResultQualifiers.py)
+    selected_data_series/half.npy       - results for each Limit of
+    selected_data_series/zero.npy         Detection policy (float64, see
+    selected_data_series/lod.npy          ResultQualifiers.py)
+    selected_data_series/censored.npy
+    selected_data_series/series.csv     - determinand, unit, sampling point,
+                                          label, location (easting/northing
+                                          and, if known from the registry,
+                                          longitude/latitude) and start/stop
+                                          row of each series
+    selected_data_series/store.json     - file the store was built from
+
+The arrays are opened memory-mapped, so getting a series is a view of the
+file rather than a read and filter of the data, and only the parts of the
+arrays which are plotted are ever loaded into memory. As the results for
+every policy are saved, changing policy only means using another array.
+WQDataExtractor.py builds the store with the data file; DataViewer.ipynb
+builds it the first time a data file without one (or with an out-of-date
+one) is opened.
+
+Example:
+    store = open_store("selected_data.csv")
+    dets = store.determinands()
+    x, y = store.series(dets[0], store.sites(dets[0])["notation"].iloc[0])
+"""
+
+# Import modules:
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from WQSchema import read_dtypes, apply_schema
+from SiteGeometry import add_known_lonlat
+from ResultQualifiers import (POLICIES, DEFAULT_POLICY, CODE_COLUMN, add_qualifier_codes,
+                              apply_policy)
+
+# pyarrow is only needed for .parquet data files:
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Columns of the data file used by the store:
+SOURCE_COLUMNS = ["sample.samplingPoint.notation",
+                  "sample.samplingPoint.label",
+                  "sample.samplingPoint.easting",
+                  "sample.samplingPoint.northing",
+                  "determinand.definition",
+                  "determinand.unit.label",
+                  "sample.sampleDateTime",
+                  "result",
+                  "resultQualifier.notation",
+                  CODE_COLUMN]
+
+# Arrays held in the store (as well as one for each policy) and their types:
+ARRAYS = {"time": "datetime64[s]",
+          "result": "float64",
+          "qualifier": "int8"}
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the store directory for a data file:
+def store_dir_for(datafile):
+    '''
+    Function to get the directory of the store for a data file (shared by the
+    .csv and .parquet copies, e.g. 'selected_data_series').
+
+    PARAMETERS:
+    - datafile: path of .csv or .parquet data file
+
+    RETURNS: path of store directory
+    '''
+    return os.path.splitext(datafile)[0] + "_series"
+
+# Define function to read the columns needed from a data file:
+def read_source(datafile):
+    '''
+    Function to read the columns used by the store from a .csv or .parquet
+    data file.
+
+    PARAMETERS:
+    - datafile: path of .csv or .parquet data file
+
+    RETURNS: pandas dataframe
+    '''
+    if os.path.splitext(datafile)[1] == ".parquet":
+        names = pq.read_schema(datafile).names
+        return apply_schema(pd.read_parquet(datafile, columns=[c for c in SOURCE_COLUMNS if c in names]))
+    names = pd.read_csv(datafile, nrows=0).columns
+    usecols = [c for c in SOURCE_COLUMNS if c in names]
+    return apply_schema(pd.read_csv(datafile, usecols=usecols, dtype=read_dtypes(usecols)))
+
+# Define function to sort a dataframe into series:
+def build_series(df):
+    '''
+    Function to sort water quality data by determinand, sampling point and
+    date into one array per column, with the results for every Limit of
+    Detection policy. Rows without a date or result are left out.
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data (e.g. from WQDataExtractor)
+
+    RETURNS: (dictionary of numpy arrays, dataframe of series)
+    '''
+    df = add_qualifier_codes(df)
+    times = pd.to_datetime(df["sample.sampleDateTime"]).values.astype(ARRAYS["time"])
+    result = df["result"].values.astype(float)
+    codes = df[CODE_COLUMN].values.astype(ARRAYS["qualifier"])
+    keep = ~np.isnat(times) & ~np.isnan(result)
+
+    # Sort rows by determinand, sampling point and date:
+    dets = pd.Categorical(df["determinand.definition"].astype(object).values[keep])
+    sites = pd.Categorical(df["sample.samplingPoint.notation"].astype(str).values[keep])
+    order = np.lexsort((times[keep], sites.codes, dets.codes))
+    arrays = {"time": times[keep][order], "result": result[keep][order],
+              "qualifier": codes[keep][order]}
+    # Work out the results for every policy now, so the viewer can switch:
+    for policy in POLICIES:
+        arrays[policy] = apply_policy(arrays["result"], arrays["qualifier"], policy)
+    arrays = {name: values.astype(ARRAYS.get(name, "float64")) for name, values in arrays.items()}
+
+    # Each change of determinand or sampling point starts a new series:
+    keys = dets.codes[order].astype(np.int64) * max(len(sites.categories), 1) + sites.codes[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=int)
+    stops = np.r_[starts[1:], len(keys)].astype(int) if len(keys) else starts
+
+    # Describe each series, keeping the label and location of its last sample:
+    rows = df[keep].iloc[order]
+    last = rows.iloc[stops - 1]
+    series = pd.DataFrame({
+            "determinand": np.asarray(dets.categories)[dets.codes[order][starts]],
+            "unit": last["determinand.unit.label"].astype(object).values
+            if "determinand.unit.label" in rows.columns else "",
+            "notation": np.asarray(sites.categories)[sites.codes[order][starts]],
+            "label": last["sample.samplingPoint.label"].astype(object).values,
+            "easting": last["sample.samplingPoint.easting"].values,
+            "northing": last["sample.samplingPoint.northing"].values,
+            "start": starts,
+            "stop": stops})
+    return arrays, series
+
+# Define function to write the store for a dataframe:
+def write_store(df, store_dir, source=None, known=None):
+    '''
+    Function to sort water quality data into series (see build_series) and
+    write it to a store.
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data (e.g. from WQDataExtractor)
+    - store_dir: directory to write store to (created if it does not exist)
+    - source: path of data file the data came from (recorded in store)
+    - known: longitudes/latitudes of sampling points to save with each series
+      (e.g. from SiteRegistry.read_lonlat; None to leave them out)
+
+    RETURNS: dataframe of series (as 'series.csv')
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    # Mark store as incomplete until it has all been written:
+    meta_file = os.path.join(store_dir, "store.json")
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+    arrays, series = build_series(df)
+    series = add_known_lonlat(series, known)
+
+    # Write arrays and index, then record the store as complete:
+    for name, values in arrays.items():
+        np.save(os.path.join(store_dir, name + ".npy"), values)
+    series.to_csv(os.path.join(store_dir, "series.csv"), index=False, encoding="utf-8")
+    with open(meta_file, "w", encoding="utf-8") as f:
+        json.dump({"source": None if source is None else os.path.basename(source),
+                   "rows": int(len(arrays["time"])), "policies": list(POLICIES),
+                   "built": time.time()}, f)
+    return series
+
+# Define function to check if a store is up to date with a data file:
+def store_is_current(datafile, store_dir=None):
+    '''
+    Function to check that a data file has a complete store built since the
+    data file was last written, with the results for every policy.
+
+    PARAMETERS:
+    - datafile: path of .csv or .parquet data file
+    - store_dir: store directory (None for default, see store_dir_for)
+
+    RETURNS: True or False
+    '''
+    store_dir = store_dir or store_dir_for(datafile)
+    meta_file = os.path.join(store_dir, "store.json")
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return (meta.get("built", 0) >= os.path.getmtime(datafile) and
+            set(POLICIES) <= set(meta.get("policies", [])))
+
+# Define function to open the store for a data file:
+def open_store(datafile, store_dir=None, log=print):
+    '''
+    Function to open the store for a data file, building it first if there
+    is none or the data file has changed since it was built.
+
+    PARAMETERS:
+    - datafile: path of .csv or .parquet data file
+    - store_dir: store directory (None for default, see store_dir_for)
+    - log: function to report progress with
+
+    RETURNS: SeriesStore
+    '''
+    store_dir = store_dir or store_dir_for(datafile)
+    if not store_is_current(datafile, store_dir):
+        log("Building series store for {0}.".format(os.path.basename(datafile)))
+        write_store(read_source(datafile), store_dir, datafile)
+    return SeriesStore(store_dir)
+
+# Define class to read series from a store:
+class SeriesStore:
+    '''
+    Class to get the time series for each determinand and sampling point from
+    a store, as views of the memory-mapped arrays (or, for a store made with
+    from_frame, of arrays in memory).
+
+    PARAMETERS:
+    - store_dir: store directory (written by write_store)
+    '''
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = pd.read_csv(os.path.join(store_dir, "series.csv"),
+                                 dtype={"determinand": str, "unit": str, "notation": str, "label": str},
+                                 keep_default_na=False)
+        with open(os.path.join(store_dir, "store.json"), "r", encoding="utf-8") as f:
+            self.policies = json.load(f).get("policies", [])
+        self.arrays = {name: np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r")
+                       for name in list(ARRAYS) + self.policies}
+
+    @classmethod
+    def from_frame(cls, df):
+        '''
+        Function to make a store held in memory from a dataframe, without
+        writing it to disk (e.g. for one determinand's rows, see
+        DataLoader.py).
+
+        PARAMETERS:
+        - df: pandas dataframe of water quality data
+
+        RETURNS: SeriesStore
+        '''
+        store = cls.__new__(cls)
+        store.store_dir = None
+        store.arrays, store.index = build_series(df)
+        for col in ("determinand", "unit", "notation", "label"):
+            store.index[col] = store.index[col].fillna("").astype(str)
+        store.policies = list(POLICIES)
+        return store
+
+    def nbytes(self):
+        '''
+        Function to get the memory used by the arrays and index of a store
+        held in memory.
+
+        RETURNS: number of bytes
+        '''
+        return (sum(values.nbytes for values in self.arrays.values()) +
+                int(self.index.memory_usage(deep=True).sum()))
+
+    def determinands(self):
+        '''
+        Function to list the determinands in the store (most samples first).
+
+        RETURNS: list of determinand definitions
+        '''
+        rows = (self.index["stop"] - self.index["start"]).groupby(self.index["determinand"]).sum()
+        return rows.sort_values(ascending=False, kind="stable").index.tolist()
+
+    def sites(self, determinand):
+        '''
+        Function to get the sampling points with data for a determinand.
+
+        PARAMETERS:
+        - determinand: determinand definition
+
+        RETURNS: pandas dataframe (notation, label, easting, northing, unit,
+        start, stop, and lon and lat if saved with the store)
+        '''
+        return self.index[self.index["determinand"] == determinand].reset_index(drop=True)
+
+    def unit(self, determinand):
+        '''
+        Function to get the unit of a determinand.
+
+        PARAMETERS:
+        - determinand: determinand definition
+
+        RETURNS: unit label (empty if determinand not in store)
+        '''
+        units = self.sites(determinand)["unit"]
+        return units.iloc[0] if len(units) else ""
+
+    def series(self, determinand, notation, column=DEFAULT_POLICY):
+        '''
+        Function to get the series for a determinand and sampling point, as
+        views of the store (no data is copied).
+
+        PARAMETERS:
+        - determinand: determinand definition
+        - notation: sampling point notation
+        - column: array to get values from (a policy name, e.g. 'half',
+          'result' or 'qualifier')
+
+        RETURNS: (dates, values) numpy arrays (empty if no series)
+        '''
+        match = self.index[(self.index["determinand"] == determinand) &
+                           (self.index["notation"] == str(notation))]
+        start, stop = (int(match["start"].iloc[0]), int(match["stop"].iloc[0])) if len(match) else (0, 0)
+        return self.arrays["time"][start:stop], self.arrays[column][start:stop]
+
+    def traces(self, determinand, column=DEFAULT_POLICY):
+        '''
+        Function to get every sampling point's series for a determinand (e.g.
+        for PlotDownsampler.TraceResampler.from_series).
+
+        PARAMETERS:
+        - determinand: determinand definition
+        - column: array to get values from
+
+        RETURNS: list of (notation, dates, values), sorted by notation
+        '''
+        return [(row.notation, self.arrays["time"][row.start:row.stop],
+                 self.arrays[column][row.start:row.stop])
+                for row in self.sites(determinand).itertuples()]
+
+    def describe(self, determinand, column=DEFAULT_POLICY):
+        '''
+        Function to calculate descriptive statistics for each sampling point's
+        series for a determinand (as pandas describe).
+
+        PARAMETERS:
+        - determinand: determinand definition
+        - column: array to get values from
+
+        RETURNS: pandas dataframe indexed by sampling point notation
+        '''
+        stats = {name: pd.Series(y, copy=False).describe()
+                 for name, x, y in self.traces(determinand, column)}
+        stats = pd.DataFrame(stats).T
+        stats.index.name = "sample.samplingPoint.notation"
+        return stats
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+ShapefileIO.py
+
+Small pure-Python (numpy) reader and writer for ESRI shapefiles, so that the
+sampling point locations ('england_wq_locs.shp') and area of interest polygons
+can be used without ArcGIS. Only the geometry types used by this tool are
+supported: points (for sampling point locations) and polygons (for areas of
+interest, read only). Point shapefiles are written in one go from columns of
+values rather than one feature at a time.
+
+Nothing is reprojected: the tool works in British National Grid, so area of
+interest polygons whose .prj file gives any other coordinate system are
+rejected (see require_bng) rather than silently matching no sampling points.
+
+Format reference: ESRI Shapefile Technical Description (July 1998),
+https://www.esri.com/library/whitepapers/pdfs/shapefile.pdf
+"""
+
+# Import modules:
+import os
+import struct
+import datetime
+import numpy as np
+import pandas as pd
+
+# Shape type codes:
+NULL_SHAPE = 0
+POINT_TYPES = (1, 11, 21)       # Point, PointZ, PointM
+POLYGON_TYPES = (5, 15, 25)     # Polygon, PolygonZ, PolygonM
+
+# Projection file contents for British National Grid (EPSG:27700):
+BNG_WKT = ('PROJCS["British_National_Grid",GEOGCS["GCS_OSGB_1936",'
+           'DATUM["D_OSGB_1936",SPHEROID["Airy_1830",6377563.396,299.3249646]],'
+           'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],'
+           'PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",400000.0],'
+           'PARAMETER["False_Northing",-100000.0],PARAMETER["Central_Meridian",-2.0],'
+           'PARAMETER["Scale_Factor",0.9996012717],PARAMETER["Latitude_Of_Origin",49.0],'
+           'UNIT["Meter",1.0]]')
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to check that a file is a shapefile:
+def require_shapefile(shp_file):
+    '''
+    Function to check that a path is an existing .shp file (e.g. not a
+    feature class in a geodatabase, which cannot be read without ArcGIS).
+
+    PARAMETERS:
+    - shp_file: path of file
+
+    RETURNS: None
+    '''
+    if os.path.splitext(shp_file)[1].lower() != ".shp":
+        raise ValueError("{0} is not a shapefile (.shp). Export it to a shapefile "
+                         "(e.g. with the ArcGIS Feature Class To Shapefile tool) first."
+                         .format(shp_file))
+    if not os.path.isfile(shp_file):
+        raise FileNotFoundError("Shapefile {0} not found.".format(shp_file))
+
+# Define function to read the projection of a shapefile:
+def read_prj(shp_file):
+    '''
+    Function to read the projection (well-known text) from the .prj file of
+    a shapefile.
+
+    PARAMETERS:
+    - shp_file: path of .shp file
+
+    RETURNS: projection as string, or None if there is no .prj file
+    '''
+    prj_file = os.path.splitext(shp_file)[0] + ".prj"
+    if not os.path.isfile(prj_file):
+        return None
+    with open(prj_file, "r", encoding="latin-1") as f:
+        return f.read().strip()
+
+# Define function to check if a projection is British National Grid:
+def is_bng(wkt):
+    '''
+    Function to check if a projection (well-known text) is British National
+    Grid (EPSG:27700).
+
+    PARAMETERS:
+    - wkt: projection as string
+
+    RETURNS: True or False
+    '''
+    text = wkt.upper().replace(" ", "_")
+    if "27700" in text or "BRITISH_NATIONAL_GRID" in text:
+        return True
+    return (text.startswith(("PROJCS", "PROJCRS")) and "OSGB" in text and
+            "TRANSVERSE_MERCATOR" in text)
+
+# Define function to check that a shapefile uses British National Grid:
+def require_bng(shp_file):
+    '''
+    Function to check that a shapefile is in British National Grid, the
+    coordinate system of the sampling point locations. Shapefiles without a
+    .prj file are assumed to be.
+
+    PARAMETERS:
+    - shp_file: path of .shp file
+
+    RETURNS: None
+    '''
+    require_shapefile(shp_file)
+    wkt = read_prj(shp_file)
+    if wkt and not is_bng(wkt):
+        raise ValueError("{0} is not in British National Grid (EPSG:27700). Reproject it "
+                         "(e.g. with the ArcGIS Project tool) first.".format(shp_file))
+
+# Define function to read the records of a .shp file:
+def read_shp_records(shp_file):
+    '''
+    Function to read the main file header and the raw content of every record
+    in a .shp file.
+
+    PARAMETERS:
+    - shp_file: path of .shp file
+
+    RETURNS: (shape type, list of record contents as bytes)
+    '''
+    with open(shp_file, "rb") as f:
+        data = f.read()
+    file_code, = struct.unpack(">i", data[0:4])
+    if file_code != 9994:
+        raise ValueError("{0} is not a shapefile.".format(shp_file))
+    shape_type, = struct.unpack("<i", data[32:36])
+    records = []
+    offset = 100
+    while offset + 8 <= len(data):
+        # Record header: record number and content length (16-bit words):
+        number, length = struct.unpack(">ii", data[offset:offset+8])
+        records.append(data[offset+8:offset+8+2*length])
+        offset += 8 + 2 * length
+    return shape_type, records
+
+# Define function to read the attribute table of a shapefile:
+def read_dbf(dbf_file, encoding=None):
+    '''
+    Function to read the attribute table (.dbf file) of a shapefile into a
+    pandas dataframe. Numeric fields are converted to numbers; all other
+    fields are kept as text.
+
+    PARAMETERS:
+    - dbf_file: path of .dbf file
+    - encoding: text encoding (if None, taken from the .cpg file if there is
+      one, otherwise latin-1)
+
+    RETURNS: pandas dataframe (one row per record, indexed by record number,
+    i.e. the FID, with any deleted records left out)
+    '''
+    if encoding is None:
+        cpg_file = os.path.splitext(dbf_file)[0] + ".cpg"
+        encoding = "latin-1"
+        if os.path.isfile(cpg_file):
+            with open(cpg_file, "r") as f:
+                encoding = f.read().strip() or encoding
+    with open(dbf_file, "rb") as f:
+        data = f.read()
+    count, header_length, record_length = struct.unpack("<IHH", data[4:12])
+
+    # Read field descriptors (32 bytes each) until terminator byte (0x0D):
+    fields = []
+    offset = 32
+    while data[offset:offset+1] != b"\r":
+        name = data[offset:offset+11].split(b"\x00")[0].decode("latin-1")
+        field_type = data[offset+11:offset+12].decode("latin-1")
+        length = data[offset+16]
+        fields.append((name, field_type, length))
+        offset += 32
+
+    # Split fixed-width records into fields using numpy:
+    raw = np.frombuffer(data, dtype=np.uint8, count=count*record_length,
+                        offset=header_length).reshape(count, record_length)
+    table = {}
+    start = 1  # first byte of each record is the deletion flag
+    for name, field_type, length in fields:
+        values = np.ascontiguousarray(raw[:, start:start+length]).view("S{0}".format(length)).ravel()
+        values = pd.Series(np.char.decode(values, encoding, "replace")).str.strip()
+        if field_type in ("N", "F"):
+            values = pd.to_numeric(values, errors="coerce")
+        table[name] = values
+        start += length
+    df = pd.DataFrame(table, index=range(count))
+    # Drop records flagged as deleted:
+    deleted = raw[:, 0] == ord("*")
+    return df[~deleted]
+
+# Define function to read a point shapefile into a table:
+def read_points(shp_file):
+    '''
+    Function to read a point shapefile and its attributes into a pandas
+    dataframe with 'x' and 'y' columns for the point coordinates.
+
+    PARAMETERS:
+    - shp_file: path of .shp file (with .dbf alongside)
+
+    RETURNS: pandas dataframe indexed by record number (FID)
+    '''
+    shape_type, records = read_shp_records(shp_file)
+    if shape_type not in POINT_TYPES:
+        raise ValueError("{0} is not a point shapefile.".format(shp_file))
+    xy = np.full((len(records), 2), np.nan)
+    for i, content in enumerate(records):
+        if len(content) >= 20 and struct.unpack("<i", content[0:4])[0] != NULL_SHAPE:
+            xy[i] = struct.unpack("<2d", content[4:20])
+    dbf_file = os.path.splitext(shp_file)[0] + ".dbf"
+    df = read_dbf(dbf_file) if os.path.isfile(dbf_file) else pd.DataFrame(index=range(len(records)))
+    df["x"] = xy[df.index, 0]
+    df["y"] = xy[df.index, 1]
+    return df
+
+# Define function to read the polygons from a polygon shapefile:
+def read_polygons(shp_file):
+    '''
+    Function to read every polygon in a polygon shapefile. Each polygon is a
+    list of rings; outer rings and holes are both included, as the even-odd
+    rule used by SpatialIndex.py treats holes correctly without needing to
+    tell them apart. The shapefile must be in British National Grid (see
+    require_bng).
+
+    PARAMETERS:
+    - shp_file: path of .shp file
+
+    RETURNS: list of polygons, each a list of numpy arrays of (x, y) vertices
+    '''
+    require_bng(shp_file)
+    shape_type, records = read_shp_records(shp_file)
+    if shape_type not in POLYGON_TYPES:
+        raise ValueError("{0} is not a polygon shapefile.".format(shp_file))
+    polygons = []
+    for content in records:
+        if struct.unpack("<i", content[0:4])[0] == NULL_SHAPE:
+            continue
+        num_parts, num_points = struct.unpack("<ii", content[36:44])
+        parts = list(struct.unpack("<{0}i".format(num_parts), content[44:44+4*num_parts]))
+        start = 44 + 4 * num_parts
+        points = np.frombuffer(content, dtype="<f8", count=2*num_points,
+                               offset=start).reshape(num_points, 2)
+        polygons.append([points[first:last] for first, last
+                         in zip(parts, parts[1:] + [num_points])])
+    return polygons
+
+# Define function to write a point shapefile in one go:
+def write_points(shp_file, x, y, fields, prj=BNG_WKT):
+    '''
+    Function to write a point shapefile (.shp, .shx, .dbf, .cpg and .prj
+    files) from columns of values, building each file as one numpy array
+    rather than inserting points one at a time.
+
+    PARAMETERS:
+    - shp_file: path of .shp file to write
+    - x: array of x coordinates (eastings)
+    - y: array of y coordinates (northings)
+    - fields: list of (name, type, length, values) tuples for attributes,
+      where type is 'N' (whole number) or 'C' (text) and values is an array
+    - prj: projection (well-known text) to write to .prj (None to skip)
+
+    RETURNS: number of points written
+    '''
+    x = np.asarray(x, dtype="<f8")
+    y = np.asarray(y, dtype="<f8")
+    count = len(x)
+    base = os.path.splitext(shp_file)[0]
+
+    # .shp records: big-endian record header then little-endian point:
+    records = np.zeros(count, dtype=[("number", ">i4"), ("length", ">i4"),
+                                     ("type", "<i4"), ("x", "<f8"), ("y", "<f8")])
+    records["number"] = np.arange(1, count + 1)
+    records["length"] = 10  # content length in 16-bit words
+    records["type"] = 1
+    records["x"] = x
+    records["y"] = y
+    bbox = (x.min(), y.min(), x.max(), y.max()) if count else (0.0, 0.0, 0.0, 0.0)
+
+    # Define function to build the 100-byte main file header:
+    def header(file_length):
+        return (struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_length // 2) +
+                struct.pack("<2i4d4d", 1000, 1, *(bbox + (0.0, 0.0, 0.0, 0.0))))
+
+    with open(base + ".shp", "wb") as f:
+        f.write(header(100 + records.nbytes))
+        f.write(records.tobytes())
+
+    # .shx index: offset (in words) and content length of each record:
+    index = np.zeros(count, dtype=[("offset", ">i4"), ("length", ">i4")])
+    index["offset"] = (100 + np.arange(count) * records.itemsize) // 2
+    index["length"] = 10
+    with open(base + ".shx", "wb") as f:
+        f.write(header(100 + index.nbytes))
+        f.write(index.tobytes())
+
+    # .dbf attribute table: fixed-width text fields built column by column:
+    record_length = 1 + sum(length for name, field_type, length, values in fields)
+    table = np.full((count, record_length), ord(" "), dtype=np.uint8)
+    descriptors = b""
+    start = 1  # first byte of each record is the deletion flag
+    for name, field_type, length, values in fields:
+        values = pd.Series(values).reset_index(drop=True)
+        if field_type == "N":
+            text = values.map(lambda v: "" if pd.isnull(v) else str(int(v))).str.rjust(length)
+        else:
+            text = values.astype(object).fillna("").astype(str).str.ljust(length)
+        encoded = b"".join(v.encode("utf-8")[:length].ljust(length) for v in text)
+        table[:, start:start+length] = np.frombuffer(encoded, dtype=np.uint8).reshape(count, length)
+        descriptors += (name.encode("latin-1")[:10].ljust(11, b"\x00") + field_type.encode("latin-1") +
+                        b"\x00" * 4 + bytes([length, 0]) + b"\x00" * 14)
+        start += length
+    today = datetime.date.today()
+    with open(base + ".dbf", "wb") as f:
+        f.write(struct.pack("<4BIHH20x", 3, today.year - 1900, today.month, today.day,
+                            count, 32 + len(descriptors) + 1, record_length))
+        f.write(descriptors + b"\r")
+        f.write(table.tobytes())
+        f.write(b"\x1a")
+    with open(base + ".cpg", "w") as f:
+        f.write("UTF-8")
+
+    if prj is not None:
+        with open(base + ".prj", "w") as f:
+            f.write(prj)
+    return count
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+SiteGeometry.py
+
+Sampling point locations for mapping. Builds a table with one row per
+sampling point (notation, label, easting, northing, longitude, latitude),
+converting all the British National Grid coordinates to longitude/latitude
+(WGS84, as used by folium) at once with numpy, and adds the sampling points
+to a folium map as clustered markers so that maps of thousands of sampling
+points stay quick to draw.
+
+Each sampling point's notation, label and coordinates are kept together in
+the same row, so sampling points which share coordinates (or coordinates
+which appear in more than one sampling point) are never mismatched. The
+sampling point registry (see SiteRegistry.py) already holds the
+longitude/latitude of every sampling point, so these are used where they are
+known and only the other sampling points are converted.
+
+The conversion uses the formulae from Ordnance Survey (2018) 'A guide to
+coordinate systems in Great Britain': inverse Transverse Mercator projection
+on the Airy 1830 ellipsoid, then a Helmert transformation from OSGB36 to
+WGS84 (accurate to within about 5 metres, which is plenty for plotting).
+"""
+
+# Import modules:
+import numpy as np
+import pandas as pd
+
+# National Grid projection constants (Airy 1830 ellipsoid):
+AIRY_A, AIRY_B = 6377563.396, 6356256.909
+F0 = 0.9996012717
+LAT0, LON0 = np.radians(49.0), np.radians(-2.0)
+E0, N0 = 400000.0, -100000.0
+
+# WGS84 (GRS80) ellipsoid:
+WGS84_A, WGS84_B = 6378137.0, 6356752.3141
+
+# Helmert transformation from OSGB36 to WGS84 (metres, ppm, arc seconds):
+TX, TY, TZ = 446.448, -125.157, 542.060
+SCALE = -20.4894e-6
+RX, RY, RZ = np.radians(np.array([0.1502, 0.2470, 0.8421]) / 3600)
+
+# Columns of the site table, and the data columns they come from:
+SITE_COLUMNS = {"sample.samplingPoint.notation": "notation",
+                "sample.samplingPoint.label": "label",
+                "sample.samplingPoint.easting": "easting",
+                "sample.samplingPoint.northing": "northing"}
+
+# Number of sampling points above which the faster (canvas drawn) marker
+# cluster layer is used:
+FAST_CLUSTER_SIZE = 500
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to convert National Grid coordinates to longitude/latitude:
+def bng_to_lonlat(easting, northing):
+    '''
+    Function to convert British National Grid eastings/northings into WGS84
+    longitudes/latitudes, working on whole arrays at once.
+
+    PARAMETERS:
+    - easting: array of eastings
+    - northing: array of northings
+
+    RETURNS: (array of longitudes, array of latitudes) in degrees
+    '''
+    E = np.asarray(easting, dtype=float)
+    N = np.asarray(northing, dtype=float)
+    a, b = AIRY_A, AIRY_B
+    e2 = 1 - (b * b) / (a * a)
+    n = (a - b) / (a + b)
+
+    # Define function for meridional arc:
+    def meridional_arc(lat):
+        dlat, slat = lat - LAT0, lat + LAT0
+        return b * F0 * ((1 + n + 1.25 * n**2 + 1.25 * n**3) * dlat
+                         - (3 * n + 3 * n**2 + 2.625 * n**3) * np.sin(dlat) * np.cos(slat)
+                         + (1.875 * n**2 + 1.875 * n**3) * np.sin(2 * dlat) * np.cos(2 * slat)
+                         - (35.0 / 24) * n**3 * np.sin(3 * dlat) * np.cos(3 * slat))
+
+    # Latitude where meridional arc matches northing (iterated to < 0.01 mm):
+    lat = (N - N0) / (a * F0) + LAT0
+    for i in range(20):
+        remainder = N - N0 - meridional_arc(lat)
+        if np.all(np.abs(remainder[np.isfinite(remainder)]) < 1e-5):
+            break
+        lat = lat + remainder / (a * F0)
+
+    sin_lat, tan_lat = np.sin(lat), np.tan(lat)
+    sec_lat = 1 / np.cos(lat)
+    nu = a * F0 / np.sqrt(1 - e2 * sin_lat**2)
+    rho = a * F0 * (1 - e2) / (1 - e2 * sin_lat**2) ** 1.5
+    eta2 = nu / rho - 1
+    t2 = tan_lat**2
+    VII = tan_lat / (2 * rho * nu)
+    VIII = tan_lat / (24 * rho * nu**3) * (5 + 3 * t2 + eta2 - 9 * t2 * eta2)
+    IX = tan_lat / (720 * rho * nu**5) * (61 + 90 * t2 + 45 * t2**2)
+    X = sec_lat / nu
+    XI = sec_lat / (6 * nu**3) * (nu / rho + 2 * t2)
+    XII = sec_lat / (120 * nu**5) * (5 + 28 * t2 + 24 * t2**2)
+    XIIA = sec_lat / (5040 * nu**7) * (61 + 662 * t2 + 1320 * t2**2 + 720 * t2**3)
+    dE = E - E0
+    lat36 = lat - VII * dE**2 + VIII * dE**4 - IX * dE**6
+    lon36 = LON0 + X * dE - XI * dE**3 + XII * dE**5 - XIIA * dE**7
+
+    # OSGB36 latitude/longitude to cartesian coordinates:
+    nu36 = a / np.sqrt(1 - e2 * np.sin(lat36)**2)
+    x = nu36 * np.cos(lat36) * np.cos(lon36)
+    y = nu36 * np.cos(lat36) * np.sin(lon36)
+    z = (1 - e2) * nu36 * np.sin(lat36)
+
+    # Helmert transformation to WGS84:
+    x2 = TX + (1 + SCALE) * x - RZ * y + RY * z
+    y2 = TY + RZ * x + (1 + SCALE) * y - RX * z
+    z2 = TZ - RY * x + RX * y + (1 + SCALE) * z
+
+    # Cartesian coordinates to WGS84 latitude/longitude:
+    e2w = 1 - (WGS84_B**2) / (WGS84_A**2)
+    p = np.sqrt(x2**2 + y2**2)
+    lat84 = np.arctan2(z2, p * (1 - e2w))
+    for i in range(10):
+        nu84 = WGS84_A / np.sqrt(1 - e2w * np.sin(lat84)**2)
+        lat84 = np.arctan2(z2 + e2w * nu84 * np.sin(lat84), p)
+    lon84 = np.arctan2(y2, x2)
+    return np.degrees(lon84), np.degrees(lat84)
+
+# Define function to add known longitudes/latitudes to a table of sites:
+def add_known_lonlat(sites, known):
+    '''
+    Function to add the longitudes/latitudes already worked out for sampling
+    points (e.g. by the sampling point registry) to a table of sampling
+    points. They are only used where the easting and northing are the same.
+
+    PARAMETERS:
+    - sites: dataframe with notation, easting and northing columns
+    - known: dataframe with notation, easting, northing, lon and lat columns
+      (or None)
+
+    RETURNS: copy of sites with lon and lat columns (NaN where not known)
+    '''
+    sites = sites.copy()
+    sites["lon"], sites["lat"] = np.nan, np.nan
+    if known is None or not len(sites):
+        return sites
+    known = known.assign(notation=known["notation"].astype(str)).drop_duplicates(
+            "notation", keep="last").set_index("notation")
+    found = known.reindex(sites["notation"].astype(str).values)
+    same = ((found["easting"].values == sites["easting"].values) &
+            (found["northing"].values == sites["northing"].values))
+    sites.loc[same, "lon"] = found["lon"].values[same]
+    sites.loc[same, "lat"] = found["lat"].values[same]
+    return sites
+
+# Define function to build the site table from measurements:
+def site_table(df):
+    '''
+    Function to build a table with one row per sampling point from a
+    dataframe of measurements (or of sampling points), with longitude and
+    latitude columns added. Longitudes/latitudes already in df (e.g. from the
+    registry, see add_known_lonlat) are kept, and only the sampling points
+    without them are converted.
+
+    PARAMETERS:
+    - df: dataframe with WQA sampling point columns (see SITE_COLUMNS) or
+      notation, label, easting and northing columns (and optionally lon and
+      lat columns)
+
+    RETURNS: pandas dataframe (notation, label, easting, northing, lon, lat)
+    '''
+    df = df.rename(columns=SITE_COLUMNS)
+    columns = list(SITE_COLUMNS.values()) + [c for c in ("lon", "lat") if c in df.columns]
+    # Keep each sampling point's own label and coordinates together:
+    sites = df[columns].drop_duplicates("notation", keep="last")
+    sites = sites.dropna(subset=["easting", "northing"]).reset_index(drop=True)
+    sites["notation"] = sites["notation"].astype(str)
+    sites["label"] = sites["label"].astype(object).fillna("").astype(str)
+    for col in ("lon", "lat"):
+        sites[col] = pd.to_numeric(sites[col], errors="coerce") if col in sites.columns else np.nan
+    missing = (sites["lon"].isna() | sites["lat"].isna()).values
+    if missing.any():
+        lon, lat = bng_to_lonlat(sites["easting"].values[missing], sites["northing"].values[missing])
+        sites.loc[missing, "lon"] = lon
+        sites.loc[missing, "lat"] = lat
+    return sites
+
+# Define function to add sampling point markers to a folium map:
+def add_site_markers(folium_map, sites, fast_size=FAST_CLUSTER_SIZE):
+    '''
+    Function to add sampling points to a folium map as a marker cluster
+    layer, with the notation and label of each sampling point as its popup.
+    For large numbers of sampling points a FastMarkerCluster is used, which
+    builds the markers in the browser rather than writing each one into the
+    map's .html file.
+
+    PARAMETERS:
+    - folium_map: folium.Map to add markers to
+    - sites: site table (from site_table)
+    - fast_size: number of sampling points above which FastMarkerCluster is
+      used
+
+    RETURNS: marker cluster layer
+    '''
+    from folium.plugins import MarkerCluster, FastMarkerCluster
+    popups = (sites["notation"] + ": " + sites["label"]).tolist()
+    if len(sites) > fast_size:
+        callback = ("function (row) {"
+                    "var marker = L.marker(new L.LatLng(row[0], row[1]));"
+                    "marker.bindPopup(row[2]);"
+                    "return marker;}")
+        data = list(zip(sites["lat"].tolist(), sites["lon"].tolist(), popups))
+        layer = FastMarkerCluster(data, callback=callback)
+    else:
+        layer = MarkerCluster(locations=list(zip(sites["lat"].tolist(), sites["lon"].tolist())),
+                              popups=popups)
+    layer.add_to(folium_map)
+    # Zoom map to the sampling points:
+    if len(sites):
+        folium_map.fit_bounds([[sites["lat"].min(), sites["lon"].min()],
+                               [sites["lat"].max(), sites["lon"].max()]])
+    return layer
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+SiteIndex.py
+
+Side index for the 'alldata_<area>.csv' files in the Stage 1 archive. For each
+sampling point ('sample.samplingPoint.notation') and year, the index records
+the byte ranges of the file which hold its rows and the first and last sample
+dates in each range:
+
+    alldata_3-35.csv      - archive file
+    alldata_3-35.csv.idx  - index (.json) for archive file
+
+Rows for the same sampling point which are close together in the file are
+grouped into one range, so the index stays small even if the rows for
+different sampling points are interleaved. WQDataExtractor.py (through
+ArchiveQuery.py) uses the index to read only the ranges for the selected
+sampling points and years instead of the whole file. Ranges can contain rows
+for other sampling points, so the rows read are always filtered afterwards.
+
+The combined files are made by appending the yearly files in year order, so
+each year is also one part of the file. The index records these year
+partitions (byte range, row count and first and last sample dates), so that
+a query with only a date range reads just the years overlapping it, and
+ranges and partitions outside the date range of a query are skipped.
+
+The index stores the size and modification time of the file it was built
+from and is ignored if the file has changed since.
+"""
+
+# Import modules:
+import os
+import io
+import csv
+import json
+
+# Rows for the same sampling point less than this many bytes apart are put in
+# the same range:
+MAX_GAP = 64 * 1024
+
+# Largest piece (in bytes) of a range to read and parse at once:
+MAX_READ = 32 * 1024 * 1024
+
+# Number of characters of sample dates kept in the index (to the second):
+DATE_LENGTH = 19
+
+# Extension of index files:
+INDEX_EXTENSION = ".idx"
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the index filename for an archive file:
+def index_filename(csv_file):
+    '''
+    Function to get the filename of the index for an archive .csv file.
+
+    PARAMETERS:
+    - csv_file: path of archive .csv file
+
+    RETURNS: path of index file
+    '''
+    return csv_file + INDEX_EXTENSION
+
+# Define function to split a line of a .csv file into values:
+def split_line(line):
+    '''
+    Function to split one line (record) of a .csv file into values, only using
+    the (slower) csv module if the line contains quoted values.
+
+    PARAMETERS:
+    - line: line of file as str (may hold line breaks within quoted values)
+
+    RETURNS: list of values
+    '''
+    if '"' in line:
+        return next(csv.reader([line]))
+    return line.rstrip("\r\n").split(",")
+
+# Define function to build the index for an archive file:
+def build_index(csv_file, max_gap=MAX_GAP):
+    '''
+    Function to scan an archive .csv file once and write its sampling point
+    index alongside it.
+
+    PARAMETERS:
+    - csv_file: path of archive .csv file
+    - max_gap: rows for the same sampling point less than this many bytes
+      apart are put in the same range
+
+    RETURNS: index as dictionary
+    '''
+    sites = {}
+    partitions = {}
+    with open(csv_file, "rb") as f:
+        header_line = f.readline()
+        columns = split_line(header_line.decode("utf-8-sig"))
+        site_col = columns.index("sample.samplingPoint.notation")
+        date_col = columns.index("sample.sampleDateTime")
+        offset = len(header_line)
+        for line in f:
+            # A quoted value can hold a line break, so keep adding lines until
+            # the quotes are balanced (the record is complete):
+            if line.count(b'"') % 2:
+                while line.count(b'"') % 2:
+                    more = f.readline()
+                    if not more:
+                        break
+                    line += more
+            values = split_line(line.decode("utf-8"))
+            site = values[site_col]
+            date = values[date_col][:DATE_LENGTH]
+            year = date[:4]
+            end = offset + len(line)
+            ranges = sites.setdefault(site, [])
+            # Extend the last range for this site and year if it is close by:
+            if ranges and ranges[-1][3] == year and offset - ranges[-1][1] <= max_gap:
+                ranges[-1][1] = end
+                ranges[-1][2] += 1
+                ranges[-1][4] = min(ranges[-1][4], date)
+                ranges[-1][5] = max(ranges[-1][5], date)
+            else:
+                ranges.append([offset, end, 1, year, date, date])
+            # Extend the partition for this year:
+            partition = partitions.get(year)
+            if partition is None:
+                partitions[year] = [offset, end, 1, date, date]
+            else:
+                partition[1] = end
+                partition[2] += 1
+                partition[3] = min(partition[3], date)
+                partition[4] = max(partition[4], date)
+            offset = end
+
+    stat = os.stat(csv_file)
+    index = {"file": os.path.basename(csv_file),
+             "size": stat.st_size,
+             "mtime": stat.st_mtime,
+             "header": header_line.decode("utf-8-sig").rstrip("\r\n"),
+             "sites": sites,
+             "partitions": partitions}
+    with open(index_filename(csv_file), "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    return index
+
+# Define function to load the index for an archive file:
+def load_index(csv_file):
+    '''
+    Function to load the index for an archive .csv file, if there is one and
+    it is up to date.
+
+    PARAMETERS:
+    - csv_file: path of archive .csv file
+
+    RETURNS: index as dictionary, or None if there is no up-to-date index
+    '''
+    filename = index_filename(csv_file)
+    if not os.path.isfile(filename) or not os.path.isfile(csv_file):
+        return None
+    with open(filename, "r", encoding="utf-8") as f:
+        index = json.load(f)
+    stat = os.stat(csv_file)
+    if index.get("size") != stat.st_size or index.get("mtime") != stat.st_mtime:
+        return None
+    return index
+
+# Define function to check whether a range of the file overlaps a date range:
+def in_window(year, first, last, start_date=None, end_date=None):
+    '''
+    Function to check whether a range of an archive file (or a year
+    partition) could hold rows within a date range. Ranges without valid
+    dates are kept in case they match.
+
+    PARAMETERS:
+    - year: year of range (as text)
+    - first: first sample date in range (ISO text, None if not indexed)
+    - last: last sample date in range (ISO text, None if not indexed)
+    - start_date: datetime; only rows after this are wanted (None for no limit)
+    - end_date: datetime; only rows before this are wanted (None for no limit)
+
+    RETURNS: True or False
+    '''
+    if not year.isdigit():
+        return True
+    # Older indexes only hold the year of each range:
+    if first is None or not first[:4].isdigit() or not last[:4].isdigit():
+        return ((start_date is None or int(year) >= start_date.year) and
+                (end_date is None or int(year) <= end_date.year))
+    return ((start_date is None or last > start_date.isoformat()) and
+            (end_date is None or first < end_date.isoformat()))
+
+# Define function to merge byte ranges which overlap or touch:
+def merge_ranges(ranges):
+    '''
+    Function to sort byte ranges and merge any which overlap or touch.
+
+    PARAMETERS:
+    - ranges: list of (start, end) byte offsets
+
+    RETURNS: sorted list of (start, end) byte offsets
+    '''
+    ranges = sorted(ranges)
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+# Define function to work out which byte ranges to read:
+def select_ranges(index, locs, start_date=None, end_date=None):
+    '''
+    Function to get the byte ranges of an archive file holding rows for the
+    selected sampling points (within a date range), merging any which overlap
+    or touch.
+
+    PARAMETERS:
+    - index: index dictionary (from load_index or build_index)
+    - locs: list of sampling point notations
+    - start_date: datetime; only rows after this are wanted (None for no limit)
+    - end_date: datetime; only rows before this are wanted (None for no limit)
+
+    RETURNS: sorted list of (start, end) byte offsets
+    '''
+    ranges = []
+    for loc in set(locs):
+        for r in index["sites"].get(loc, []):
+            first, last = (r[4], r[5]) if len(r) > 4 else (None, None)
+            if in_window(r[3], first, last, start_date, end_date):
+                ranges.append((r[0], r[1]))
+    return merge_ranges(ranges)
+
+# Define function to work out which year partitions to read:
+def select_partitions(index, start_date=None, end_date=None):
+    '''
+    Function to get the byte ranges of the year partitions of an archive file
+    which overlap a date range.
+
+    PARAMETERS:
+    - index: index dictionary (from load_index or build_index)
+    - start_date: datetime; only rows after this are wanted (None for no limit)
+    - end_date: datetime; only rows before this are wanted (None for no limit)
+
+    RETURNS: sorted list of (start, end) byte offsets, or None if the index
+    has no partitions (built by an older version)
+    '''
+    if "partitions" not in index:
+        return None
+    return merge_ranges([(start, end) for year, (start, end, rows, first, last)
+                         in index["partitions"].items()
+                         if in_window(year, first, last, start_date, end_date)])
+
+# Define function to read the selected ranges of an archive file:
+def read_ranges(csv_file, index, ranges, max_read=MAX_READ):
+    '''
+    Generator to read byte ranges of an archive .csv file, yielding each
+    piece (with the header line in front) ready to be parsed by pandas.
+    Ranges longer than max_read are split at line ends (not within quoted
+    values).
+
+    PARAMETERS:
+    - csv_file: path of archive .csv file
+    - index: index dictionary
+    - ranges: list of (start, end) byte offsets (from select_ranges)
+    - max_read: largest piece to read at once
+
+    YIELDS: io.BytesIO containing header line and rows
+    '''
+    header = (index["header"] + "\n").encode("utf-8")
+    with open(csv_file, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(max_read, end - start))
+                if not data:
+                    break
+                # Cut piece at last complete line (unless it is the last piece),
+                # skipping line breaks inside quoted values:
+                if start + len(data) < end:
+                    cut = data.rfind(b"\n")
+                    while cut >= 0 and data.count(b'"', 0, cut) % 2:
+                        cut = data.rfind(b"\n", 0, cut)
+                    cut += 1
+                    if cut > 0:
+                        f.seek(start + cut)
+                        data = data[:cut]
+                start += len(data)
+                yield io.BytesIO(header + data)
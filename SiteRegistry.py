@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+SiteRegistry.py
+
+Registry of every EA water quality sampling point, kept up to date by
+CSVDownloader.py as each year/area dataset is downloaded. For each sampling
+point the registry holds its notation, label, easting, northing, longitude,
+latitude, EA area, first and last sample dates and number of rows.
+
+Each downloaded dataset is summarised once (only the five columns needed are
+read, in the same pass over the file as the statistics cube when both are
+kept, see BatchDownloader.summarise_dataset) and the summary is stored under
+its (area, year) key, replacing any earlier summary for that dataset, so
+re-downloading the current year does not double count. Longitudes/latitudes
+(for mapping, see SiteGeometry.py) are worked out once when each dataset is
+summarised and saved with the registry, so maps do not need to convert
+coordinates again. The national sampling point
+table is then a cheap aggregation of the stored summaries, and
+'england_wq_locs.shp' can be written from it without a second pass over the
+archive (see CSVtoSHP.py for the original method).
+
+The registry is saved as a .csv file of per-(area, year) summaries, kept
+alongside the download manifest so that it persists between refreshes.
+"""
+
+# Import modules:
+import os
+import threading
+import numpy as np
+import pandas as pd
+from ShapefileIO import write_points
+from SiteGeometry import bng_to_lonlat
+
+# Columns to read from each downloaded dataset:
+SOURCE_COLUMNS = {"sample.samplingPoint.notation": "notation",
+                  "sample.samplingPoint.label": "label",
+                  "sample.samplingPoint.easting": "easting",
+                  "sample.samplingPoint.northing": "northing",
+                  "sample.sampleDateTime": "date"}
+
+# Columns of the saved registry file:
+REGISTRY_COLUMNS = ["area", "year", "notation", "label", "easting", "northing",
+                    "lon", "lat", "first_sample", "last_sample", "rows"]
+
+# Columns to read as text:
+TEXT_COLUMNS = ["sample.samplingPoint.notation", "sample.samplingPoint.label"]
+
+# Number of rows to read from a dataset at a time:
+CHUNK_SIZE = 500000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to combine summaries of the same sampling points:
+def merge_summaries(summary):
+    '''
+    Function to combine rows of a sampling point summary which refer to the
+    same sampling point, keeping the label and coordinates from the most
+    recent sample.
+
+    PARAMETERS:
+    - summary: dataframe with notation, label, easting, northing, lon, lat,
+      first_sample, last_sample and rows columns (plus optional area)
+
+    RETURNS: dataframe with one row per notation
+    '''
+    summary = summary.sort_values("last_sample", kind="stable")
+    aggregations = {"label": "last", "easting": "last", "northing": "last",
+                    "lon": "last", "lat": "last", "first_sample": "min", "last_sample": "max", "rows": "sum"}
+    if "area" in summary.columns:
+        aggregations["area"] = "last"
+    return summary.groupby("notation", sort=True).agg(aggregations).reset_index()
+
+# Define function to summarise the sampling points in part of a dataset:
+def summarise_chunk(chunk):
+    '''
+    Function to summarise the sampling points in one chunk of a downloaded
+    dataset.
+
+    PARAMETERS:
+    - chunk: dataframe of measurements (with at least SOURCE_COLUMNS)
+
+    RETURNS: dataframe with one row per sampling point in chunk
+    '''
+    chunk = chunk[list(SOURCE_COLUMNS)].rename(columns=SOURCE_COLUMNS)
+    # ISO dates ('2019-01-31T10:00:00') sort correctly as text:
+    chunk["date"] = chunk["date"].astype(str)
+    return chunk.groupby("notation", sort=False).agg(
+            label=("label", "last"), easting=("easting", "last"),
+            northing=("northing", "last"), first_sample=("date", "min"),
+            last_sample=("date", "max"), rows=("date", "size")).reset_index()
+
+# Define function to combine the chunk summaries of a dataset:
+def combine_chunks(partials):
+    '''
+    Function to combine the summaries of each chunk of a downloaded dataset
+    into one summary, adding longitudes/latitudes.
+
+    PARAMETERS:
+    - partials: list of dataframes from summarise_chunk
+
+    RETURNS: dataframe with one row per sampling point
+    '''
+    if not partials:
+        return pd.DataFrame(columns=REGISTRY_COLUMNS[2:])
+    summary = pd.concat(partials, ignore_index=True)
+    summary["lon"], summary["lat"] = bng_to_lonlat(summary["easting"].values,
+                                                   summary["northing"].values)
+    return merge_summaries(summary)
+
+# Define function to summarise one downloaded dataset:
+def summarise_batch(file, chunksize=CHUNK_SIZE):
+    '''
+    Function to summarise the sampling points in one downloaded dataset,
+    reading it in chunks.
+
+    PARAMETERS:
+    - file: path of yearly .csv (or .csv.gz) file
+    - chunksize: number of rows to read at a time
+
+    RETURNS: dataframe with one row per sampling point
+    '''
+    return combine_chunks([summarise_chunk(chunk) for chunk in
+                           pd.read_csv(file, usecols=list(SOURCE_COLUMNS), chunksize=chunksize,
+                                       dtype={c: str for c in TEXT_COLUMNS})])
+
+# Define function to get the sampling point table exported with an archive:
+def archive_sites_file(wqArchive):
+    '''
+    Function to get the location of the sampling point table exported from
+    the registry with an archive (see CSVDownloader.py), which is kept next
+    to the archive directory (e.g. 'csv_downloaded_<date>/shp/england_wq_locs.csv').
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+
+    RETURNS: path of .csv file
+    '''
+    return os.path.join(os.path.dirname(os.path.normpath(os.path.abspath(wqArchive))),
+                        "shp", "england_wq_locs.csv")
+
+# Define function to read the longitudes/latitudes held by the registry:
+def read_lonlat(csv_file):
+    '''
+    Function to read the longitude/latitude of each sampling point from a
+    sampling point table exported from the registry (see SiteRegistry.export).
+
+    PARAMETERS:
+    - csv_file: path of exported .csv file
+
+    RETURNS: dataframe (notation, easting, northing, lon, lat), or None if
+    there is no file or it has no longitudes/latitudes (exported by an older
+    version)
+    '''
+    if not os.path.isfile(csv_file):
+        return None
+    sites = pd.read_csv(csv_file, dtype={"notation": str})
+    if "lon" not in sites.columns or "lat" not in sites.columns:
+        return None
+    return sites[["notation", "easting", "northing", "lon", "lat"]]
+
+# Define function to write sampling points to a point shapefile:
+def write_sites_shapefile(shp_file, notation, label, easting, northing):
+    '''
+    Function to write sampling points to a point shapefile (British National
+    Grid) with the same 'Id', 'easting', 'northing', 'notation' and 'label'
+    fields as the shapefiles made by CSVtoSHP.py.
+
+    PARAMETERS:
+    - shp_file: path of .shp file to write
+    - notation: array of sampling point notations
+    - label: array of sampling point labels
+    - easting: array of eastings
+    - northing: array of northings
+
+    RETURNS: number of points written
+    '''
+    fields = [("Id", "N", 6, np.zeros(len(notation))),
+              ("easting", "N", 6, easting),
+              ("northing", "N", 6, northing),
+              ("notation", "C", 50, notation),
+              ("label", "C", 254, label)]
+    return write_points(shp_file, easting, northing, fields)
+
+# Define class to hold the sampling point registry:
+class SiteRegistry:
+    '''
+    Class to load, update, save and export the sampling point registry.
+    Updates are thread-safe so datasets can be added by download workers.
+
+    PARAMETERS:
+    - path: location of registry .csv file (created if it does not exist)
+    '''
+    # Columns read from each dataset (see BatchDownloader.summarise_dataset):
+    source_columns = list(SOURCE_COLUMNS)
+    text_columns = TEXT_COLUMNS
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.batches = {}
+        # Read existing registry and split it back into per-dataset summaries:
+        if os.path.isfile(path):
+            df = pd.read_csv(path, dtype={"area": str, "notation": str, "label": str})
+            # Registries saved before longitudes/latitudes were added:
+            if "lon" not in df.columns:
+                df["lon"], df["lat"] = bng_to_lonlat(df["easting"].values, df["northing"].values)
+            for (area, year), summary in df.groupby(["area", "year"], sort=False):
+                self.batches[(area, int(year))] = summary.drop(columns=["area", "year"])
+
+    def has_batch(self, area_notation, year):
+        '''
+        Function to check if a dataset has been added to the registry.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: True if dataset is in registry
+        '''
+        with self._lock:
+            return (str(area_notation), int(year)) in self.batches
+
+    def add_batch(self, file, area_notation, year):
+        '''
+        Function to summarise a downloaded dataset and add it to the registry,
+        replacing any earlier summary of the same dataset.
+
+        PARAMETERS:
+        - file: path of yearly .csv file
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: number of sampling points in dataset
+        '''
+        summary = summarise_batch(file)
+        with self._lock:
+            self.batches[(str(area_notation), int(year))] = summary
+        return len(summary)
+
+    def summarise_chunk(self, chunk, area_notation):
+        '''
+        Function to summarise one chunk of a dataset, to be added to the
+        registry with add_chunks once the whole dataset has been read.
+
+        PARAMETERS:
+        - chunk: dataframe of measurements
+        - area_notation: notation of EA operational area
+
+        RETURNS: dataframe with one row per sampling point in chunk
+        '''
+        return summarise_chunk(chunk)
+
+    def add_chunks(self, partials, area_notation, year):
+        '''
+        Function to add a dataset to the registry from the summaries of its
+        chunks, replacing any earlier summary of the same dataset.
+
+        PARAMETERS:
+        - partials: list of dataframes from summarise_chunk
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: number of sampling points in dataset
+        '''
+        summary = combine_chunks(partials)
+        with self._lock:
+            self.batches[(str(area_notation), int(year))] = summary
+        return len(summary)
+
+    def sites(self):
+        '''
+        Function to get the national sampling point table from the registry.
+
+        RETURNS: dataframe with one row per sampling point (notation, area,
+        label, easting, northing, lon, lat, first_sample, last_sample, rows)
+        '''
+        with self._lock:
+            frames = [summary.assign(area=key[0]) for key, summary in self.batches.items()]
+        if not frames:
+            return pd.DataFrame(columns=["notation", "area"] + REGISTRY_COLUMNS[3:])
+        sites = merge_summaries(pd.concat(frames, ignore_index=True))
+        return sites[["notation", "area"] + REGISTRY_COLUMNS[3:]]
+
+    def save(self):
+        '''
+        Function to save the registry to disk.
+
+        RETURNS: None
+        '''
+        with self._lock:
+            frames = [summary.assign(area=key[0], year=key[1])
+                      for key, summary in sorted(self.batches.items())]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        df = df.reindex(columns=REGISTRY_COLUMNS)
+        # Write to a temporary file then rename, so that the registry is never
+        # left half-written:
+        tmp = self.path + ".tmp"
+        df.to_csv(tmp, index=False, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def export(self, shp_file, csv_file=None):
+        '''
+        Function to write the national sampling point table to a point
+        shapefile (e.g. 'england_wq_locs.shp') and optionally a .csv file.
+        Sampling points without coordinates are left out of the shapefile.
+
+        PARAMETERS:
+        - shp_file: path of .shp file to write
+        - csv_file: path of .csv file to write (or None)
+
+        RETURNS: number of sampling points written to shapefile
+        '''
+        sites = self.sites()
+        if csv_file is not None:
+            sites.to_csv(csv_file, index=False, encoding="utf-8")
+        sites = sites.dropna(subset=["easting", "northing"])
+        return write_sites_shapefile(shp_file, sites["notation"].values, sites["label"].values,
+                                     sites["easting"].values, sites["northing"].values)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+SpatialIndex.py
+
+Point-in-polygon engine used by WQLocsIdentifier.py to find the sampling
+points within an area of interest without ArcGIS (replacing Clip_analysis).
+
+The sampling point eastings/northings are binned into a regular grid so that
+only points in grid cells overlapping the bounding box of the area of interest
+are considered. Those candidates are then tested against the polygon edges
+with numpy using the even-odd (ray casting) rule: points are sorted by
+northing so each edge only has to be tested against the points in its own
+band of northings.
+
+Example:
+    sites = read_points("england_wq_locs.shp")
+    inside = identify_sites(sites, "area_of_interest.shp")
+"""
+
+# Import modules:
+import numpy as np
+from ShapefileIO import read_points, read_polygons, require_bng
+
+# Default size of grid cells (in metres, British National Grid):
+CELL_SIZE = 5000.0
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define class to hold the grid index of points:
+class PointGrid:
+    '''
+    Class to index points in a regular grid so that the points within a
+    bounding box can be found without testing every point.
+
+    PARAMETERS:
+    - x: numpy array of x coordinates (eastings)
+    - y: numpy array of y coordinates (northings)
+    - cell_size: width and height of grid cells
+    '''
+    def __init__(self, x, y, cell_size=CELL_SIZE):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cell_size = cell_size
+        valid = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        if len(valid) == 0:
+            self.x0 = self.y0 = 0.0
+            self.ncols = self.nrows = 1
+            self.order = valid
+            self.starts = np.zeros(2, dtype=int)
+            return
+        self.x0, self.y0 = self.x[valid].min(), self.y[valid].min()
+        cols = ((self.x[valid] - self.x0) // cell_size).astype(int)
+        rows = ((self.y[valid] - self.y0) // cell_size).astype(int)
+        self.ncols, self.nrows = cols.max() + 1, rows.max() + 1
+        # Sort points by cell so each cell's points are one slice of 'order':
+        cells = rows * self.ncols + cols
+        sort = np.argsort(cells, kind="stable")
+        self.order = valid[sort]
+        self.starts = np.searchsorted(cells[sort], np.arange(self.ncols * self.nrows + 1))
+
+    def query_bbox(self, xmin, ymin, xmax, ymax):
+        '''
+        Function to find the points inside a bounding box.
+
+        PARAMETERS:
+        - xmin, ymin, xmax, ymax: bounding box
+
+        RETURNS: numpy array of point indices
+        '''
+        c0 = max(int((xmin - self.x0) // self.cell_size), 0)
+        c1 = min(int((xmax - self.x0) // self.cell_size), self.ncols - 1)
+        r0 = max(int((ymin - self.y0) // self.cell_size), 0)
+        r1 = min(int((ymax - self.y0) // self.cell_size), self.nrows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.array([], dtype=int)
+        # Each row of cells is one contiguous slice:
+        parts = [self.order[self.starts[r * self.ncols + c0]:self.starts[r * self.ncols + c1 + 1]]
+                 for r in range(r0, r1 + 1)]
+        idx = np.concatenate(parts)
+        x, y = self.x[idx], self.y[idx]
+        return idx[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
+
+# Define function to test which points are inside a polygon:
+def points_in_polygon(x, y, rings):
+    '''
+    Function to test which points are inside a polygon using the even-odd
+    rule (a point is inside if a ray from it crosses the polygon's edges an
+    odd number of times), so holes are handled automatically.
+
+    PARAMETERS:
+    - x: numpy array of x coordinates
+    - y: numpy array of y coordinates
+    - rings: list of numpy arrays of (x, y) vertices (outer rings and holes)
+
+    RETURNS: numpy boolean array (True if point is inside)
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return inside
+    # Sort points by y so that the points level with each edge are a slice:
+    order = np.argsort(y, kind="stable")
+    ys = y[order]
+    xs = x[order]
+    crossings = np.zeros(len(x), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        lo = np.searchsorted(ys, np.minimum(y1, y2), side="left")
+        hi = np.searchsorted(ys, np.maximum(y1, y2), side="left")
+        # Only edges with points level with them (horizontal edges never do):
+        for i in np.flatnonzero(hi > lo):
+            py = ys[lo[i]:hi[i]]
+            # x coordinate where edge crosses each point's northing:
+            cross_x = x1[i] + (py - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+            crossings[lo[i]:hi[i]] ^= xs[lo[i]:hi[i]] < cross_x
+    inside[order] = crossings
+    return inside
+
+# Define function to find the points inside any of a set of polygons:
+def points_in_polygons(grid, polygons):
+    '''
+    Function to find the indexed points inside any of a list of polygons,
+    using each polygon's bounding box to pick candidate points from the grid.
+
+    PARAMETERS:
+    - grid: PointGrid of points
+    - polygons: list of polygons, each a list of rings (see ShapefileIO.py)
+
+    RETURNS: sorted numpy array of indices of points inside
+    '''
+    selected = []
+    for rings in polygons:
+        vertices = np.concatenate(rings)
+        xmin, ymin = vertices.min(axis=0)
+        xmax, ymax = vertices.max(axis=0)
+        candidates = grid.query_bbox(xmin, ymin, xmax, ymax)
+        inside = points_in_polygon(grid.x[candidates], grid.y[candidates], rings)
+        selected.append(candidates[inside])
+    if not selected:
+        return np.array([], dtype=int)
+    return np.unique(np.concatenate(selected))
+
+# Define function to identify the sampling points inside an area of interest:
+def identify_sites(sites, areaOfInterest, x_col="x", y_col="y", cell_size=CELL_SIZE):
+    '''
+    Function to select the sampling points inside an area of interest.
+
+    PARAMETERS:
+    - sites: pandas dataframe of sampling points, or path of point .shp file
+      (British National Grid)
+    - areaOfInterest: path of polygon .shp file (British National Grid), or
+      list of polygons
+    - x_col: name of column holding eastings
+    - y_col: name of column holding northings
+    - cell_size: size of grid cells for the point index
+
+    RETURNS: pandas dataframe of the sampling points inside
+    '''
+    if isinstance(sites, str):
+        require_bng(sites)
+        sites = read_points(sites)
+    if isinstance(areaOfInterest, str):
+        areaOfInterest = read_polygons(areaOfInterest)
+    grid = PointGrid(sites[x_col].values, sites[y_col].values, cell_size)
+    return sites.iloc[points_in_polygons(grid, areaOfInterest)]
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+StatsCube.py
+
+Pre-calculated summary statistics of water quality results, kept for every
+(sampling point, determinand, year). For each one the cube holds the number
+of results, number below the Limit of Detection (LoD), sum, sum of squares,
+minimum, maximum and a small quantile sketch, so that descriptive statistics
+tables for any set of sampling points and years can be produced without
+reading the measurements again.
+
+Results below the LoD are halved before being summarised (the standard
+'half' policy of ResultQualifiers.py, which is also WQDataExtractor.py's
+default).
+
+All the statistics can be added together, so the cube is built up one dataset
+at a time: CSVDownloader.py adds each year/area dataset as it is downloaded,
+from the same chunks read for the sampling point registry (replacing the
+statistics for that dataset if it has been downloaded before),
+and WQDataExtractor.py writes a cube for each extraction which
+DataViewer.ipynb uses for its statistics table.
+
+The quantile sketch puts results into buckets whose widths grow in
+proportion to the value, so quantiles are accurate to within 1% of the value
+whatever the range of the data, and sketches can be merged by adding the
+counts in each bucket.
+
+The cube is saved as two .csv files:
+
+    selected_stats.csv         - statistics
+    selected_stats.sketch.csv  - quantile sketch bucket counts
+"""
+
+# Import modules:
+import os
+import threading
+import numpy as np
+import pandas as pd
+from ResultQualifiers import qualifier_codes, apply_policy, BELOW
+
+# Columns identifying each cell of the cube:
+KEY_COLUMNS = ["area", "year", "site", "determinand"]
+
+# Columns of the statistics table:
+STATS_COLUMNS = KEY_COLUMNS + ["definition", "unit", "count", "below_lod",
+                               "sum", "sum_sq", "min", "max"]
+
+# Columns of the quantile sketch table:
+SKETCH_COLUMNS = KEY_COLUMNS + ["bucket", "count"]
+
+# Columns read from the archive:
+SOURCE_COLUMNS = {"sample.samplingPoint.notation": "site",
+                  "determinand.notation": "determinand",
+                  "determinand.definition": "definition",
+                  "determinand.unit.label": "unit",
+                  "sample.sampleDateTime": "date",
+                  "resultQualifier.notation": "qualifier",
+                  "result": "result"}
+
+# Columns to read as text:
+TEXT_COLUMNS = ["sample.samplingPoint.notation", "determinand.notation",
+                "resultQualifier.notation"]
+
+# Policy for results below the Limit of Detection (see ResultQualifiers.py):
+CUBE_POLICY = "half"
+
+# Relative accuracy of quantile sketch, and bucket growth factor:
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+
+# Values closer to zero than this share the zero bucket; bucket numbers are
+# offset so that they are always positive for positive values:
+MIN_VALUE = 1e-9
+BUCKET_OFFSET = int(np.ceil(-np.log(MIN_VALUE) / np.log(GAMMA))) + 1
+
+# Quantiles reported in summary tables (as in pandas describe):
+QUANTILES = (0.25, 0.5, 0.75)
+
+# Number of rows to read from a dataset at a time:
+CHUNK_SIZE = 500000
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to put values into quantile sketch buckets:
+def value_buckets(values):
+    '''
+    Function to get the sketch bucket number for each value. Positive values
+    get positive bucket numbers, negative values negative numbers, and values
+    close to zero bucket 0.
+
+    PARAMETERS:
+    - values: numpy array of values
+
+    RETURNS: numpy array of bucket numbers
+    '''
+    values = np.asarray(values, dtype=float)
+    magnitude = np.maximum(np.abs(values), MIN_VALUE)
+    k = np.ceil(np.log(magnitude) / np.log(GAMMA)).astype(np.int64) + BUCKET_OFFSET
+    k = np.maximum(k, 1)
+    return np.where(np.abs(values) < MIN_VALUE, 0, np.sign(values).astype(np.int64) * k)
+
+# Define function to get the value represented by sketch buckets:
+def bucket_values(buckets):
+    '''
+    Function to get the value represented by each sketch bucket (the value
+    within 1% of every value in the bucket).
+
+    PARAMETERS:
+    - buckets: numpy array of bucket numbers
+
+    RETURNS: numpy array of values
+    '''
+    buckets = np.asarray(buckets, dtype=np.int64)
+    k = np.abs(buckets) - BUCKET_OFFSET
+    values = 2 * np.power(GAMMA, k.astype(float)) / (GAMMA + 1)
+    return np.where(buckets == 0, 0.0, np.sign(buckets) * values)
+
+# Define function to convert a column to text with blanks for missing values:
+def as_text(values):
+    '''
+    Function to convert a column (text or categorical) to text, with missing
+    values as blank text.
+
+    PARAMETERS:
+    - values: pandas series
+
+    RETURNS: numpy array of str
+    '''
+    return values.astype(object).fillna("").astype(str).values
+
+# Define function to get the results with LoD processing applied:
+def qualified_results(result, qualifier):
+    '''
+    Function to halve results below (<) the Limit of Detection.
+
+    PARAMETERS:
+    - result: array of results
+    - qualifier: array of result qualifiers ('<', '>' or blank)
+
+    RETURNS: numpy array of results
+    '''
+    return apply_policy(result, qualifier_codes(qualifier), CUBE_POLICY)
+
+# Define function to summarise measurements into cube cells:
+def summarise(df, area_notation=""):
+    '''
+    Function to summarise water quality measurements into cube cells.
+
+    PARAMETERS:
+    - df: dataframe of measurements (with WQA or short column names, see
+      SOURCE_COLUMNS)
+    - area_notation: notation of EA operational area the data is for
+
+    RETURNS: (statistics dataframe, sketch dataframe)
+    '''
+    df = df.rename(columns=SOURCE_COLUMNS)
+    values = qualified_results(df["result"], df["qualifier"])
+    dates = df["date"]
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        years = dates.dt.year
+    else:
+        years = pd.to_numeric(dates.astype(str).str[:4], errors="coerce")
+    cells = pd.DataFrame({"area": area_notation,
+                          "year": years.values,
+                          "site": as_text(df["site"]),
+                          "determinand": as_text(df["determinand"]),
+                          "definition": as_text(df["definition"]),
+                          "unit": as_text(df["unit"]),
+                          "value": values,
+                          "below": qualifier_codes(df["qualifier"]) == BELOW})
+    cells = cells[np.isfinite(cells["value"]) & cells["year"].notnull()]
+    cells["year"] = cells["year"].astype(int)
+    cells["value_sq"] = cells["value"] ** 2
+    stats = cells.groupby(KEY_COLUMNS, sort=False).agg(
+            definition=("definition", "last"), unit=("unit", "last"),
+            count=("value", "size"), below_lod=("below", "sum"),
+            sum=("value", "sum"), sum_sq=("value_sq", "sum"),
+            min=("value", "min"), max=("value", "max")).reset_index()
+    cells["bucket"] = value_buckets(cells["value"].values)
+    sketch = cells.groupby(KEY_COLUMNS + ["bucket"], sort=False).size().rename("count").reset_index()
+    return stats[STATS_COLUMNS], sketch[SKETCH_COLUMNS]
+
+# Define function to combine statistics for the same cube cells:
+def merge_cells(stats, sketch):
+    '''
+    Function to combine statistics and sketch counts which are for the same
+    cube cells (e.g. from different chunks of a file).
+
+    PARAMETERS:
+    - stats: statistics dataframe
+    - sketch: sketch dataframe
+
+    RETURNS: (statistics dataframe, sketch dataframe)
+    '''
+    stats = stats.groupby(KEY_COLUMNS, sort=False).agg(
+            {"definition": "last", "unit": "last", "count": "sum",
+             "below_lod": "sum", "sum": "sum", "sum_sq": "sum",
+             "min": "min", "max": "max"}).reset_index()
+    sketch = sketch.groupby(KEY_COLUMNS + ["bucket"], sort=False)["count"].sum().reset_index()
+    return stats[STATS_COLUMNS], sketch[SKETCH_COLUMNS]
+
+# Define function to calculate quantiles from sketch counts:
+def sketch_quantiles(sketch, groups, quantiles=QUANTILES):
+    '''
+    Function to calculate quantiles for groups of cube cells from their
+    sketch bucket counts.
+
+    PARAMETERS:
+    - sketch: sketch dataframe
+    - groups: list of columns to group by (e.g. ['site'])
+    - quantiles: quantiles to calculate (0 to 1)
+
+    RETURNS: dataframe indexed by groups with one column per quantile
+    '''
+    counts = sketch.groupby(groups + ["bucket"])["count"].sum().reset_index()
+    counts["value"] = bucket_values(counts["bucket"].values)
+    counts = counts.sort_values(groups + ["value"])
+    counts["cumulative"] = counts.groupby(groups)["count"].cumsum()
+    totals = counts.groupby(groups)["count"].transform("sum")
+    result = {}
+    for q in quantiles:
+        # First bucket holding the value ranked q of the way through:
+        rank = q * (totals - 1)
+        hit = counts[counts["cumulative"] > rank]
+        result["{0:g}%".format(q * 100)] = hit.groupby(groups)["value"].first()
+    return pd.DataFrame(result)
+
+# Define class to hold the statistics cube:
+class StatsCube:
+    '''
+    Class to load, update, save and query the statistics cube. Updates are
+    thread-safe so datasets can be added by download workers. The cells for
+    each (area, year) are kept as separate dataframes, so adding a dataset
+    only touches its own cells; they are joined into one table when the cube
+    is saved or queried.
+
+    PARAMETERS:
+    - path: location of statistics .csv file (sketch is saved alongside)
+    - load: True to load the existing cube from path (if there is one)
+    '''
+    # Columns read from each dataset (see BatchDownloader.summarise_dataset):
+    source_columns = list(SOURCE_COLUMNS)
+    text_columns = TEXT_COLUMNS
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self.sketch_path = os.path.splitext(path)[0] + ".sketch.csv"
+        self._lock = threading.Lock()
+        # (stats, sketch) dataframes for each (area, year):
+        self.batches = {}
+        # Joined tables (None until needed after each change):
+        self._tables = None
+        if load and os.path.isfile(self.path) and os.path.isfile(self.sketch_path):
+            text = {"area": str, "site": str, "determinand": str}
+            stats = pd.read_csv(self.path, dtype=text, keep_default_na=False)
+            sketch = pd.read_csv(self.sketch_path, dtype=text, keep_default_na=False)
+            self.batches = self._split(stats, sketch)
+
+    def _split(self, stats, sketch):
+        '''
+        Function to split statistics and sketch dataframes by (area, year).
+
+        PARAMETERS:
+        - stats: statistics dataframe
+        - sketch: sketch dataframe
+
+        RETURNS: dictionary of (stats, sketch) dataframes keyed by (area, year)
+        '''
+        sketches = {key: group for key, group in sketch.groupby(["area", "year"], sort=False)}
+        empty = pd.DataFrame(columns=SKETCH_COLUMNS)
+        return {(str(area), int(year)): (group, sketches.get((area, year), empty))
+                for (area, year), group in stats.groupby(["area", "year"], sort=False)}
+
+    def _replace(self, stats, sketch, batch=None):
+        '''
+        Function to replace part of the cube with new cells. Existing cells
+        with the same key are replaced; if a batch is given, all of its
+        existing cells are replaced.
+
+        PARAMETERS:
+        - stats: new statistics dataframe
+        - sketch: new sketch dataframe
+        - batch: (area, year) whose cells are all replaced (or None)
+
+        RETURNS: None
+        '''
+        new = self._split(stats, sketch)
+        with self._lock:
+            if batch is not None:
+                self.batches.pop(batch, None)
+            for key, (new_stats, new_sketch) in new.items():
+                old = self.batches.get(key)
+                if old is not None:
+                    # Keep existing cells which are not in the new data:
+                    cells = pd.MultiIndex.from_frame(new_stats[KEY_COLUMNS])
+                    keep = [~pd.MultiIndex.from_frame(df[KEY_COLUMNS].astype(
+                            {"area": str, "year": int, "site": str, "determinand": str})).isin(cells)
+                            for df in old]
+                    new_stats = pd.concat([old[0][keep[0]], new_stats], ignore_index=True)
+                    new_sketch = pd.concat([old[1][keep[1]], new_sketch], ignore_index=True)
+                self.batches[key] = (new_stats, new_sketch)
+            self._tables = None
+
+    def _joined(self):
+        '''
+        Function to get the whole cube as one statistics and one sketch
+        dataframe (joined once after each change).
+
+        RETURNS: (stats, sketch) dataframes
+        '''
+        with self._lock:
+            if self._tables is None:
+                batches = list(self.batches.values())
+                self._tables = (pd.concat([b[0] for b in batches] or
+                                          [pd.DataFrame(columns=STATS_COLUMNS)], ignore_index=True),
+                                pd.concat([b[1] for b in batches] or
+                                          [pd.DataFrame(columns=SKETCH_COLUMNS)], ignore_index=True))
+            return self._tables
+
+    def has_batch(self, area_notation, year):
+        '''
+        Function to check if a dataset has been added to the cube.
+
+        PARAMETERS:
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: True if dataset is in cube
+        '''
+        with self._lock:
+            return (str(area_notation), int(year)) in self.batches
+
+    def add_batch(self, file, area_notation, year, chunksize=CHUNK_SIZE):
+        '''
+        Function to summarise a downloaded year/area dataset and add it to the
+        cube, replacing any earlier statistics for the same dataset.
+
+        PARAMETERS:
+        - file: path of yearly .csv (or .csv.gz) file
+        - area_notation: notation of EA operational area
+        - year: year of data
+        - chunksize: number of rows to read at a time
+
+        RETURNS: number of cube cells for dataset
+        '''
+        return self.add_chunks([self.summarise_chunk(chunk, area_notation) for chunk in
+                                pd.read_csv(file, usecols=self.source_columns, chunksize=chunksize,
+                                            dtype={c: str for c in self.text_columns})],
+                               area_notation, year)
+
+    def summarise_chunk(self, chunk, area_notation):
+        '''
+        Function to summarise one chunk of a dataset into cube cells, to be
+        added to the cube with add_chunks once the whole dataset has been
+        read.
+
+        PARAMETERS:
+        - chunk: dataframe of measurements (WQA column names)
+        - area_notation: notation of EA operational area
+
+        RETURNS: (statistics dataframe, sketch dataframe)
+        '''
+        return summarise(chunk[self.source_columns], str(area_notation))
+
+    def add_chunks(self, parts, area_notation, year):
+        '''
+        Function to add a dataset to the cube from the cells of its chunks,
+        replacing any earlier statistics for the same dataset.
+
+        PARAMETERS:
+        - parts: list of (stats, sketch) tuples from summarise_chunk
+        - area_notation: notation of EA operational area
+        - year: year of data
+
+        RETURNS: number of cube cells for dataset
+        '''
+        if not parts:
+            return 0
+        stats, sketch = merge_cells(pd.concat([p[0] for p in parts], ignore_index=True),
+                                    pd.concat([p[1] for p in parts], ignore_index=True))
+        self._replace(stats, sketch, (str(area_notation), int(year)))
+        return len(stats)
+
+    def add_frame(self, df, area_notation=""):
+        '''
+        Function to summarise a dataframe of measurements (e.g. an extraction)
+        and add it to the cube, replacing any earlier statistics for the same
+        cells.
+
+        PARAMETERS:
+        - df: dataframe of measurements
+        - area_notation: notation of EA operational area (blank if the data is
+          for more than one area)
+
+        RETURNS: number of cube cells for dataframe
+        '''
+        stats, sketch = summarise(df, area_notation)
+        self._replace(stats, sketch)
+        return len(stats)
+
+    def save(self):
+        '''
+        Function to save the cube to disk.
+
+        RETURNS: None
+        '''
+        stats, sketch = self._joined()
+        stats = stats.sort_values(KEY_COLUMNS)
+        sketch = sketch.sort_values(KEY_COLUMNS + ["bucket"])
+        # Write to temporary files then rename, so the cube is never left
+        # half-written:
+        for df, path in ((stats, self.path), (sketch, self.sketch_path)):
+            df.to_csv(path + ".tmp", index=False, encoding="utf-8")
+            os.replace(path + ".tmp", path)
+
+    def codes(self, definition):
+        '''
+        Function to get the determinand codes with a definition (more than
+        one code can share a definition).
+
+        PARAMETERS:
+        - definition: determinand definition
+
+        RETURNS: sorted list of determinand codes
+        '''
+        stats, sketch = self._joined()
+        return sorted(stats.loc[stats["definition"] == definition, "determinand"].unique())
+
+    def summary(self, determinand=None, sites=None, first_year=None, last_year=None):
+        '''
+        Function to produce a descriptive statistics table (like pandas
+        describe) for each sampling point and determinand from the cube.
+
+        PARAMETERS:
+        - determinand: determinand code (None for all)
+        - sites: list of sampling point notations (None for all)
+        - first_year: first year to include (None for no limit)
+        - last_year: last year to include (None for no limit)
+
+        RETURNS: dataframe indexed by (determinand, site) with count, mean,
+        std, min, 25%, 50%, 75%, max and below_lod columns
+        '''
+        stats, sketch = self._joined()
+        keep = pd.Series(True, index=stats.index)
+        if determinand is not None:
+            keep &= stats["determinand"] == str(determinand)
+        if sites is not None:
+            keep &= stats["site"].isin(list(sites))
+        if first_year is not None:
+            keep &= stats["year"] >= first_year
+        if last_year is not None:
+            keep &= stats["year"] <= last_year
+        stats = stats[keep]
+        groups = ["determinand", "site"]
+        sketch = sketch.merge(stats[KEY_COLUMNS], on=KEY_COLUMNS)
+
+        totals = stats.groupby(groups).agg({"count": "sum", "sum": "sum", "sum_sq": "sum",
+                                            "min": "min", "max": "max", "below_lod": "sum"})
+        n = totals["count"]
+        table = pd.DataFrame({"count": n.astype(float),
+                              "mean": totals["sum"] / n}, index=totals.index)
+        variance = (totals["sum_sq"] - totals["sum"] ** 2 / n) / (n - 1)
+        table["std"] = np.sqrt(variance.clip(lower=0)).where(n > 1)
+        table["min"] = totals["min"]
+        quantiles = sketch_quantiles(sketch, groups).reindex(totals.index)
+        for col in quantiles.columns:
+            # Keep sketch values within the exact range:
+            table[col] = quantiles[col].clip(totals["min"], totals["max"])
+        table["max"] = totals["max"]
+        table["below_lod"] = totals["below_lod"]
+        return table
@@ -0,0 +1,672 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+WQBenchmark.py
+
+Repeatable end-to-end benchmark of the whole workflow on a made-up archive,
+so that changes which slow any stage down show up before the next refresh of
+the real archive (which takes hours to run).
+
+A made-up archive of the chosen size (EA areas, years, sampling points,
+determinands and rows or bytes per dataset) is served by LocalWQAServer.py and
+taken through each stage in turn:
+
+    download  - BatchDownloader.download_grid against the local server
+    retry     - download_grid against a flaky local server, checking that
+                failed requests are tried again, that a stopped run carries
+                on from its journal and that unchanged datasets are
+                hard-linked from the previous download (an error is raised
+                if any check fails)
+    combine   - CSVCombiner.combine_areas into one file per area
+    index     - SiteIndex.build_index and the determinand catalogue per area
+    locations - SiteRegistry summary of every dataset and england_wq_locs.shp
+    aoi       - SpatialIndex.identify_sites for an area of interest
+    extract   - ArchiveQuery.query_areas, selected_data.csv and statistics cube
+    notebook  - DataViewer.ipynb aggregation for every determinand (loading,
+                plot downsampling, statistics table and site table)
+
+Each stage is run in a fresh process, so the peak memory (resident set size)
+recorded is that stage's own, and writes a trace of its steps (see
+PipelineTrace.py) to 'trace_<stage>.jsonl' in the work directory. The time,
+throughput (rows and MB per second) and peak memory of each stage are saved
+to 'benchmark_results.json' in the work directory and compared with a stored
+baseline for the same archive size; a stage which is more than 25% slower
+(or uses 25% more memory) than its baseline is reported as a regression and
+the script exits with status 1.
+
+Example (from a command prompt):
+    python WQBenchmark.py --scale small --save-baseline
+    python WQBenchmark.py --scale small
+    python WQBenchmark.py --sites 500 --bytes 20000000 --stages download retry
+"""
+
+# Import modules:
+import os
+import io
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import platform
+import tempfile
+import traceback
+import contextlib
+import multiprocessing
+import numpy as np
+import pandas as pd
+from LocalWQAServer import LocalWQAServer, make_batch_csv
+from PipelineTrace import start_trace, stop_trace, summary_lines, peak_rss_mb
+
+# Archive sizes for --scale (rows are per yearly dataset of each area):
+SCALES = {"small": {"areas": 2, "years": 2, "sites": 50, "determinands": 4, "rows": 5000},
+          "medium": {"areas": 4, "years": 5, "sites": 200, "determinands": 8, "rows": 50000},
+          "large": {"areas": 8, "years": 10, "sites": 1000, "determinands": 20, "rows": 250000}}
+
+# Stages of the benchmark, in the order they must run:
+STAGES = ["download", "retry", "combine", "index", "locations", "aoi", "extract", "notebook"]
+
+# First year of made-up data:
+FIRST_YEAR = 2000
+
+# Baseline results, kept alongside this script:
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Fraction by which a stage may be slower (or use more memory) than its
+# baseline before it is reported as a regression:
+TOLERANCE = 0.25
+
+# Stages quicker than this (seconds) are too short to time reliably, so are
+# not reported as regressions:
+MIN_SECONDS = 0.5
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the notations of the made-up EA areas:
+def area_notations(count):
+    '''
+    Function to get the notations of the made-up EA operational areas.
+
+    PARAMETERS:
+    - count: number of areas
+
+    RETURNS: list of area notations
+    '''
+    return ["9-{0}".format(i + 1) for i in range(count)]
+
+# Define function to work out rows per dataset from a target size:
+def rows_for_bytes(target_bytes, sites, determinands):
+    '''
+    Function to work out how many rows a made-up dataset needs to be about a
+    given size on disk.
+
+    PARAMETERS:
+    - target_bytes: size of each yearly dataset in bytes
+    - sites: number of sampling points
+    - determinands: number of determinands
+
+    RETURNS: number of rows
+    '''
+    sample = make_batch_csv("9-1", FIRST_YEAR, 1000, sites, determinands)
+    header = sample.index(b"\n") + 1
+    return max(1, int(target_bytes / ((len(sample) - header) / 1000.0)))
+
+# Define function to get the total size of some files:
+def total_bytes(files):
+    '''
+    Function to add up the sizes of files.
+
+    PARAMETERS:
+    - files: list of file paths
+
+    RETURNS: total size in bytes
+    '''
+    return sum(os.path.getsize(f) for f in files)
+
+# Define function to get the work directory paths:
+def work_paths(work_dir):
+    '''
+    Function to get the locations of the files made by each stage.
+
+    PARAMETERS:
+    - work_dir: benchmark work directory
+
+    RETURNS: dictionary of paths
+    '''
+    return {"work": work_dir,
+            "yearly": os.path.join(work_dir, "yearly"),
+            "retry": os.path.join(work_dir, "retry"),
+            "areas": os.path.join(work_dir, "areas"),
+            "shp": os.path.join(work_dir, "shp"),
+            "registry": os.path.join(work_dir, "site_registry.csv"),
+            "aoi_sites": os.path.join(work_dir, "aoi_sites.csv"),
+            "extract": os.path.join(work_dir, "extract")}
+
+# -----------------------------------------------------------------------------
+# STAGES:
+# Each stage reads the files made by the stages before it.
+
+# Define function to benchmark downloading:
+def stage_download(paths, config):
+    '''
+    Stage: download every made-up dataset from a local server.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from BatchDownloader import download_grid
+    shutil.rmtree(paths["yearly"], ignore_errors=True)
+    os.makedirs(paths["yearly"])
+    areas = area_notations(config["areas"])
+    years = range(FIRST_YEAR, FIRST_YEAR + config["years"])
+    with LocalWQAServer(config["rows"], sites=config["sites"],
+                        determinands=config["determinands"]) as server:
+        download_grid(years, areas, paths["yearly"], root=server.root, progress=None)
+    files = glob.glob(os.path.join(paths["yearly"], "*.csv"))
+    return {"rows": config["rows"] * len(files), "bytes": total_bytes(files)}
+
+# Define function to check a condition of the retry stage:
+def check(condition, message):
+    '''
+    Function to raise an error if a check made by a stage fails.
+
+    PARAMETERS:
+    - condition: result of check
+    - message: description of what went wrong
+
+    RETURNS: None
+    '''
+    if not condition:
+        raise RuntimeError("Check failed: " + message)
+
+# Define function to benchmark (and check) downloading from a flaky server:
+def stage_retry(paths, config):
+    '''
+    Stage: download every made-up dataset from a local server which fails
+    the first requests for each dataset, then carry on a stopped run from
+    its journal and refresh against the manifest of the first run.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from BatchDownloader import download_grid, check_failures, RetryPolicy, temp_filename
+    from DownloadManifest import DownloadManifest
+    from DownloadJournal import DownloadJournal
+    from SiteRegistry import SiteRegistry
+    from StatsCube import StatsCube
+    shutil.rmtree(paths["retry"], ignore_errors=True)
+    first, resumed, second = [os.path.join(paths["retry"], name)
+                              for name in ("first", "resumed", "second")]
+    for directory in (first, resumed, second):
+        os.makedirs(directory)
+    areas = area_notations(config["areas"])
+    years = list(range(FIRST_YEAR, FIRST_YEAR + config["years"]))
+    datasets = len(areas) * len(years)
+    size = {"sites": config["sites"], "determinands": config["determinands"]}
+    # Short waits, so the stage is quick:
+    retry = RetryPolicy(base_delay=0.01, max_delay=0.05, max_retry_after=0.05)
+    manifest = DownloadManifest(os.path.join(paths["retry"], "manifest.json"))
+
+    # Every dataset fails its first two requests (in one of the ways listed in
+    # LocalWQAServer.FAILURES), so is downloaded on its third attempt:
+    journal_file = os.path.join(first, "download_journal.jsonl")
+    with LocalWQAServer(config["rows"], fail_first=2, retry_after=0, **size) as server:
+        results = download_grid(years, areas, first, root=server.root, progress=None,
+                                manifest=manifest, retry=retry,
+                                journal=DownloadJournal(journal_file))
+    check_failures(results)
+    check(len(results) == datasets, "{0} of {1} datasets downloaded".format(len(results), datasets))
+    check(all(info["attempts"] == 3 for task, info in results),
+          "datasets not downloaded on their third attempt")
+    check(server.failed == 2 * datasets,
+          "server failed {0} requests, expected {1}".format(server.failed, 2 * datasets))
+    with open(journal_file, "r", encoding="utf-8") as f:
+        retries = sum(json.loads(line)["state"] == "retry" for line in f)
+    check(retries == 2 * datasets, "{0} retries in journal, expected {1}".format(retries, 2 * datasets))
+    for (year, area_notation, url, file), info in results:
+        with open(file, "rb") as f:
+            check(f.read() == make_batch_csv(area_notation, year, config["rows"], **size),
+                  "{0} does not match the served dataset".format(file))
+
+    # A run stopped after the first area: its datasets are done (but not
+    # saved in the registry and cube) and a half-written file is left behind:
+    journal = DownloadJournal(os.path.join(resumed, "download_journal.jsonl"))
+    with LocalWQAServer(config["rows"], **size) as server:
+        download_grid(years, areas[:1], resumed, root=server.root, progress=None,
+                      retry=retry, journal=journal)
+    stopped = os.path.join(resumed, "{0}_{1}.csv".format(years[0], areas[-1]))
+    with open(temp_filename(stopped), "wb") as f:
+        f.write(make_batch_csv(areas[-1], years[0], config["rows"], **size)[:100])
+    # Carrying on only requests the other datasets, and adds the datasets
+    # done by the stopped run to the new registry and cube again:
+    registry = SiteRegistry(os.path.join(resumed, "site_registry.csv"))
+    cube = StatsCube(os.path.join(resumed, "stats_cube.csv"), load=False)
+    journal = DownloadJournal(journal.path)
+    with LocalWQAServer(config["rows"], **size) as server:
+        results = download_grid(years, areas, resumed, root=server.root, progress=None,
+                                retry=retry, journal=journal, registry=registry, cube=cube)
+    requested = sum(server.requests.values())
+    check(requested == datasets - len(years),
+          "resumed run sent {0} requests, expected {1}".format(requested, datasets - len(years)))
+    check(all(registry.has_batch(a, y) and cube.has_batch(a, y) for a in areas for y in years),
+          "resumed run did not add every dataset to the registry and cube")
+    check(not os.path.exists(temp_filename(stopped)), "half-written file left behind")
+
+    # Refreshing against the first run's manifest gets 304 for every dataset
+    # and hard-links the first run's files:
+    with LocalWQAServer(config["rows"], **size) as server:
+        results = download_grid(years, areas, second, root=server.root, progress=None,
+                                manifest=manifest, retry=retry,
+                                journal=DownloadJournal(os.path.join(second, "download_journal.jsonl")))
+    check(all(info["status"] == "linked" for task, info in results),
+          "unchanged datasets downloaded again")
+    for (year, area_notation, url, file), info in results:
+        check(os.path.samefile(file, os.path.join(first, os.path.basename(file))),
+              "{0} is not linked to the previous download".format(file))
+
+    files = glob.glob(os.path.join(first, "*.csv"))
+    return {"rows": config["rows"] * len(files), "bytes": total_bytes(files)}
+
+# Define function to benchmark combining yearly files into area files:
+def stage_combine(paths, config):
+    '''
+    Stage: combine the yearly files into one file per area.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from CSVCombiner import combine_areas
+    shutil.rmtree(paths["areas"], ignore_errors=True)
+    os.makedirs(paths["areas"])
+    combine_areas(paths["yearly"], area_notations(config["areas"]), paths["areas"])
+    files = glob.glob(os.path.join(paths["yearly"], "*.csv"))
+    return {"rows": config["rows"] * len(files), "bytes": total_bytes(files)}
+
+# Define function to benchmark indexing the area files:
+def stage_index(paths, config):
+    '''
+    Stage: build the sampling point index and determinand catalogue
+    of each area file.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from SiteIndex import build_index
+    from DeterminandCatalogue import build_catalogue
+    from ArchiveQuery import area_file
+    files = []
+    for area_notation in area_notations(config["areas"]):
+        files.append(area_file(paths["areas"], area_notation))
+        build_index(files[-1])
+        build_catalogue(paths["areas"], area_notation)
+    return {"rows": config["rows"] * config["years"] * len(files), "bytes": total_bytes(files)}
+
+# Define function to benchmark building the sampling point layer:
+def stage_locations(paths, config):
+    '''
+    Stage: summarise every yearly file into the sampling point
+    registry and write england_wq_locs.shp/.csv.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from SiteRegistry import SiteRegistry
+    if os.path.isfile(paths["registry"]):
+        os.remove(paths["registry"])
+    os.makedirs(paths["shp"], exist_ok=True)
+    registry = SiteRegistry(paths["registry"])
+    files = sorted(glob.glob(os.path.join(paths["yearly"], "*.csv")))
+    for file in files:
+        # Yearly files are named '<year>_<area>.csv':
+        year, area_notation = os.path.splitext(os.path.basename(file))[0].split("_", 1)
+        registry.add_batch(file, area_notation, year)
+    registry.save()
+    registry.export(os.path.join(paths["shp"], "england_wq_locs.shp"),
+                    os.path.join(paths["shp"], "england_wq_locs.csv"))
+    return {"rows": config["rows"] * len(files), "bytes": total_bytes(files)}
+
+# Define function to benchmark finding sampling points in an area of interest:
+def stage_aoi(paths, config):
+    '''
+    Stage: find the sampling points inside an area of interest.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from ShapefileIO import read_points
+    from SpatialIndex import identify_sites
+    shp_file = os.path.join(paths["shp"], "england_wq_locs.shp")
+    points = read_points(shp_file)
+    # Area of interest covering the western half of the sampling points:
+    x0, x1 = points["x"].min() - 50, points["x"].median()
+    y0, y1 = points["y"].min() - 50, points["y"].max() + 50
+    ring = np.array([[x0, y0], [x0, y1], [x1, y1], [x1, y0], [x0, y0]])
+    sites = identify_sites(points, [[ring]])
+    sites[["notation"]].to_csv(paths["aoi_sites"], index=False)
+    return {"rows": len(points), "bytes": total_bytes(glob.glob(os.path.splitext(shp_file)[0] + ".*"))}
+
+# Define function to benchmark extracting data for the area of interest:
+def stage_extract(paths, config):
+    '''
+    Stage: extract the data for the area of interest's sampling
+    points, as WQDataExtractor.py.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from ArchiveQuery import find_areas, query_areas
+    from WQSchema import write_wq_csv
+    from StatsCube import StatsCube
+    from SeriesStore import write_store, store_dir_for
+    from SiteRegistry import archive_sites_file, read_lonlat
+    from ResultQualifiers import qualify
+    os.makedirs(paths["extract"], exist_ok=True)
+    locs = pd.read_csv(paths["aoi_sites"], dtype=str)["notation"].tolist()
+    areas = find_areas(paths["areas"], locs)
+    df = query_areas(paths["areas"], areas, locs)
+    # As WQDataExtractor.py:
+    df = qualify(df)
+    write_wq_csv(df, os.path.join(paths["extract"], "selected_data.csv"))
+    cube = StatsCube(os.path.join(paths["extract"], "selected_stats.csv"), load=False)
+    cube.add_frame(df)
+    cube.save()
+    datafile = os.path.join(paths["extract"], "selected_data.csv")
+    write_store(df, store_dir_for(datafile), datafile,
+                read_lonlat(archive_sites_file(paths["areas"])))
+    return {"rows": len(df), "bytes": total_bytes(glob.glob(os.path.join(paths["areas"], "*.csv")))}
+
+# Define function to benchmark the notebook's aggregation for every determinand:
+def stage_notebook(paths, config):
+    '''
+    Stage: load, downsample and summarise each determinand of the
+    extracted data, as step 3 of DataViewer.ipynb.
+
+    RETURNS: dictionary of rows and bytes processed
+    '''
+    from DataLoader import DataLoader
+    from PlotDownsampler import TraceResampler
+    from StatsCube import StatsCube
+    from SiteGeometry import site_table
+    datafile = os.path.join(paths["extract"], "selected_data.csv")
+    loader = DataLoader(datafile)
+    cube = StatsCube(os.path.join(paths["extract"], "selected_stats.csv"))
+    rows = 0
+    # As step 3 of DataViewer.ipynb, for each determinand in turn:
+    for determinand in loader.determinands():
+        store = loader.series(determinand)
+        sites = store.sites(determinand)
+        TraceResampler.from_series(store.traces(determinand)).traces()
+        codes = cube.codes(determinand)
+        if len(codes) == 1:
+            cube.summary(codes[0])
+        else:
+            store.describe(determinand)
+        site_table(sites)
+        rows += int((sites["stop"] - sites["start"]).sum())
+    return {"rows": rows, "bytes": os.path.getsize(datafile)}
+
+# -----------------------------------------------------------------------------
+# RUNNING AND COMPARING:
+
+# Define function to run one stage in a child process:
+def stage_worker(stage, paths, config, queue, verbose):
+    '''
+    Function run in a child process to time one stage and record its peak
+    memory. The result (or the error) is put on the queue.
+
+    PARAMETERS:
+    - stage: name of stage
+    - paths: work directory paths (from work_paths)
+    - config: archive size dictionary
+    - queue: multiprocessing queue to put the result on
+    - verbose: True to show the output of the stage
+
+    RETURNS: None
+    '''
+    try:
+        function = globals()["stage_" + stage]
+        output = sys.stdout if verbose else io.StringIO()
+        trace = start_trace(os.path.join(paths["work"], "trace_" + stage + ".jsonl"))
+        with contextlib.redirect_stdout(output):
+            start = time.perf_counter()
+            result = function(paths, config)
+            result["seconds"] = time.perf_counter() - start
+        stop_trace()
+        result["peak_rss_mb"] = peak_rss_mb()
+        if verbose:
+            for line in summary_lines(trace.path):
+                print(line)
+        queue.put(result)
+    except Exception:
+        queue.put({"error": traceback.format_exc()})
+
+# Define function to run one stage:
+def run_stage(stage, paths, config, verbose=False):
+    '''
+    Function to run one stage of the benchmark in a fresh process (started
+    with 'spawn', so it does not share memory with this process).
+
+    PARAMETERS:
+    - stage: name of stage
+    - paths: work directory paths (from work_paths)
+    - config: archive size dictionary
+    - verbose: True to show the output of the stage
+
+    RETURNS: dictionary of seconds, rows, bytes and peak_rss_mb
+    '''
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=stage_worker, args=(stage, paths, config, queue, verbose))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Exception:
+            # Stop waiting if the process died without a result:
+            if not process.is_alive():
+                result = {"error": "Process ended with exit code {0}.".format(process.exitcode)}
+    process.join()
+    if "error" in result:
+        raise RuntimeError("Stage '{0}' failed:\n{1}".format(stage, result["error"]))
+    return result
+
+# Define function to run the benchmark:
+def run_benchmark(config, work_dir, stages=STAGES, repeat=1, verbose=False):
+    '''
+    Function to run the benchmark stages in order. Each stage is run repeat
+    times and its fastest time kept.
+
+    PARAMETERS:
+    - config: archive size dictionary (areas, years, sites, determinands, rows)
+    - work_dir: directory to make the archive in
+    - stages: list of stages to run (a stage needs the files made by the
+      stages before it, from this or an earlier run)
+    - repeat: number of times to run each stage
+    - verbose: True to show the output of each stage
+
+    RETURNS: results dictionary
+    '''
+    paths = work_paths(work_dir)
+    results = {"config": config,
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "cpus": os.cpu_count(),
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "stages": {}}
+    for stage in [s for s in STAGES if s in stages]:
+        runs = [run_stage(stage, paths, config, verbose) for i in range(repeat)]
+        best = min(runs, key=lambda r: r["seconds"])
+        best["peak_rss_mb"] = max(r["peak_rss_mb"] for r in runs)
+        best["rows_per_s"] = best["rows"] / best["seconds"] if best["seconds"] else 0.0
+        best["mb_per_s"] = best["bytes"] / 1024.0**2 / best["seconds"] if best["seconds"] else 0.0
+        results["stages"][stage] = best
+        print("{0:<10} {1:8.2f} s".format(stage, best["seconds"]))
+    return results
+
+# Define function to get the key of an archive size in the baseline file:
+def config_key(config):
+    '''
+    Function to get the key under which results for an archive size are
+    stored in the baseline file.
+
+    PARAMETERS:
+    - config: archive size dictionary
+
+    RETURNS: string key
+    '''
+    return ",".join("{0}={1}".format(k, config[k]) for k in sorted(config))
+
+# Define function to compare results with a baseline:
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''
+    Function to compare benchmark results with baseline results for the same
+    archive size.
+
+    PARAMETERS:
+    - results: results dictionary (from run_benchmark)
+    - baseline: baseline results dictionary (or None)
+    - tolerance: fraction by which a stage may be worse than baseline
+
+    RETURNS: list of (stage, measure, baseline value, new value) regressions
+    '''
+    regressions = []
+    if baseline is None:
+        return regressions
+    for stage, result in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        if result["seconds"] > base["seconds"] * (1 + tolerance) and result["seconds"] > MIN_SECONDS:
+            regressions.append((stage, "seconds", base["seconds"], result["seconds"]))
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+            regressions.append((stage, "peak_rss_mb", base["peak_rss_mb"], result["peak_rss_mb"]))
+    return regressions
+
+# Define function to print the results table:
+def print_results(results, baseline=None):
+    '''
+    Function to print a table of benchmark results, with the change in time
+    from the baseline (if any).
+
+    PARAMETERS:
+    - results: results dictionary (from run_benchmark)
+    - baseline: baseline results dictionary (or None)
+
+    RETURNS: None
+    '''
+    print("")
+    print("{0:<10} {1:>9} {2:>12} {3:>9} {4:>9} {5:>10}".format(
+            "stage", "seconds", "rows/s", "MB/s", "peak MB", "vs base"))
+    for stage, r in results["stages"].items():
+        change = ""
+        if baseline is not None and stage in baseline["stages"] and baseline["stages"][stage]["seconds"]:
+            change = "{0:+.0%}".format(r["seconds"] / baseline["stages"][stage]["seconds"] - 1)
+        print("{0:<10} {1:>9.2f} {2:>12,.0f} {3:>9.1f} {4:>9.0f} {5:>10}".format(
+                stage, r["seconds"], r["rows_per_s"], r["mb_per_s"], r["peak_rss_mb"], change))
+
+# Define function to load the baseline file:
+def load_baselines(baseline_file):
+    '''
+    Function to load stored baseline results.
+
+    PARAMETERS:
+    - baseline_file: path of baseline .json file
+
+    RETURNS: dictionary of baseline results keyed by config_key
+    '''
+    if not os.path.isfile(baseline_file):
+        return {}
+    with open(baseline_file, "r") as f:
+        return json.load(f)
+
+# Define function to save results as the baseline:
+def save_baseline(results, baseline_file):
+    '''
+    Function to store results as the baseline for their archive size (other
+    sizes in the baseline file are kept).
+
+    PARAMETERS:
+    - results: results dictionary (from run_benchmark)
+    - baseline_file: path of baseline .json file
+
+    RETURNS: None
+    '''
+    baselines = load_baselines(baseline_file)
+    baselines[config_key(results["config"])] = results
+    tmp = baseline_file + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(baselines, f, indent=1, sort_keys=True)
+    os.replace(tmp, baseline_file)
+
+# -----------------------------------------------------------------------------
+# MAIN:
+
+# Define function to read the command line options:
+def parse_args(argv=None):
+    '''
+    Function to read the command line options.
+
+    PARAMETERS:
+    - argv: list of options (None for sys.argv)
+
+    RETURNS: argparse namespace
+    '''
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the WQ workflow on a made-up archive.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="small",
+                        help="archive size to start from (default small)")
+    parser.add_argument("--areas", type=int, help="number of EA areas")
+    parser.add_argument("--years", type=int, help="number of years")
+    parser.add_argument("--sites", type=int, help="sampling points per area")
+    parser.add_argument("--determinands", type=int, help="number of determinands")
+    parser.add_argument("--rows", type=int, help="rows per yearly dataset")
+    parser.add_argument("--bytes", type=int, help="size of each yearly dataset (instead of --rows)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help="stages to run (default all)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each stage (fastest kept)")
+    parser.add_argument("--work-dir", help="directory for the archive (default a temporary directory)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline .json file")
+    parser.add_argument("--save-baseline", action="store_true", help="store results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="fraction slower than baseline reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the output of each stage")
+    return parser.parse_args(argv)
+
+# Define function to run the benchmark from the command line:
+def main(argv=None):
+    '''
+    Function to run the benchmark from the command line.
+
+    PARAMETERS:
+    - argv: list of options (None for sys.argv)
+
+    RETURNS: exit status (1 if any stage regressed)
+    '''
+    args = parse_args(argv)
+    config = dict(SCALES[args.scale])
+    for option in ("areas", "years", "sites", "determinands", "rows"):
+        if getattr(args, option) is not None:
+            config[option] = getattr(args, option)
+    if args.bytes is not None:
+        config["rows"] = rows_for_bytes(args.bytes, config["sites"], config["determinands"])
+    print("Benchmark archive: {0}".format(config_key(config)))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wqbench_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = run_benchmark(config, work_dir, args.stages, args.repeat, args.verbose)
+    with open(os.path.join(work_dir, "benchmark_results.json"), "w") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    baseline = load_baselines(args.baseline).get(config_key(config))
+    print_results(results, baseline)
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print("\nBaseline saved to {0}.".format(args.baseline))
+    elif baseline is None:
+        print("\nNo baseline for this archive size (run with --save-baseline to store one).")
+    regressions = compare(results, baseline, args.tolerance)
+    for stage, measure, before, after in regressions:
+        print("REGRESSION: {0} {1} {2:.2f} -> {3:.2f}".format(stage, measure, before, after))
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1 if regressions and not args.save_baseline else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,161 +1,318 @@
-# -*- coding: utf-8 -*-
-"""
-GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
-Independent Project - EA WIMS Water Quality Data Analyser/Viewer
-
-Anne Harding (200754573)
-26/04/2019
-
-WQDataExtractor.py
-
-Script to extract data from downloaded water quality archive for user-specified
-EA water sampling points (as output from 'WQLocsIdentifier.py'). The user may
-also choose here to extract the data for a certain time period only.
-
-Note that the processes in WQLocsIdentifier.py and WQDataExtractor.py were
-intended to be combined in the same script. However, ArcGIS applied a lock to
-the 'wqPoints_clip' file which could not be removed without ending the
-script in which that file was created. Hence, the processes were split into 2
-different ArcGIS Script tools, both of which are still located in the same 
-ArcGIS Toolbox ('WQToolbox.tbx').
-"""
-
-# Import modules:
-import arcpy
-import arcpy.da
-import os
-import pandas as pd
-import numpy as np
-import datetime
-
-# -----------------------------------------------------------------------------
-# FUNCTIONS:
-
-# Define function to filter water quality data using user-specified filters:
-def data_filter(df):
-    '''
-    Function to filter water quality data using user-specified filters for
-    date range and monitoring locations.
-    
-    PARAMETERS:
-    - df: dataframe containing water quality data
-    
-    RETURNS: None
-    '''
-    # Filter dataframe to only keep rows where "sample.samplingPoint.notation"
-    # attribute matches the notation of one of the selected WQ monitoring locs:
-    df = df.loc[df['sample.samplingPoint.notation'].isin(locs)]
-    # Filter dataframe to only keep rows within user-selected time period:
-    df = df[(df['sample.sampleDateTime'] > startDate) & (df['sample.sampleDateTime'] < endDate)]
-    
-# -----------------------------------------------------------------------------
-# PARAMETERS:
-
-# Read in parameter values from toolbox GUI:
-# 0: INPUT - Selected water quality monitoring points.
-# 1: INPUT - Water quality data archive.
-# 2: INPUT - EA operational area.
-# 3: INPUT - Start date (defaults to 01/01/2000).
-# 4: INPUT - End date (defaults to current date).
-# 5: INPUT - Output folder location.
-
-wqPoints_clip = arcpy.GetParameterAsText(0)
-wqArchive = arcpy.GetParameterAsText(1)
-eaArea = arcpy.GetParameterAsText(2)
-startDate = arcpy.GetParameterAsText(3)
-endDate = arcpy.GetParameterAsText(4)
-outDir = arcpy.GetParameterAsText(5)
-
-# TODO - Would like to include an option here which allows the user to select
-# which determinands they are interested in. For future development.
-
-# Reformat startDate and endDate for comparison with dataframe later on: 
-startDate = str(datetime.datetime.strptime(startDate, '%d/%m/%Y'))
-endDate = str(datetime.datetime.strptime(endDate, '%d/%m/%Y'))
-
-# Print statement to manually check re-formatting of dates:
-# arcpy.AddMessage(startDate)
-# arcpy.AddMessage(endDate)
-
-# -----------------------------------------------------------------------------
-# ARC ENVIRONMENTS:
-
-# Allow overwriting of output files:
-arcpy.env.overwriteOutput = True
-# Set workspace:
-arcpy.env.workspace = outDir
-
-# -----------------------------------------------------------------------------
-# GET LIST OF WQ MONITORING LOCATIONS:
-
-# Create empty locs array to hold list of WQ monitoring locations of interest:
-locs = []
-
-arcpy.AddMessage("Identifying WQ monitoring locations selected.")
-
-# Define SearchCursor for .shp containing selected monitoring points:
-# Search Cursor: https://pro.arcgis.com/en/pro-app/arcpy/data-access/searchcursor-class.htm
-# SearchCursor(in_table, field_names, {where_clause}, {spatial_reference}, {explode_to_points}, {sql_clause})
-# Use 'with' statement to prevent relics further down the script.
-with arcpy.da.SearchCursor(wqPoints_clip, '*') as cursor:
-    # Loop through rows in the cursor:
-    for row in cursor:
-        # Print statement to manually check return:
-        # arcpy.AddMessage(row)
-        # Get "notation" attribute for row:
-        loc = row[5]
-        # Append "notation" attribute for row to locs list:
-        locs.append(loc)
-
-arcpy.AddMessage("{0} sites selected:".format(len(locs)))
-for loc in locs:
-    arcpy.AddMessage("  - {0}".format(loc))
-    
-# -----------------------------------------------------------------------------
-# USE LIST OF WQ MONITORING LOCATIONS TO EXTRACT DATA FROM ARCHIVE:    
-
-# Using index of "(" and ")" in eaArea variable to get notation:
-start_loc = eaArea.find("(")
-end_loc = eaArea.find(")")
-eaArea_notation = eaArea[start_loc+1:end_loc]
-# Print statement to manually check eaArea_notation variable:
-# arcpy.AddMessage(eaArea_notation)
-
-# Find required .csv file using wqArchive directory and eaArea:
-datafile = wqArchive + "\\" + "alldata_" + eaArea_notation + ".csv"
-
-arcpy.AddMessage("Collecting archive data from: {0}.".format(datafile))
-
-# Try to read .csv file:
-try:
-    # Read wqArchive .csv into a pandas dataframe:
-    df = pd.read_csv(datafile, header=0)
-    
-    arcpy.AddMessage("Filtering data.")
-    # Call data_filter function using user-specified filters to extract data:
-    df_filtered = data_filter(df)
-
-# Except if memory error is encountered (i.e. file is too large):
-except MemoryError:
-    # Read .csv file into a pandas dataframe in chunks:
-    chunks = pd.read_csv(datafile, sep=',', chunksize=10000)
-    
-    arcpy.AddMessage("Filtering data.")
-    # Filter chunks using list of selected sampling points:
-    chunks = [chunk[chunk['sample.samplingPoint.notation'].isin(locs)] for chunk in chunks]
-    # Filter chunks using user-specified dates:
-    chunks = [chunk[(chunk['sample.sampleDateTime'] > startDate) & (chunk['sample.sampleDateTime'] < endDate)] for chunk in chunks]      
-    
-    # Concatenate filtered chunks into one pandas dataframe:
-    df_filtered = pd.concat(chunks)
-    # Print statement to check filtered dataframe:
-    # arcpy.AddMessage(df_filtered)
-    
-arcpy.AddMessage("Processing data for values below Limit of Detection.")
-# Standard data pre-processing for values below (<) Limit of Detection (LoD)
-# is to halve the value and perform analysis using the halved value:
-df_filtered['resultQualified'] = np.where(df_filtered['resultQualifier.notation'] == '<', df_filtered['result']/2, df_filtered['result'])
-
-arcpy.AddMessage("Exporting filtered data to .csv file.")
-# Writing pandas dataframe to .csv file:
-df_filtered.to_csv(os.path.join(outDir, "selected_data.csv"))
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+Anne Harding (200754573)
+26/04/2019
+
+WQDataExtractor.py
+
+Script to extract data from downloaded water quality archive for user-specified
+EA water sampling points (as output from 'WQLocsIdentifier.py'). The user may
+also choose here to extract the data for a certain time period and/or certain
+determinands only. If the sampling points are in more than one EA operational
+area, the data for all of those areas is extracted (in parallel) into the one
+output file.
+
+Note that the processes in WQLocsIdentifier.py and WQDataExtractor.py were
+intended to be combined in the same script. However, ArcGIS applied a lock to
+the 'wqPoints_clip' file which could not be removed without ending the
+script in which that file was created. Hence, the processes were split into 2
+different ArcGIS Script tools, both of which are still located in the same 
+ArcGIS Toolbox ('WQToolbox.tbx'). Neither step now needs ArcGIS, so
+WQPipeline.py runs them together in one process, passing the sampling points
+found straight to extract_data without writing 'wqPoints_clip.shp' first.
+"""
+
+# Import modules:
+import os
+import sys
+import multiprocessing
+import datetime
+from ParquetArchive import is_parquet_archive
+from ArchiveQuery import find_areas, query_areas
+from WQSchema import write_wq_csv
+from DeterminandCatalogue import load_catalogue, match_determinands
+from StatsCube import StatsCube
+from SeriesStore import write_store, store_dir_for
+from SiteRegistry import archive_sites_file, read_lonlat
+from ResultQualifiers import qualify, DEFAULT_POLICY, POLICY_LABELS
+from QueryCache import QueryCache, default_cache_dir
+from ShapefileIO import read_points
+from PipelineTrace import start_trace, stop_trace, span, count, summary_lines
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to read the notations of the selected sampling points:
+def read_locs(wqPoints_clip):
+    '''
+    Function to read the notations of the sampling points in a shapefile
+    output by WQLocsIdentifier.py (the 'notation' field).
+
+    PARAMETERS:
+    - wqPoints_clip: path of sampling points .shp file
+
+    RETURNS: list of sampling point notations
+    '''
+    return read_points(wqPoints_clip)["notation"].astype(str).tolist()
+
+# Define function to extract the data for the selected sampling points:
+def extract_data(wqArchive, locs, startDate, endDate, outDir, determinands=None,
+                 default_areas=None, log=print, warn=print, cache=None,
+                 lod_policy=DEFAULT_POLICY):
+    '''
+    Function to extract the data for the selected sampling points, date range
+    and determinands from the archive, and write 'selected_data.csv' (plus a
+    .parquet copy for a Parquet archive), the 'selected_stats.csv' statistics
+    cube, the 'selected_data_series' store of each sampling point's series
+    (see SeriesStore.py) and an 'extract_trace.jsonl' trace of timings to
+    outDir.
+
+    PARAMETERS:
+    - wqArchive: .csv or Parquet archive directory
+    - locs: list of sampling point notations
+    - startDate: start of date range (datetime)
+    - endDate: end of date range (datetime)
+    - outDir: output folder location
+    - determinands: list of determinand codes or definitions (None for all)
+    - default_areas: EA area notations to query if the areas holding the
+      sampling points cannot be worked out from the archive (and to use for
+      area files without an index)
+    - log: function to report progress with (e.g. print or arcpy.AddMessage)
+    - warn: function to report warnings with (e.g. arcpy.AddWarning)
+    - cache: QueryCache to read and store results in (None to always read
+      the archive)
+    - lod_policy: policy for results below the Limit of Detection (see
+      ResultQualifiers.py) used for the 'resultQualified' column
+
+    RETURNS: pandas dataframe of extracted data
+    '''
+    # Check if wqArchive is a Parquet archive (see ParquetArchive.py) rather than
+    # a folder of .csv files:
+    parquet = is_parquet_archive(wqArchive)
+
+    # Record time, rows and memory use of each step (and of the reading and
+    # filtering done by the worker processes) in 'extract_trace.jsonl' (see
+    # PipelineTrace.py):
+    trace = start_trace(os.path.join(outDir, "extract_trace.jsonl"))
+
+    # Stop the trace however the extraction ends (so its memory sampler and
+    # file are not left running if a step fails):
+    try:
+        # Work out which EA areas hold data for the selected sampling points, so that
+        # areas of interest crossing an area boundary only need one run. The EA area
+        # chosen by the user is used for area files without an index, and if none
+        # can be found:
+        with span("find_areas", sites=len(locs)):
+            areas = find_areas(wqArchive, locs, default_areas)
+        if not areas:
+            areas = list(default_areas or [])
+        log("Collecting and filtering archive data from {0} EA area(s) in: {1}.".format(len(areas), wqArchive))
+        for area_notation in areas:
+            log("  - {0}".format(area_notation))
+
+        # Check determinands against the determinand catalogue for these areas
+        # (see DeterminandCatalogue.py), so that they can be given by code or by
+        # definition in any case:
+        if determinands:
+            with span("catalogue"):
+                catalogue = load_catalogue(wqArchive, areas)
+            if catalogue is not None:
+                determinands, missing = match_determinands(catalogue, determinands)
+                for determinand in missing:
+                    warn("Determinand not found in archive: {0}".format(determinand))
+                if not determinands:
+                    raise ValueError("None of the determinands selected are in the archive for these areas.")
+            log("{0} determinands selected:".format(len(determinands)))
+            for determinand in determinands:
+                log("  - {0}".format(determinand))
+
+        # Extract data using user-specified filters. The filters are applied while the
+        # archive is being read (see ArchiveQuery.py), so only the matching rows are
+        # ever held in memory. Each area is read by its own worker process and the
+        # results merged. If determinands were chosen, only their rows are kept.
+        # With a query cache (see QueryCache.py), sampling points already
+        # extracted for this date range and archive are read from the cache and
+        # only the rest are extracted:
+        with span("query", areas=len(areas)):
+            if cache is None:
+                df_filtered = query_areas(wqArchive, areas, locs, startDate, endDate, determinands)
+            else:
+                df_filtered = cache.query(wqArchive, areas, locs, startDate, endDate, determinands)
+                log("{0} of {1} sites read from query cache ({2} more extended to the "
+                    "dates not cached).".format(cache.hits, cache.hits + cache.misses, cache.extended))
+        log("{0} rows extracted.".format(len(df_filtered)))
+        # Print statement to check filtered dataframe:
+        # log(df_filtered)
+
+        log("Processing data for values below Limit of Detection ({0}).".format(POLICY_LABELS[lod_policy]))
+        # Standard data pre-processing for values below (<) Limit of Detection (LoD)
+        # is to halve the value and perform analysis using the halved value. Other
+        # policies can be chosen (see ResultQualifiers.py); the qualifier codes
+        # they use were worked out while the archive was read:
+        with span("lod"):
+            df_filtered = qualify(df_filtered, lod_policy)
+
+        log("Exporting filtered data to .csv file.")
+        # Writing pandas dataframe to .csv file (with dates in the archive's format,
+        # see WQSchema.py):
+        with span("write"):
+            write_wq_csv(df_filtered, os.path.join(outDir, "selected_data.csv"))
+            count("bytes", os.path.getsize(os.path.join(outDir, "selected_data.csv")))
+
+        log("Calculating summary statistics for each sampling point.")
+        # Pre-calculate statistics for each sampling point, determinand and year
+        # (see StatsCube.py), which DataViewer.ipynb uses for its statistics table:
+        with span("stats"):
+            cube = StatsCube(os.path.join(outDir, "selected_stats.csv"), load=False)
+            cube.add_frame(df_filtered)
+            cube.save()
+
+        if parquet:
+            log("Exporting filtered data to .parquet file.")
+            # Also write a typed, compressed copy which DataViewer.ipynb can read:
+            with span("write.parquet"):
+                df_filtered.to_parquet(os.path.join(outDir, "selected_data.parquet"), index=False)
+
+        log("Writing series store.")
+        # Save each sampling point's series for each determinand as contiguous
+        # arrays (see SeriesStore.py), which DataViewer.ipynb opens memory-mapped
+        # rather than reading the data file. The longitude/latitude of each
+        # sampling point held by the registry (exported with the archive) is saved
+        # with it, so the map does not need to convert the coordinates again:
+        with span("write.series"):
+            write_store(df_filtered, store_dir_for(os.path.join(outDir, "selected_data.csv")),
+                        os.path.join(outDir, "selected_data.csv"),
+                        read_lonlat(archive_sites_file(wqArchive)))
+    finally:
+        stop_trace()
+
+    # Show where the time went:
+    log("Timings (also saved to {0}):".format(trace.path))
+    for line in summary_lines(trace.path):
+        log(line)
+
+    return df_filtered
+
+# -----------------------------------------------------------------------------
+# RUN TOOL:
+
+# The tool only runs when this script is run by ArcGIS (not when it is
+# re-imported by the worker processes started by ArchiveQuery.query_areas, or
+# imported by WQPipeline.py):
+if __name__ == "__main__":
+    import arcpy
+    import arcpy.da
+
+    # Worker processes must be started with python.exe rather than the ArcGIS
+    # application running this script:
+    if not os.path.basename(sys.executable).lower().startswith("python"):
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+
+    # -------------------------------------------------------------------------
+    # PARAMETERS:
+
+    # Read in parameter values from toolbox GUI:
+    # 0: INPUT - Selected water quality monitoring points.
+    # 1: INPUT - Water quality data archive.
+    # 2: INPUT - EA operational area (only used if the areas holding the
+    #    selected points cannot be worked out from the archive).
+    # 3: INPUT - Start date (defaults to 01/01/2000).
+    # 4: INPUT - End date (defaults to current date).
+    # 5: INPUT - Output folder location.
+    # 6: INPUT - Determinands (optional; codes or definitions separated by
+    #    ";", e.g. "0076;Ammoniacal Nitrogen as N". All if not given).
+    # 7: INPUT - Limit of Detection policy (optional; 'half', 'zero', 'lod' or
+    #    'censored', see ResultQualifiers.py. 'half' if not given).
+    # 8: INPUT - Query cache size in MB (optional; results are kept in a
+    #    query cache next to the archive up to this size, see QueryCache.py.
+    #    No cache if not given or 0).
+
+    wqPoints_clip = arcpy.GetParameterAsText(0)
+    wqArchive = arcpy.GetParameterAsText(1)
+    eaArea = arcpy.GetParameterAsText(2)
+    startDate = arcpy.GetParameterAsText(3)
+    endDate = arcpy.GetParameterAsText(4)
+    outDir = arcpy.GetParameterAsText(5)
+
+    # Determinands parameter is optional (and not in older copies of the
+    # toolbox). Multivalue parameters are returned as "a;'b c'":
+    determinands = None
+    if arcpy.GetArgumentCount() > 6 and arcpy.GetParameterAsText(6):
+        determinands = [d.strip().strip("'\"") for d in arcpy.GetParameterAsText(6).split(";")]
+        determinands = [d for d in determinands if d]
+
+    # Limit of Detection policy parameter is optional too:
+    lod_policy = DEFAULT_POLICY
+    if arcpy.GetArgumentCount() > 7 and arcpy.GetParameterAsText(7):
+        lod_policy = arcpy.GetParameterAsText(7)
+
+    # Query cache size parameter is optional too (the cache is only used if a
+    # size is given, so nothing is written next to the archive otherwise):
+    cache_size = 0
+    if arcpy.GetArgumentCount() > 8 and arcpy.GetParameterAsText(8):
+        cache_size = float(arcpy.GetParameterAsText(8))
+
+    # Reformat startDate and endDate for comparison with dataframe later on: 
+    startDate = datetime.datetime.strptime(startDate, '%d/%m/%Y')
+    endDate = datetime.datetime.strptime(endDate, '%d/%m/%Y')
+
+    # Print statement to manually check re-formatting of dates:
+    # arcpy.AddMessage(startDate)
+    # arcpy.AddMessage(endDate)
+
+    # -------------------------------------------------------------------------
+    # ARC ENVIRONMENTS:
+
+    # Allow overwriting of output files:
+    arcpy.env.overwriteOutput = True
+    # Set workspace:
+    arcpy.env.workspace = outDir
+
+    # -------------------------------------------------------------------------
+    # GET LIST OF WQ MONITORING LOCATIONS:
+
+    # Create empty locs array to hold list of WQ monitoring locations of interest:
+    locs = []
+
+    arcpy.AddMessage("Identifying WQ monitoring locations selected.")
+
+    # Define SearchCursor for .shp containing selected monitoring points:
+    # Search Cursor: https://pro.arcgis.com/en/pro-app/arcpy/data-access/searchcursor-class.htm
+    # SearchCursor(in_table, field_names, {where_clause}, {spatial_reference}, {explode_to_points}, {sql_clause})
+    # Use 'with' statement to prevent relics further down the script.
+    with arcpy.da.SearchCursor(wqPoints_clip, '*') as cursor:
+        # Loop through rows in the cursor:
+        for row in cursor:
+            # Print statement to manually check return:
+            # arcpy.AddMessage(row)
+            # Get "notation" attribute for row:
+            loc = row[5]
+            # Append "notation" attribute for row to locs list:
+            locs.append(loc)
+
+    arcpy.AddMessage("{0} sites selected:".format(len(locs)))
+    for loc in locs:
+        arcpy.AddMessage("  - {0}".format(loc))
+
+    # -------------------------------------------------------------------------
+    # USE LIST OF WQ MONITORING LOCATIONS TO EXTRACT DATA FROM ARCHIVE:    
+
+    # Using index of "(" and ")" in eaArea variable to get notation:
+    start_loc = eaArea.find("(")
+    end_loc = eaArea.find(")")
+    eaArea_notation = eaArea[start_loc+1:end_loc]
+    # Print statement to manually check eaArea_notation variable:
+    # arcpy.AddMessage(eaArea_notation)
+
+    # If a cache size was given, keep the results for each sampling point in a
+    # query cache next to the archive, so later runs for the same or
+    # overlapping areas are quicker:
+    cache = None
+    if cache_size > 0:
+        cache = QueryCache(default_cache_dir(wqArchive), int(cache_size * 1024 ** 2))
+    extract_data(wqArchive, locs, startDate, endDate, outDir, determinands,
+                 default_areas=[eaArea_notation], log=arcpy.AddMessage,
+                 warn=arcpy.AddWarning, cache=cache, lod_policy=lod_policy)
@@ -1,77 +1,159 @@
-# -*- coding: utf-8 -*-
-"""
-GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
-Independent Project - EA WIMS Water Quality Data Analyser/Viewer
-
-Anne Harding (200754573)
-04/05/2019
-
-WQLocsIdentifier.py
-
-ArcGIS Script tool to identify EA water quality sampling points within a user-
-specified region (identified by input .shp for area of interest). Outputs a
-.shp file containing locations of identified sampling points. This output .shp
-may then be used as an input parameter in WQDataExtractor to extract the data.
-
-Note that the processes in WQLocsIdentifier.py and WQDataExtractor.py were
-intended to be combined in the same script. However, ArcGIS applied a lock to
-the 'wqPoints_clip' file which could not be removed without ending the
-script in which that file was created. Hence, the processes were split into 2
-different ArcGIS Script tools, both of which are still located in the same 
-ArcGIS Toolbox ('WQToolbox.tbx').
-"""
-
-# Import modules:
-import arcpy
-import os
-
-# -----------------------------------------------------------------------------
-# PARAMETERS:
-
-# Read in parameter values from toolbox GUI:
-# 0: INPUT - Water quality monitoring points.
-# 1: INPUT - Shapefile for area of interest.
-# 2: INPUT - Output folder location. 
-
-wqPoints = arcpy.GetParameterAsText(0)
-areaOfInterest = arcpy.GetParameterAsText(1)
-outDir = arcpy.GetParameterAsText(2)
-
-# -----------------------------------------------------------------------------
-# ARC ENVIRONMENTS:
-
-# Allow overwriting of output files:
-arcpy.env.overwriteOutput = True
-# Set workspace:
-arcpy.env.workspace = outDir
-
-# -----------------------------------------------------------------------------
-
-# Define location of output files:
-wqPoints_clip = os.path.join(outDir, "wqPoints_clip.shp")
-
-# Clip wqPoints shapefile using areaOfInterest shapefile:
-# Clip:  https://pro.arcgis.com/en/pro-app/tool-reference/analysis/clip.htm
-# Clip_analysis (in_features, clip_features, out_feature_class, {cluster_tolerance})
-arcpy.Clip_analysis(wqPoints, areaOfInterest, wqPoints_clip)
-
-'''
-# ALTERNATIVE METHOD OF SELECTING DATA BY LOCATION AND SAVING AS .SHP:
-# USING CLIP TOOL IS FASTER AND MORE EFFICIENT.
-
-# Make Feature Layer:
-arcpy.MakeFeatureLayer_management(wqPoints, "wqPoints_lyr")
-
-# Select Layer By Location: http://desktop.arcgis.com/en/arcmap/10.3/tools/data-management-toolbox/select-layer-by-location.htm
-# SelectLayerByLocation_management (in_layer, {overlap_type}, {select_features}, {search_distance}, {selection_type}, {invert_spatial_relationship})
-arcpy.SelectLayerByLocation_management("wqPoints_lyr", "WITHIN", areaOfInterest)
-
-# Get Count: https://pro.arcgis.com/en/pro-app/tool-reference/data-management/get-count.htm
-# GetCount_management (in_rows)
-count = int(arcpy.GetCount_management("wqPoints_lyr")[0])
-arcpy.AddMessage(count)
-
-# Copy Features: https://pro.arcgis.com/en/pro-app/tool-reference/data-management/copy-features.htm
-# CopyFeatures_management (in_features, out_feature_class, {config_keyword}, {spatial_grid_1}, {spatial_grid_2}, {spatial_grid_3})
-arcpy.CopyFeatures_management("wqPoints_lyr", wqPoints_clip)
-'''
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+Anne Harding (200754573)
+04/05/2019
+
+WQLocsIdentifier.py
+
+ArcGIS Script tool to identify EA water quality sampling points within a user-
+specified region (identified by input .shp for area of interest). Outputs a
+.shp file containing locations of identified sampling points. This output .shp
+may then be used as an input parameter in WQDataExtractor to extract the data.
+
+Note that the processes in WQLocsIdentifier.py and WQDataExtractor.py were
+intended to be combined in the same script. However, ArcGIS applied a lock to
+the 'wqPoints_clip' file which could not be removed without ending the
+script in which that file was created. Hence, the processes were split into 2
+different ArcGIS Script tools, both of which are still located in the same 
+ArcGIS Toolbox ('WQToolbox.tbx'). Neither step now needs ArcGIS, so
+WQPipeline.py runs them together in one process, passing the sampling points
+found straight to the extraction without writing 'wqPoints_clip.shp' first.
+"""
+
+# Import modules:
+import os
+from SpatialIndex import identify_sites
+from SiteRegistry import write_sites_shapefile
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to identify sampling points within an area of interest:
+def identify_locations(wqPoints, areaOfInterest, log=print):
+    '''
+    Function to find the sampling points within an area of interest using
+    SpatialIndex.py, which reads the shapefiles directly and does not need
+    ArcGIS (both must be shapefiles in British National Grid, otherwise a
+    ValueError is raised).
+
+    PARAMETERS:
+    - wqPoints: sampling points .shp file (e.g. 'england_wq_locs.shp'), or
+      dataframe of sampling points with 'x' and 'y' columns
+    - areaOfInterest: area of interest polygon .shp file, or list of polygons
+    - log: function to report progress with (e.g. print or arcpy.AddMessage)
+
+    RETURNS: dataframe of sampling points inside (indexed by FID)
+    '''
+    log("Identifying WQ monitoring locations within area of interest.")
+    sites = identify_sites(wqPoints, areaOfInterest)
+    log("{0} sites found.".format(len(sites)))
+    return sites
+
+# Define function to write identified sampling points to a shapefile:
+def write_locations(sites, shp_file):
+    '''
+    Function to write identified sampling points to a point shapefile with
+    the same fields as 'england_wq_locs.shp' (see SiteRegistry.py).
+
+    PARAMETERS:
+    - sites: dataframe of sampling points (from identify_locations)
+    - shp_file: path of .shp file to write
+
+    RETURNS: number of points written
+    '''
+    return write_sites_shapefile(shp_file, sites["notation"].values, sites["label"].values,
+                                 sites["x"].values, sites["y"].values)
+
+# -----------------------------------------------------------------------------
+# RUN TOOL:
+
+# The tool only runs when this script is run by ArcGIS (the functions above
+# can also be imported, e.g. by WQPipeline.py):
+if __name__ == "__main__":
+    import arcpy
+
+    # -------------------------------------------------------------------------
+    # PARAMETERS:
+
+    # Read in parameter values from toolbox GUI:
+    # 0: INPUT - Water quality monitoring points.
+    # 1: INPUT - Shapefile for area of interest.
+    # 2: INPUT - Output folder location. 
+
+    wqPoints = arcpy.GetParameterAsText(0)
+    areaOfInterest = arcpy.GetParameterAsText(1)
+    outDir = arcpy.GetParameterAsText(2)
+
+    # -------------------------------------------------------------------------
+    # ARC ENVIRONMENTS:
+
+    # Allow overwriting of output files:
+    arcpy.env.overwriteOutput = True
+    # Set workspace:
+    arcpy.env.workspace = outDir
+
+    # -------------------------------------------------------------------------
+
+    # Define location of output files:
+    wqPoints_clip = os.path.join(outDir, "wqPoints_clip.shp")
+
+    # The sampling points are read straight from the shapefile (selected
+    # below by FID), so they must be a shapefile:
+    wqPoints_file = arcpy.Describe(wqPoints).catalogPath
+    if os.path.splitext(wqPoints_file)[1].lower() != ".shp":
+        arcpy.AddError("{0} is not a shapefile. Use 'england_wq_locs.shp' (or export "
+                       "the sampling points to a shapefile).".format(wqPoints_file))
+        raise arcpy.ExecuteError
+
+    # Clip_analysis reprojected the area of interest on the fly. Instead, an
+    # area of interest which is not a shapefile in British National Grid
+    # (e.g. a geodatabase feature class, or WGS84) is projected to one first:
+    aoi = arcpy.Describe(areaOfInterest)
+    aoi_file = aoi.catalogPath
+    if (os.path.splitext(aoi_file)[1].lower() != ".shp" or
+            aoi.spatialReference.factoryCode != 27700):
+        arcpy.AddMessage("Projecting area of interest to British National Grid.")
+        aoi_file = os.path.join(outDir, "aoi_bng.shp")
+        arcpy.Project_management(areaOfInterest, aoi_file, arcpy.SpatialReference(27700))
+
+    # Find sampling points within areaOfInterest:
+    sites = identify_locations(wqPoints_file, aoi_file, arcpy.AddMessage)
+
+    # Copy identified sampling points (by FID) to output shapefile, keeping
+    # all the fields of the input layer:
+    # Select: https://pro.arcgis.com/en/pro-app/tool-reference/analysis/select.htm
+    # Select_analysis (in_features, out_feature_class, {where_clause})
+    fids = ",".join(str(fid) for fid in sites.index) or "-1"
+    arcpy.Select_analysis(wqPoints, wqPoints_clip, '"FID" IN ({0})'.format(fids))
+
+    '''
+    # PREVIOUS METHOD USING CLIP TOOL:
+    # Clip wqPoints shapefile using areaOfInterest shapefile:
+    # Clip:  https://pro.arcgis.com/en/pro-app/tool-reference/analysis/clip.htm
+    # Clip_analysis (in_features, clip_features, out_feature_class, {cluster_tolerance})
+    arcpy.Clip_analysis(wqPoints, areaOfInterest, wqPoints_clip)
+    '''
+
+    '''
+    # ALTERNATIVE METHOD OF SELECTING DATA BY LOCATION AND SAVING AS .SHP:
+    # USING CLIP TOOL IS FASTER AND MORE EFFICIENT.
+
+    # Make Feature Layer:
+    arcpy.MakeFeatureLayer_management(wqPoints, "wqPoints_lyr")
+
+    # Select Layer By Location: http://desktop.arcgis.com/en/arcmap/10.3/tools/data-management-toolbox/select-layer-by-location.htm
+    # SelectLayerByLocation_management (in_layer, {overlap_type}, {select_features}, {search_distance}, {selection_type}, {invert_spatial_relationship})
+    arcpy.SelectLayerByLocation_management("wqPoints_lyr", "WITHIN", areaOfInterest)
+
+    # Get Count: https://pro.arcgis.com/en/pro-app/tool-reference/data-management/get-count.htm
+    # GetCount_management (in_rows)
+    count = int(arcpy.GetCount_management("wqPoints_lyr")[0])
+    arcpy.AddMessage(count)
+
+    # Copy Features: https://pro.arcgis.com/en/pro-app/tool-reference/data-management/copy-features.htm
+    # CopyFeatures_management (in_features, out_feature_class, {config_keyword}, {spatial_grid_1}, {spatial_grid_2}, {spatial_grid_3})
+    arcpy.CopyFeatures_management("wqPoints_lyr", wqPoints_clip)
+    '''
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+WQPipeline.py
+
+Command line driver and pipeline runner for the scripts, so that they can be
+run without ArcGIS, from other scripts, or in batches.
+
+The Pipeline class keeps the sampling point layer and its grid index (see
+SpatialIndex.py) in memory and runs identification and extraction for each
+area of interest in turn, passing the sampling points found straight to the
+extraction. This does away with writing and re-reading 'wqPoints_clip.shp'
+between the two ArcGIS tools (which was only needed because ArcGIS locked
+that file), and many areas of interest can be run back-to-back in one
+process without the start-up time of the ArcGIS tools. Results for each
+sampling point are kept in a query cache (see QueryCache.py), so repeat and
+overlapping areas of interest are mostly read from the cache.
+
+Example (from a command prompt):
+    python WQPipeline.py refresh Z:/GEOG5790/project/data
+    python WQPipeline.py locations areas_dir shp_dir
+    python WQPipeline.py identify england_wq_locs.shp aoi.shp out_dir
+    python WQPipeline.py extract out_dir/wqPoints_clip.shp areas_dir out_dir
+    python WQPipeline.py run england_wq_locs.shp areas_dir out_dir aoi1.shp aoi2.shp
+
+Example (from Python):
+    pipeline = Pipeline("england_wq_locs.shp", "areas_dir")
+    for aoi in ["aoi1.shp", "aoi2.shp"]:
+        df = pipeline.run(aoi, os.path.join("out_dir", aoi[:-4]))
+"""
+
+# Import modules:
+import os
+import sys
+import argparse
+import datetime
+from ShapefileIO import read_points, read_polygons, require_bng
+from SpatialIndex import PointGrid, points_in_polygons, CELL_SIZE
+from WQLocsIdentifier import identify_locations, write_locations
+from WQDataExtractor import read_locs, extract_data
+from QueryCache import QueryCache, default_cache_dir, CACHE_SIZE
+from ResultQualifiers import POLICIES, DEFAULT_POLICY
+
+# Format of dates given on the command line (as in the ArcGIS tools):
+DATE_FORMAT = "%d/%m/%Y"
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define class to run areas of interest through the pipeline:
+class Pipeline:
+    '''
+    Class to hold the sampling point layer and its grid index in memory and
+    run identification and extraction for one area of interest after another.
+
+    PARAMETERS:
+    - wqPoints: sampling points .shp file (e.g. 'england_wq_locs.shp'), or
+      dataframe of sampling points with 'x', 'y' and 'notation' columns
+    - wqArchive: .csv or Parquet archive directory
+    - log: function to report progress with
+    - warn: function to report warnings with
+    - cache_dir: query cache directory (None for default location next to
+      the archive, False for no cache)
+    - cache_size: size limit of query cache in bytes
+    '''
+    def __init__(self, wqPoints, wqArchive, log=print, warn=print, cache_dir=None,
+                 cache_size=CACHE_SIZE):
+        if isinstance(wqPoints, str):
+            require_bng(wqPoints)
+            wqPoints = read_points(wqPoints)
+        self.sites = wqPoints
+        self.grid = PointGrid(self.sites["x"].values, self.sites["y"].values, CELL_SIZE)
+        self.wqArchive = wqArchive
+        self.log = log
+        self.warn = warn
+        self.cache = None
+        if cache_dir is not False:
+            self.cache = QueryCache(cache_dir or default_cache_dir(wqArchive), cache_size)
+
+    def identify(self, areaOfInterest):
+        '''
+        Function to find the sampling points within an area of interest,
+        using the grid index built when the pipeline was created.
+
+        PARAMETERS:
+        - areaOfInterest: area of interest polygon .shp file, or list of
+          polygons
+
+        RETURNS: dataframe of sampling points inside
+        '''
+        if isinstance(areaOfInterest, str):
+            areaOfInterest = read_polygons(areaOfInterest)
+        sites = self.sites.iloc[points_in_polygons(self.grid, areaOfInterest)]
+        self.log("{0} sites found.".format(len(sites)))
+        return sites
+
+    def run(self, areaOfInterest, outDir, startDate=None, endDate=None,
+            determinands=None, write_clip=False, lod_policy=DEFAULT_POLICY):
+        '''
+        Function to identify the sampling points within an area of interest
+        and extract their data into outDir (see WQDataExtractor.extract_data).
+
+        PARAMETERS:
+        - areaOfInterest: area of interest polygon .shp file, or list of
+          polygons
+        - outDir: output folder location (created if it does not exist)
+        - startDate: start of date range (None for no limit)
+        - endDate: end of date range (None for no limit)
+        - determinands: list of determinand codes or definitions (None for all)
+        - write_clip: True to also write the sampling points found to
+          'wqPoints_clip.shp' in outDir
+        - lod_policy: policy for results below the Limit of Detection (see
+          ResultQualifiers.py)
+
+        RETURNS: pandas dataframe of extracted data (None if no sampling points
+        were found)
+        '''
+        os.makedirs(outDir, exist_ok=True)
+        sites = self.identify(areaOfInterest)
+        if write_clip:
+            write_locations(sites, os.path.join(outDir, "wqPoints_clip.shp"))
+        if not len(sites):
+            self.warn("No sampling points within area of interest.")
+            return None
+        locs = sites["notation"].astype(str).tolist()
+        return extract_data(self.wqArchive, locs, startDate, endDate, outDir, determinands,
+                            log=self.log, warn=self.warn, cache=self.cache,
+                            lod_policy=lod_policy)
+
+# Define function to read a date given on the command line:
+def parse_date(text):
+    '''
+    Function to read a date given on the command line as dd/mm/yyyy.
+
+    PARAMETERS:
+    - text: date as text
+
+    RETURNS: datetime
+    '''
+    try:
+        return datetime.datetime.strptime(text, DATE_FORMAT)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Date must be dd/mm/yyyy: {0}".format(text))
+
+# Define function to read the command line options:
+def parse_args(argv=None):
+    '''
+    Function to read the command line options.
+
+    PARAMETERS:
+    - argv: list of options (None for sys.argv)
+
+    RETURNS: argparse namespace
+    '''
+    parser = argparse.ArgumentParser(description="Run the EA water quality scripts without ArcGIS.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    refresh = commands.add_parser("refresh", help="download and combine the archive (CSVDownloader.py)")
+    refresh.add_argument("data_dir", help="data directory (manifest, registry, downloads)")
+    refresh.add_argument("--areas-file", help="EA areas .csv file (default data_dir/ea-area.csv)")
+    refresh.add_argument("--first-year", type=int, default=2000, help="first year to download")
+    refresh.add_argument("--workers", type=int, default=8, help="download threads")
+    refresh.add_argument("--per-host", type=int, default=4, help="simultaneous requests to server")
+    refresh.add_argument("--compress", action="store_true", help="gzip yearly files")
+    refresh.add_argument("--all-england", action="store_true", help="also write alldata.csv")
+    refresh.add_argument("--parquet", action="store_true", help="also build Parquet archive")
+    refresh.add_argument("--attempts", type=int, default=5, help="tries per dataset before giving up")
+
+    locations = commands.add_parser("locations", help="write sampling point shapefiles (CSVtoSHP.py)")
+    locations.add_argument("csv_dir", help="directory of area .csv files (or Parquet archive)")
+    locations.add_argument("shp_dir", help="directory to write .shp files to")
+
+    identify = commands.add_parser("identify", help="find sampling points in an area (WQLocsIdentifier.py)")
+    identify.add_argument("wq_points", help="sampling points .shp file")
+    identify.add_argument("aoi", help="area of interest .shp file")
+    identify.add_argument("out_dir", help="folder to write wqPoints_clip.shp to")
+
+    # Options shared by extract and run:
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("--start", type=parse_date, help="start date (dd/mm/yyyy)")
+    filters.add_argument("--end", type=parse_date, help="end date (dd/mm/yyyy)")
+    filters.add_argument("--determinands", nargs="+", help="determinand codes or definitions")
+    filters.add_argument("--cache-dir", help="query cache directory (default next to archive)")
+    filters.add_argument("--cache-size", type=float, default=CACHE_SIZE / 1024 ** 2,
+                         help="size limit of query cache in MB")
+    filters.add_argument("--no-cache", action="store_true", help="always read the archive")
+    filters.add_argument("--lod-policy", choices=list(POLICIES), default=DEFAULT_POLICY,
+                         help="policy for results below the Limit of Detection")
+
+    extract = commands.add_parser("extract", parents=[filters],
+                                  help="extract data for selected points (WQDataExtractor.py)")
+    extract.add_argument("wq_points_clip", help="selected sampling points .shp file")
+    extract.add_argument("archive", help=".csv or Parquet archive directory")
+    extract.add_argument("out_dir", help="output folder")
+    extract.add_argument("--area", help="EA area to use if areas cannot be worked out")
+
+    run = commands.add_parser("run", parents=[filters],
+                              help="identify and extract for one or more areas of interest")
+    run.add_argument("wq_points", help="sampling points .shp file")
+    run.add_argument("archive", help=".csv or Parquet archive directory")
+    run.add_argument("out_dir", help="output folder (one subfolder per area of interest)")
+    run.add_argument("aoi", nargs="+", help="area of interest .shp files")
+    run.add_argument("--write-clip", action="store_true", help="also write wqPoints_clip.shp")
+    return parser.parse_args(argv)
+
+# Define function to run the command line driver:
+def main(argv=None):
+    '''
+    Function to run a script from the command line.
+
+    PARAMETERS:
+    - argv: list of options (None for sys.argv)
+
+    RETURNS: exit status
+    '''
+    args = parse_args(argv)
+    if args.command == "refresh":
+        from CSVDownloader import read_areas, refresh_archive
+        areas_file = args.areas_file or os.path.join(args.data_dir, "ea-area.csv")
+        refresh_archive(args.data_dir, read_areas(areas_file), first_year=args.first_year,
+                        max_workers=args.workers, max_per_host=args.per_host,
+                        compress=args.compress, all_england=args.all_england,
+                        write_parquet=args.parquet, attempts=args.attempts)
+    elif args.command == "locations":
+        from CSVtoSHP import build_locations
+        os.makedirs(args.shp_dir, exist_ok=True)
+        build_locations(args.csv_dir, args.shp_dir)
+    elif args.command == "identify":
+        os.makedirs(args.out_dir, exist_ok=True)
+        sites = identify_locations(args.wq_points, args.aoi)
+        write_locations(sites, os.path.join(args.out_dir, "wqPoints_clip.shp"))
+    elif args.command == "extract":
+        os.makedirs(args.out_dir, exist_ok=True)
+        cache = None
+        if not args.no_cache:
+            cache = QueryCache(args.cache_dir or default_cache_dir(args.archive),
+                               int(args.cache_size * 1024 ** 2))
+        extract_data(args.archive, read_locs(args.wq_points_clip), args.start, args.end,
+                     args.out_dir, args.determinands,
+                     default_areas=[args.area] if args.area else None, cache=cache,
+                     lod_policy=args.lod_policy)
+    elif args.command == "run":
+        pipeline = Pipeline(args.wq_points, args.archive,
+                            cache_dir=False if args.no_cache else args.cache_dir,
+                            cache_size=int(args.cache_size * 1024 ** 2))
+        for aoi in args.aoi:
+            print("Area of interest: {0}".format(aoi))
+            name = os.path.splitext(os.path.basename(aoi))[0]
+            pipeline.run(aoi, os.path.join(args.out_dir, name), args.start, args.end,
+                         args.determinands, args.write_clip, args.lod_policy)
+    return 0
+
+# -----------------------------------------------------------------------------
+# RUN SCRIPT:
+
+# Only run when this script is run directly (not when it is re-imported by the
+# worker processes started by ArchiveQuery.query_areas):
+if __name__ == "__main__":
+    sys.exit(main())
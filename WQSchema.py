@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+GEOG5790 - Programming for Geographical Information Analysis: Advanced Skills
+Independent Project - EA WIMS Water Quality Data Analyser/Viewer
+
+WQSchema.py
+
+Shared column types for water quality measurement data, so that every stage
+(ArchiveQuery.py, CSVtoSHP.py, WQDataExtractor.py, ParquetArchive.py) and
+DataViewer.ipynb loads the data in the same compact form:
+
+- Text columns which repeat the same few values on every row (determinand,
+  unit, qualifier, sampling point, etc.) are held as pandas categoricals, so
+  each distinct value is only stored once.
+- Eastings/northings are downcast to float32 (exact for British National
+  Grid coordinates, and unlike an integer type can hold missing values).
+- 'sample.sampleDateTime' is parsed into datetimes, so date filters and
+  sorting are true date comparisons rather than text comparisons.
+
+Columns which are not listed (e.g. '@id', which is different on every row)
+are read as text.
+"""
+
+# Import modules:
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Columns of repeated text to hold as categoricals (codes such as
+# determinand.notation '0076' are kept as text, with leading zeros):
+CATEGORY_COLUMNS = ["sample.samplingPoint",
+                    "sample.samplingPoint.notation",
+                    "sample.samplingPoint.label",
+                    "determinand.label",
+                    "determinand.definition",
+                    "determinand.notation",
+                    "determinand.unit.label",
+                    "resultQualifier.notation",
+                    "codedResultInterpretation.interpretation",
+                    "sample.sampledMaterialType.label",
+                    "sample.purpose.label"]
+
+# Numeric and true/false columns:
+NUMERIC_TYPES = {"result": "float64",
+                 "sample.samplingPoint.easting": "float32",
+                 "sample.samplingPoint.northing": "float32",
+                 "sample.isComplianceSample": "boolean",
+                 "resultQualifier.code": "int8"}
+
+# Date columns, their type (to the nearest second, as in the archive) and the
+# format they are written back out in:
+DATE_COLUMNS = ["sample.sampleDateTime"]
+DATE_TYPE = "datetime64[s]"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# -----------------------------------------------------------------------------
+# FUNCTIONS:
+
+# Define function to get the read_csv dtypes for a set of columns:
+def read_dtypes(columns=None, dates_as_text=True):
+    '''
+    Function to get the dtype argument for pandas.read_csv. Dates are read as
+    text (and parsed by apply_schema) so that they are only parsed for rows
+    which are kept.
+
+    PARAMETERS:
+    - columns: list of columns being read (None for all schema columns)
+    - dates_as_text: True to read date columns as text
+
+    RETURNS: dictionary of column name to dtype
+    '''
+    dtypes = {col: "category" for col in CATEGORY_COLUMNS}
+    dtypes.update(NUMERIC_TYPES)
+    if dates_as_text:
+        dtypes.update({col: str for col in DATE_COLUMNS})
+    if columns is not None:
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+    return dtypes
+
+# Define function to convert a dataframe to the schema types:
+def apply_schema(df):
+    '''
+    Function to convert the columns of a water quality dataframe to the
+    schema types (skipping any columns which are already converted or are
+    not in the dataframe).
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data
+
+    RETURNS: converted dataframe
+    '''
+    df = df.copy(deep=False)
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    for col, dtype in NUMERIC_TYPES.items():
+        if col in df.columns and df[col].dtype != dtype:
+            if dtype == "boolean" and not pd.api.types.is_bool_dtype(df[col].dtype):
+                df[col] = df[col].astype(str).str.lower().map({"true": True, "false": False})
+            df[col] = df[col].astype(dtype)
+    for col in DATE_COLUMNS:
+        if col in df.columns and df[col].dtype != DATE_TYPE:
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col], format="ISO8601", errors="coerce")
+            df[col] = df[col].astype(DATE_TYPE)
+    return df
+
+# Define function to join dataframes without losing categoricals:
+def concat_frames(frames):
+    '''
+    Function to join a list of dataframes (e.g. filtered chunks of a file)
+    into one. Categorical columns are given the same categories first, as
+    pandas would otherwise turn them back into text, and any categories no
+    longer used are dropped afterwards.
+
+    PARAMETERS:
+    - frames: list of pandas dataframes (with the same or similar columns)
+
+    RETURNS: pandas dataframe
+    '''
+    frames = [frame.copy(deep=False) for frame in frames]
+    for col in frames[0].columns:
+        if all(col in frame.columns and isinstance(frame[col].dtype, pd.CategoricalDtype)
+               for frame in frames):
+            categories = union_categoricals([frame[col] for frame in frames],
+                                            ignore_order=True).categories
+            for frame in frames:
+                frame[col] = frame[col].cat.set_categories(categories)
+    df = pd.concat(frames, ignore_index=True)
+    # Drop categories which were only in rows filtered out of the chunks:
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].cat.remove_unused_categories()
+    return df
+
+# Define function to read a water quality .csv file using the schema:
+def read_wq_csv(source, usecols=None, **kwargs):
+    '''
+    Function to read a water quality .csv file (e.g. an 'alldata_<area>.csv'
+    archive file or 'selected_data.csv') with the schema types.
+
+    PARAMETERS:
+    - source: path of .csv file (or file object)
+    - usecols: list of columns to read (None for all)
+    - kwargs: other arguments for pandas.read_csv (not chunksize)
+
+    RETURNS: pandas dataframe
+    '''
+    df = pd.read_csv(source, usecols=usecols, dtype=read_dtypes(usecols), **kwargs)
+    return apply_schema(df)
+
+# Define function to write a water quality dataframe to a .csv file:
+def write_wq_csv(df, path, **kwargs):
+    '''
+    Function to write a water quality dataframe to a .csv file, keeping dates
+    in the archive's 'yyyy-mm-ddThh:mm:ss' format.
+
+    PARAMETERS:
+    - df: pandas dataframe of water quality data
+    - path: path of .csv file to write
+    - kwargs: other arguments for pandas.DataFrame.to_csv
+
+    RETURNS: None
+    '''
+    df.to_csv(path, date_format=DATE_FORMAT, **kwargs)